@@ -0,0 +1,124 @@
+""" cache of user existence and conversation ownership checks"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import event, inspect
+
+from models import Conversation, User
+
+load_dotenv()
+
+# Seconds a check is trusted; other workers see deletes at most this late. 0 disables
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+
+class AuthorizationCache:
+    """TTL and LRU bounded cache of which users exist and who owns each conversation.
+
+    Only rows that were found are cached, so a new user or conversation is never
+    refused. Deletes and ownership changes made through an ORM session drop their
+    entries; bulk statements, raw SQL and other workers are only seen once the TTL expires.
+    """
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # {("user", id): (True, expires_at)} and {("conversation", id): (owner, expires_at)}
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[Hashable, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def has_user(self, user_id: int) -> bool:
+        """Whether the user is known to exist"""
+        return self._get(("user", user_id)) is not None
+
+    def add_user(self, user_id: int):
+        self._put(("user", user_id), True)
+
+    def conversation_owner(self, conversation_id: int) -> Optional[int]:
+        """Owner of the conversation, or None when it isn't cached"""
+        return self._get(("conversation", conversation_id))
+
+    def add_conversation(self, conversation_id: int, user_id: int):
+        self._put(("conversation", conversation_id), user_id)
+        # A conversation's owner exists
+        self._put(("user", user_id), True)
+
+    def invalidate_user(self, user_id: int):
+        self._entries.pop(("user", user_id), None)
+        owned = [
+            key for key, (owner, _) in self._entries.items()
+            if key[0] == "conversation" and owner == user_id
+        ]
+        for key in owned:
+            del self._entries[key]
+
+    def invalidate_conversation(self, conversation_id: int):
+        self._entries.pop(("conversation", conversation_id), None)
+
+    def clear(self):
+        """Forget every check"""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _get(self, key: Tuple[str, int]) -> Optional[Hashable]:
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def _put(self, key: Tuple[str, int], value: Hashable):
+        if not self.enabled:
+            return
+
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# Global authorization cache instance
+auth_cache = AuthorizationCache()
+
+
+@event.listens_for(User, "after_delete")
+def _forget_user(mapper, connection, target: User):
+    auth_cache.invalidate_user(target.id)
+
+
+@event.listens_for(Conversation, "after_delete")
+def _forget_conversation(mapper, connection, target: Conversation):
+    auth_cache.invalidate_conversation(target.id)
+
+
+@event.listens_for(Conversation, "after_update")
+def _forget_moved_conversation(mapper, connection, target: Conversation):
+    if inspect(target).attrs.user_id.history.has_changes():
+        auth_cache.invalidate_conversation(target.id)
@@ -1,37 +1,125 @@
 """ chatbot agent class"""
-from typing import Dict, List, Any
+import asyncio
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Dict, List, Any, Optional, Tuple, Union
 
 from dotenv import load_dotenv
-from langchain.schema import HumanMessage, AIMessage
-from langchain_groq import ChatGroq
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph, END
 
+from context import summary_cutoff
+from history_cache import to_chat_message
+from llm_providers import create_llm, warm_up_llm
+from metrics import observe_stream
+from response_cache import ResponseCache, response_cache, response_cache_key
+from scheduler import LLMScheduler, QueueStatus, llm_scheduler
+
 load_dotenv()
 
+# Model calls a single /chat/batch request keeps in flight at once
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Extend the current summary with the new lines, keeping names, facts, decisions and "
+    "open questions. Reply with the updated summary only, in at most 250 words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines:\n{lines}"
+)
+
+
+def to_chat_messages(messages: List[Union[Dict[str, str], BaseMessage]]) -> List[BaseMessage]:
+    """Convert to LangChain message format, passing through cached messages"""
+    return [
+        msg if isinstance(msg, BaseMessage) else to_chat_message(msg["role"], msg["content"])
+        for msg in messages
+    ]
+
+
+def with_summary(
+        messages: List[Union[Dict[str, str], BaseMessage]], summary: Optional[str] = None
+) -> List[BaseMessage]:
+    """Convert messages and prepend the running summary of older turns"""
+    chat_messages = to_chat_messages(messages)
+    if summary:
+        chat_messages.insert(
+            0, SystemMessage(content=f"Summary of the earlier conversation:\n{summary}")
+        )
+    return chat_messages
+
+
+def summary_request(summary: Optional[str], messages: List[Dict[str, str]]) -> List[BaseMessage]:
+    """Prompt asking the LLM to fold new lines into the running summary"""
+    lines = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    return [HumanMessage(content=SUMMARY_PROMPT.format(summary=summary or "(none)", lines=lines))]
+
 
 class ChatbotState:
     """chatbot state class"""
     def __init__(self):
         self.messages: List[Dict[str, str]] = []
+        self.summary: Optional[str] = None
+        self.summary_message_id: Optional[int] = None
         self.current_response: str = ""
 
 
-def create_chatbot_graph():
+def create_compaction_node(llm):
+    """Node folding the oldest turns into the running summary once history is too long"""
+
+    def folded_state(state: Dict[str, Any], cut: int, summary: str) -> Dict[str, Any]:
+        messages = state["messages"]
+        return {
+            **state,
+            "messages": messages[cut:],
+            "summary": summary,
+            "summary_message_id": messages[cut - 1].get("id")
+        }
+
+    def compact_history(state: Dict[str, Any]) -> Dict[str, Any]:
+        """Update the running summary with turns that no longer fit"""
+        messages = state.get("messages", [])
+        cut = summary_cutoff(messages)
+        if not cut:
+            return state
+
+        response = llm.invoke(summary_request(state.get("summary"), messages[:cut]))
+        return folded_state(state, cut, response.content)
+
+    async def acompact_history(state: Dict[str, Any]) -> Dict[str, Any]:
+        messages = state.get("messages", [])
+        cut = summary_cutoff(messages)
+        if not cut:
+            return state
+
+        response = await llm.ainvoke(summary_request(state.get("summary"), messages[:cut]))
+        return folded_state(state, cut, response.content)
+
+    return RunnableLambda(compact_history, afunc=acompact_history)
+
+
+def create_compaction_graph(llm):
+    """ langgraph running only the summary compaction step"""
+    workflow = StateGraph(dict)
+    workflow.add_node("compact_history", create_compaction_node(llm))
+    workflow.set_entry_point("compact_history")
+    workflow.add_edge("compact_history", END)
+    return workflow.compile()
+
+
+def create_chatbot_graph(llm=None):
     """ langgraph creation"""
     # Initialize the LLM
-    llm = ChatGroq(model="llama3-8b-8192", temperature=0.3)
+    llm = llm or create_llm(temperature=0.3)
 
     def process_message(state: Dict[str, Any]) -> Dict[str, Any]:
         """Process the user message and generate response"""
         messages = state.get("messages", [])
 
         # Convert to LangChain message format
-        chat_messages = []
-        for msg in messages:
-            if msg["role"] == "user":
-                chat_messages.append(HumanMessage(content=msg["content"]))
-            else:
-                chat_messages.append(AIMessage(content=msg["content"]))
+        chat_messages = with_summary(messages, state.get("summary"))
 
         # Generate response
         response = llm.invoke(chat_messages)
@@ -44,6 +132,8 @@ def create_chatbot_graph():
 
         return {
             "messages": messages,
+            "summary": state.get("summary"),
+            "summary_message_id": state.get("summary_message_id"),
             "current_response": response.content
         }
 
@@ -55,48 +145,274 @@ def create_chatbot_graph():
     workflow = StateGraph(dict)
 
     # Add nodes
+    workflow.add_node("compact_history", create_compaction_node(llm))
     workflow.add_node("process_message", process_message)
 
     # Add edges
-    workflow.set_entry_point("process_message")
+    workflow.set_entry_point("compact_history")
+    workflow.add_edge("compact_history", "process_message")
     workflow.add_edge("process_message", END)
 
     return workflow.compile()
 
 
+class _Flight:
+    """One upstream LLM stream and the chunks it has produced so far"""
+    def __init__(self):
+        self.chunks: List[str] = []
+        # Latest queue update while the stream waits for an LLM slot
+        self.queued: Optional[QueueStatus] = None
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        """Wake every subscriber waiting for the next chunk"""
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self):
+        """Wait for the next chunk or the end of the stream"""
+        await self._changed.wait()
+
+
+class SingleFlight:
+    """Shares one upstream stream between identical requests made at the same time.
+
+    Every subscriber gets all chunks from the start, however late it joins. The
+    upstream stream is cancelled once nobody is reading it any more. Queue
+    updates from the upstream stream are passed on until its first chunk.
+    """
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def stream(
+            self,
+            key: str,
+            open_stream: Callable[[], AsyncIterator[Union[str, QueueStatus]]],
+            on_complete: Optional[Callable[[List[str]], None]] = None
+    ) -> AsyncIterator[Union[str, QueueStatus]]:
+        """Yield the chunks of the stream for `key`, starting it if none is in flight"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight, open_stream, on_complete))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        flight.subscribers += 1
+        sent = 0
+        queued = None
+        try:
+            while True:
+                if not flight.chunks and flight.queued is not queued:
+                    queued = flight.queued
+                    yield queued
+                while sent < len(flight.chunks):
+                    yield flight.chunks[sent]
+                    sent += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.wait()
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # Nobody is listening: free the provider capacity
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _pump(self, key, flight: _Flight, open_stream, on_complete):
+        """Read the upstream stream into the flight"""
+        try:
+            async for chunk in open_stream():
+                if isinstance(chunk, QueueStatus):
+                    flight.queued = chunk
+                else:
+                    flight.chunks.append(chunk)
+                flight.notify()
+            # Populate the cache before the flight goes away so no request falls between
+            if on_complete is not None:
+                on_complete(flight.chunks)
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(key, flight)
+            flight.notify()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
 class StreamingChatbot:
     """ Streaming chatbot"""
-    def __init__(self):
-        self.llm = ChatGroq(model="llama3-8b-8192", temperature=0.7)
+    def __init__(
+            self,
+            llm=None,
+            cache: Optional[ResponseCache] = response_cache,
+            scheduler: LLMScheduler = llm_scheduler
+    ):
+        self.llm = llm or create_llm(temperature=0.7)
+        # Admission control in front of every upstream call
+        self.scheduler = scheduler
+        self.compactor = create_compaction_graph(self.llm)
+        # Replies to prompts seen before; None to always call the LLM
+        self.cache = cache
+        # Identical requests in flight share one upstream stream
+        self.flights = SingleFlight()
+
+    async def warm_up(self):
+        """Open the provider connection with a one token completion, admitted like any call"""
+        await self.scheduler.run(lambda: warm_up_llm(self.llm), priority="background")
+
+    async def compact(
+            self, summary: Optional[str], messages: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """Fold older turns into the running summary when the history is too long"""
+        return await self.scheduler.run(
+            lambda: self.compactor.ainvoke({"messages": messages, "summary": summary}),
+            priority="background"
+        )
+
+    async def stream_response(
+            self,
+            messages: List[Union[Dict[str, str], BaseMessage]],
+            summary: Optional[str] = None,
+            user_id: Optional[int] = None,
+            priority: str = "interactive"
+    ):
+        """Stream response chunk by chunk.
 
-    async def stream_response(self, messages: List[Dict[str, str]]):
-        """Stream response word by word"""
+        Only the new text is yielded; callers that need the whole reply collect the
+        chunks and join them once the stream ends. While the call waits for an LLM
+        slot, `{"queued": QueueStatus}` updates are yielded instead.
+        """
         # Convert to LangChain message format
-        chat_messages = []
-        for msg in messages:
-            if msg["role"] == "user":
-                chat_messages.append(HumanMessage(content=msg["content"]))
-            else:
-                chat_messages.append(AIMessage(content=msg["content"]))
-
-        # Stream the response
-        full_response = ""
-        async for chunk in self.llm.astream(chat_messages):
-            if chunk.content:
-                full_response += chunk.content
-                yield {
-                    "chunk": chunk.content,
-                    "full_response": full_response
-                }
-
-    def get_response(self, messages: List[Dict[str, str]]) -> str:
+        chat_messages = with_summary(messages, summary)
+
+        # Replay a cached reply with the chunks it was streamed in
+        key = response_cache_key(self.llm, chat_messages)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            for content in cached:
+                yield {"chunk": content}
+            return
+
+        async def contents():
+            started = time.perf_counter()
+            first_token = None
+            tokens = 0
+            try:
+                async for chunk in self.llm.astream(chat_messages):
+                    if chunk.content:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        tokens += 1
+                        yield chunk.content
+            finally:
+                observe_stream(started, first_token, tokens)
+
+        def upstream():
+            return self.scheduler.stream(contents, user_id, priority)
+
+        def store(chunks: List[str]):
+            # Only complete replies are cached
+            if self.cache is not None:
+                self.cache.put(key, chunks)
+
+        # Stream the response, joining an identical request already in flight;
+        # closing this generator closes the subscription too
+        async with aclosing(self.flights.stream(key, upstream, store)) as stream:
+            async for content in stream:
+                if isinstance(content, QueueStatus):
+                    yield {"queued": content}
+                else:
+                    yield {"chunk": content}
+
+    def get_response(
+            self,
+            messages: List[Union[Dict[str, str], BaseMessage]],
+            summary: Optional[str] = None
+    ) -> str:
         """Get complete response (non-streaming)"""
-        chat_messages = []
-        for msg in messages:
-            if msg["role"] == "user":
-                chat_messages.append(HumanMessage(content=msg["content"]))
-            else:
-                chat_messages.append(AIMessage(content=msg["content"]))
+        chat_messages = with_summary(messages, summary)
+
+        key = response_cache_key(self.llm, chat_messages)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return "".join(cached)
 
         response = self.llm.invoke(chat_messages)
+        if self.cache is not None:
+            self.cache.put(key, [response.content])
         return response.content
+
+    async def aget_response(
+            self,
+            messages: List[Union[Dict[str, str], BaseMessage]],
+            summary: Optional[str] = None,
+            user_id: Optional[int] = None,
+            priority: str = "interactive"
+    ) -> str:
+        """Get complete response without blocking the event loop"""
+        replies = await self.batch_responses([(messages, summary)], user_id, priority)
+        if isinstance(replies[0], Exception):
+            raise replies[0]
+        return replies[0]
+
+    async def batch_responses(
+            self,
+            conversations: List[Tuple[List[Union[Dict[str, str], BaseMessage]], Optional[str]]],
+            user_id: Optional[int] = None,
+            priority: str = "bulk",
+            max_concurrency: int = BATCH_MAX_CONCURRENCY
+    ) -> List[Union[str, Exception]]:
+        """Complete responses for many (messages, summary) pairs, in order.
+
+        Cached replies are returned directly and identical prompts share one call.
+        The rest are batched with at most `max_concurrency` calls in flight, each
+        admitted by the scheduler so bulk work yields to interactive chats. A
+        failed call returns its exception in place of the reply.
+        """
+        prompts = [with_summary(messages, summary) for messages, summary in conversations]
+        keys = [response_cache_key(self.llm, chat_messages) for chat_messages in prompts]
+
+        replies: Dict[str, Union[str, Exception]] = {}
+        pending: Dict[str, List[BaseMessage]] = {}
+        for key, chat_messages in zip(keys, prompts):
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                replies[key] = "".join(cached)
+            elif key not in replies:
+                pending[key] = chat_messages
+
+        async def invoke(chat_messages: List[BaseMessage]) -> str:
+            response = await self.scheduler.run(
+                lambda: self.llm.ainvoke(chat_messages), user_id, priority
+            )
+            return response.content
+
+        if pending:
+            results = await RunnableLambda(invoke).abatch(
+                list(pending.values()),
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+            for key, result in zip(pending, results):
+                replies[key] = result
+                if self.cache is not None and not isinstance(result, Exception):
+                    self.cache.put(key, [result])
+
+        return [replies[key] for key in keys]
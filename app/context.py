@@ -0,0 +1,72 @@
+""" conversation context window helpers"""
+import math
+import os
+from typing import Callable, Dict, List, Optional, Sequence
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Prompt budget for llama3-8b-8192, leaving room in the window for the reply
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6144"))
+
+# Unsummarized history past this many tokens is folded into the running summary
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "3072"))
+
+# Tokens of the newest turns that are always kept verbatim when summarizing
+SUMMARY_KEEP_TOKENS = int(os.getenv("SUMMARY_KEEP_TOKENS", "1024"))
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Average characters per token for llama3's tokenizer on English text
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of tokens in a message body"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message: Dict) -> int:
+    """Tokens a message costs in the prompt, using its stored count when present"""
+    token_count = message.get("token_count") or count_tokens(message["content"])
+    return token_count + MESSAGE_TOKEN_OVERHEAD
+
+
+def build_context_window(
+        messages: Sequence,
+        budget: Optional[int] = None,
+        tokens: Callable[..., int] = message_tokens
+) -> List:
+    """Keep the most recent messages that fit within the token budget.
+
+    The newest message is always kept, even when it alone exceeds the budget.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+    total = 0
+    start = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        total += tokens(messages[index])
+        if total > budget and index != len(messages) - 1:
+            break
+        start = index
+
+    return list(messages[start:])
+
+
+def summary_cutoff(
+        messages: Sequence[Dict],
+        trigger: Optional[int] = None,
+        keep: Optional[int] = None
+) -> int:
+    """Number of oldest messages to fold into the running summary, 0 when under the trigger"""
+    trigger = SUMMARY_TRIGGER_TOKENS if trigger is None else trigger
+    keep = SUMMARY_KEEP_TOKENS if keep is None else keep
+
+    if sum(message_tokens(msg) for msg in messages) <= trigger:
+        return 0
+    return len(messages) - len(build_context_window(messages, keep))
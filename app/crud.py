@@ -1,10 +1,142 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import case, desc, func, or_, select, update
+from context import CHARS_PER_TOKEN, CONTEXT_TOKEN_BUDGET, MESSAGE_TOKEN_OVERHEAD, count_tokens
+from auth_cache import auth_cache
+from history_cache import TurnContext, history_cache, to_chat_message
+from metrics import timed_crud
 from models import User, Conversation, Message
+from pagination import Cursor, DEFAULT_PAGE_SIZE, Page, keyset_page, keyset_query
 from schemas import UserCreate, ConversationCreate, MessageCreate
-from typing import Optional, List
+from typing import TYPE_CHECKING, Dict, Optional, List
+
+# Only for annotations; importing the app must not load the LLM stack
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+
+# Characters of the last message kept on the conversation for listings
+PREVIEW_LENGTH = 120
+
+
+def new_message(conversation_id: int, role: str, content: str) -> Message:
+    """Build a message with its token count and timestamp filled in"""
+    return Message(
+        conversation_id=conversation_id,
+        role=role,
+        content=content,
+        token_count=count_tokens(content),
+        created_at=datetime.utcnow()
+    )
+
+
+def message_counters(conversation_id: int, messages: List[Message]):
+    """Statement updating a conversation's counters for newly written messages.
+
+    Run it in the same transaction as the inserts so the counters never drift.
+    """
+    last = messages[-1]
+    return update(Conversation).where(
+        Conversation.id == conversation_id
+    ).values(
+        message_count=Conversation.message_count + len(messages),
+        total_tokens=Conversation.total_tokens + sum(msg.token_count for msg in messages),
+        last_message_at=last.created_at,
+        last_message_preview=last.content[:PREVIEW_LENGTH],
+        updated_at=last.created_at
+    ).execution_options(synchronize_session=False)
+
+
+def conversation_messages_query(conversation_id: int):
+    """Select a conversation's messages in the order they were written"""
+    return select(Message).filter(
+        Message.conversation_id == conversation_id
+    ).order_by(Message.created_at)
+
+
+def user_conversations_query(user_id: int):
+    """Select a user's conversations, most recently updated first"""
+    return select(Conversation).filter(
+        Conversation.user_id == user_id
+    ).order_by(desc(Conversation.updated_at))
+
 
+def message_token_column():
+    """SQL expression for the tokens a stored message takes up in the prompt"""
+    # Rows written before token counts were stored fall back to a length estimate
+    return case(
+        (Message.token_count > 0, Message.token_count),
+        else_=func.length(Message.content) / CHARS_PER_TOKEN
+    ) + MESSAGE_TOKEN_OVERHEAD
 
+
+def context_window_query(
+        conversation_id: int,
+        budget: Optional[int] = None,
+        after_message_id: Optional[int] = None
+):
+    """Select the newest messages whose running token total fits in the budget"""
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+    conditions = [Message.conversation_id == conversation_id]
+    if after_message_id is not None:
+        # Messages up to here are already covered by the conversation summary
+        conditions.append(Message.id > after_message_id)
+
+    newest_first = (desc(Message.created_at), desc(Message.id))
+
+    window = select(
+        Message.id,
+        Message.role,
+        Message.content,
+        Message.token_count,
+        Message.created_at,
+        func.sum(message_token_column()).over(order_by=newest_first).label("running_tokens"),
+        func.row_number().over(order_by=newest_first).label("position"),
+    ).filter(*conditions).subquery()
+
+    # The newest message is always kept, even when it alone exceeds the budget
+    return select(window.c.role, window.c.content, window.c.token_count).filter(
+        or_(window.c.running_tokens <= budget, window.c.position == 1)
+    ).order_by(window.c.created_at, window.c.id)
+
+
+def context_windows_query(conversation_ids: List[int], budget: Optional[int] = None):
+    """Context windows of several conversations in one query.
+
+    Same windows as context_window_query, each starting after its conversation's
+    summarized messages.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    newest_first = (desc(Message.created_at), desc(Message.id))
+    per_conversation = dict(partition_by=Message.conversation_id, order_by=newest_first)
+
+    window = select(
+        Message.conversation_id,
+        Message.id,
+        Message.role,
+        Message.content,
+        Message.token_count,
+        Message.created_at,
+        func.sum(message_token_column()).over(**per_conversation).label("running_tokens"),
+        func.row_number().over(**per_conversation).label("position"),
+    ).join(
+        Conversation, Conversation.id == Message.conversation_id
+    ).filter(
+        Message.conversation_id.in_(conversation_ids),
+        Message.id > func.coalesce(Conversation.summary_message_id, 0)
+    ).subquery()
+
+    return select(
+        window.c.conversation_id, window.c.role, window.c.content, window.c.token_count
+    ).filter(
+        or_(window.c.running_tokens <= budget, window.c.position == 1)
+    ).order_by(window.c.conversation_id, window.c.created_at, window.c.id)
+
+
+@timed_crud
 class UserCRUD:
     @staticmethod
     def create_user(db: Session, user: UserCreate) -> User:
@@ -12,6 +144,7 @@ class UserCRUD:
         db.add(db_user)
         db.commit()
         db.refresh(db_user)
+        auth_cache.add_user(db_user.id)
         return db_user
 
     @staticmethod
@@ -25,7 +158,18 @@ class UserCRUD:
     def get_user_by_id(db: Session, user_id: int) -> Optional[User]:
         return db.query(User).filter(User.id == user_id).first()
 
+    @staticmethod
+    def user_exists(db: Session, user_id: int) -> bool:
+        """Existence check served from the authorization cache"""
+        if auth_cache.has_user(user_id):
+            return True
+        found = db.query(User.id).filter(User.id == user_id).first() is not None
+        if found:
+            auth_cache.add_user(user_id)
+        return found
+
 
+@timed_crud
 class ConversationCRUD:
     @staticmethod
     def create_conversation(db: Session, user_id: int, title: Optional[str] = None) -> Conversation:
@@ -33,11 +177,26 @@ class ConversationCRUD:
         db.add(db_conversation)
         db.commit()
         db.refresh(db_conversation)
+        auth_cache.add_conversation(db_conversation.id, user_id)
         return db_conversation
 
     @staticmethod
     def get_conversation(db: Session, conversation_id: int) -> Optional[Conversation]:
-        return db.query(Conversation).filter(Conversation.id == conversation_id).first()
+        conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+        if conversation is not None:
+            auth_cache.add_conversation(conversation.id, conversation.user_id)
+        return conversation
+
+    @staticmethod
+    def get_owner(db: Session, conversation_id: int) -> Optional[int]:
+        """Owner of a conversation, served from the authorization cache"""
+        owner = auth_cache.conversation_owner(conversation_id)
+        if owner is not None:
+            return owner
+        owner = db.query(Conversation.user_id).filter(Conversation.id == conversation_id).scalar()
+        if owner is not None:
+            auth_cache.add_conversation(conversation_id, owner)
+        return owner
 
     @staticmethod
     def get_user_conversations(db: Session, user_id: int) -> List[Conversation]:
@@ -45,18 +204,60 @@ class ConversationCRUD:
             Conversation.user_id == user_id
         ).order_by(desc(Conversation.updated_at)).all()
 
+    @staticmethod
+    def get_user_conversations_page(
+            db: Session,
+            user_id: int,
+            limit: int = DEFAULT_PAGE_SIZE,
+            before: Optional[Cursor] = None,
+            after: Optional[Cursor] = None
+    ) -> Page:
+        """One page of a user's conversations, most recently updated first"""
+        stmt, newest_first = keyset_query(
+            select(Conversation).filter(
+                Conversation.user_id == user_id
+            ).options(selectinload(Conversation.messages)),
+            Conversation.updated_at, Conversation.id, limit, before, after
+        )
+        rows = db.execute(stmt).scalars().all()
+        return keyset_page(rows, limit, newest_first, descending=True)
+
+    @staticmethod
+    def get_user_conversation_previews_page(
+            db: Session,
+            user_id: int,
+            limit: int = DEFAULT_PAGE_SIZE,
+            before: Optional[Cursor] = None,
+            after: Optional[Cursor] = None
+    ) -> Page:
+        """One page of conversation previews in a single query, without loading messages"""
+        stmt, newest_first = keyset_query(
+            select(
+                Conversation.id,
+                Conversation.title,
+                Conversation.created_at,
+                Conversation.updated_at,
+                Conversation.message_count,
+                Conversation.total_tokens,
+                Conversation.last_message_at,
+                Conversation.last_message_preview
+            ).filter(Conversation.user_id == user_id),
+            Conversation.updated_at, Conversation.id, limit, before, after
+        )
+        rows = db.execute(stmt).all()
+        return keyset_page(rows, limit, newest_first, descending=True)
+
 
+@timed_crud
 class MessageCRUD:
     @staticmethod
     def create_message(db: Session, conversation_id: int, role: str, content: str) -> Message:
-        db_message = Message(
-            conversation_id=conversation_id,
-            role=role,
-            content=content
-        )
+        db_message = new_message(conversation_id, role, content)
         db.add(db_message)
+        db.execute(message_counters(conversation_id, [db_message]))
         db.commit()
         db.refresh(db_message)
+        history_cache.append(conversation_id, role, content, db_message.token_count)
         return db_message
 
     @staticmethod
@@ -65,7 +266,308 @@ class MessageCRUD:
             Message.conversation_id == conversation_id
         ).order_by(Message.created_at).all()
 
+    @staticmethod
+    def get_conversation_messages_page(
+            db: Session,
+            conversation_id: int,
+            limit: int = DEFAULT_PAGE_SIZE,
+            before: Optional[Cursor] = None,
+            after: Optional[Cursor] = None
+    ) -> Page:
+        """One page of a conversation's messages, oldest first, defaulting to the newest"""
+        stmt, newest_first = keyset_query(
+            select(Message).filter(Message.conversation_id == conversation_id),
+            Message.created_at, Message.id, limit, before, after
+        )
+        rows = db.execute(stmt).scalars().all()
+        return keyset_page(rows, limit, newest_first, descending=False)
+
     @staticmethod
     def get_messages_as_dict(db: Session, conversation_id: int) -> List[dict]:
         messages = MessageCRUD.get_conversation_messages(db, conversation_id)
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
\ No newline at end of file
+        return [{"role": msg.role, "content": msg.content} for msg in messages]
+
+    @staticmethod
+    def get_context_messages(
+            db: Session,
+            conversation_id: int,
+            budget: Optional[int] = None,
+            after_message_id: Optional[int] = None
+    ) -> List[dict]:
+        rows = db.execute(context_window_query(conversation_id, budget, after_message_id)).all()
+        return [
+            {"role": role, "content": content, "token_count": token_count}
+            for role, content, token_count in rows
+        ]
+
+
+@timed_crud
+class AsyncUserCRUD:
+    @staticmethod
+    async def create_user(db: AsyncSession, user: UserCreate) -> User:
+        db_user = User(username=user.username, email=user.email)
+        db.add(db_user)
+        await db.commit()
+        await db.refresh(db_user)
+        auth_cache.add_user(db_user.id)
+        return db_user
+
+    @staticmethod
+    async def get_user_by_username(db: AsyncSession, username: str) -> Optional[User]:
+        result = await db.execute(select(User).filter(User.username == username).limit(1))
+        return result.scalars().first()
+
+    @staticmethod
+    async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
+        result = await db.execute(select(User).filter(User.email == email).limit(1))
+        return result.scalars().first()
+
+    @staticmethod
+    async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[User]:
+        return await db.get(User, user_id)
+
+    @staticmethod
+    async def user_exists(db: AsyncSession, user_id: int) -> bool:
+        """Existence check served from the authorization cache"""
+        if auth_cache.has_user(user_id):
+            return True
+        result = await db.execute(select(User.id).filter(User.id == user_id))
+        found = result.first() is not None
+        if found:
+            auth_cache.add_user(user_id)
+        return found
+
+
+@timed_crud
+class AsyncConversationCRUD:
+    @staticmethod
+    async def create_conversation(
+            db: AsyncSession, user_id: int, title: Optional[str] = None
+    ) -> Conversation:
+        db_conversation = Conversation(user_id=user_id, title=title)
+        db.add(db_conversation)
+        await db.commit()
+        await db.refresh(db_conversation)
+        auth_cache.add_conversation(db_conversation.id, user_id)
+        return db_conversation
+
+    @staticmethod
+    async def get_conversation(db: AsyncSession, conversation_id: int) -> Optional[Conversation]:
+        conversation = await db.get(Conversation, conversation_id)
+        if conversation is not None:
+            auth_cache.add_conversation(conversation.id, conversation.user_id)
+        return conversation
+
+    @staticmethod
+    async def get_owner(db: AsyncSession, conversation_id: int) -> Optional[int]:
+        """Owner of a conversation, served from the authorization cache"""
+        owner = auth_cache.conversation_owner(conversation_id)
+        if owner is not None:
+            return owner
+        result = await db.execute(
+            select(Conversation.user_id).filter(Conversation.id == conversation_id)
+        )
+        owner = result.scalar()
+        if owner is not None:
+            auth_cache.add_conversation(conversation_id, owner)
+        return owner
+
+    @staticmethod
+    async def get_conversations(db: AsyncSession, conversation_ids: List[int]) -> List[Conversation]:
+        result = await db.execute(
+            select(Conversation).filter(Conversation.id.in_(conversation_ids))
+        )
+        conversations = list(result.scalars().all())
+        for conversation in conversations:
+            auth_cache.add_conversation(conversation.id, conversation.user_id)
+        return conversations
+
+    @staticmethod
+    async def create_conversations(
+            db: AsyncSession, user_id: int, count: int, title: Optional[str] = None
+    ) -> List[Conversation]:
+        """Create several conversations in one transaction"""
+        conversations = [Conversation(user_id=user_id, title=title) for _ in range(count)]
+        db.add_all(conversations)
+        await db.commit()
+        for conversation in conversations:
+            auth_cache.add_conversation(conversation.id, user_id)
+        return conversations
+
+    @staticmethod
+    async def update_summary(
+            db: AsyncSession, conversation: Conversation, summary: str, summary_message_id: int
+    ) -> Conversation:
+        conversation.summary = summary
+        conversation.summary_message_id = summary_message_id
+        await db.commit()
+        # Cached windows may still hold the turns that were just summarized
+        history_cache.invalidate(conversation.id)
+        return conversation
+
+    @staticmethod
+    async def get_user_conversations(db: AsyncSession, user_id: int) -> List[Conversation]:
+        result = await db.execute(user_conversations_query(user_id))
+        return list(result.scalars().all())
+
+
+@timed_crud
+class AsyncMessageCRUD:
+    @staticmethod
+    async def create_message(
+            db: AsyncSession, conversation_id: int, role: str, content: str
+    ) -> Message:
+        db_message = new_message(conversation_id, role, content)
+        db.add(db_message)
+        await db.execute(message_counters(conversation_id, [db_message]))
+        await db.commit()
+        history_cache.append(conversation_id, role, content, db_message.token_count)
+        return db_message
+
+    @staticmethod
+    async def get_conversation_messages(db: AsyncSession, conversation_id: int) -> List[Message]:
+        result = await db.execute(conversation_messages_query(conversation_id))
+        return list(result.scalars().all())
+
+    @staticmethod
+    async def get_messages_as_dict(db: AsyncSession, conversation_id: int) -> List[dict]:
+        result = await db.execute(
+            select(Message.role, Message.content).filter(
+                Message.conversation_id == conversation_id
+            ).order_by(Message.created_at)
+        )
+        return [{"role": role, "content": content} for role, content in result.all()]
+
+    @staticmethod
+    async def get_context_messages(
+            db: AsyncSession,
+            conversation_id: int,
+            budget: Optional[int] = None,
+            after_message_id: Optional[int] = None
+    ) -> List[dict]:
+        result = await db.execute(
+            context_window_query(conversation_id, budget, after_message_id)
+        )
+        return [
+            {"role": role, "content": content, "token_count": token_count}
+            for role, content, token_count in result.all()
+        ]
+
+    @staticmethod
+    async def get_cached_context(
+            db: AsyncSession, conversation: Conversation, budget: Optional[int] = None
+    ) -> List["BaseMessage"]:
+        """Unsummarized context window as LangChain messages, served from the history cache"""
+        messages = history_cache.get(conversation.id, budget)
+        if messages is not None:
+            return messages
+
+        token = history_cache.begin_load(conversation.id)
+        try:
+            window = await AsyncMessageCRUD.get_context_messages(
+                db, conversation.id, budget, conversation.summary_message_id
+            )
+            history_cache.put(conversation.id, window, budget, conversation.summary, token)
+        finally:
+            history_cache.end_load(conversation.id)
+        return [to_chat_message(msg["role"], msg["content"]) for msg in window]
+
+    @staticmethod
+    async def get_turn_context(
+            db: AsyncSession, conversation_id: int, budget: Optional[int] = None
+    ) -> Optional[TurnContext]:
+        """Running summary and context window of a conversation, served from the history cache.
+
+        A miss reads the summary columns and then the window, never the whole row.
+        Returns None when the conversation doesn't exist.
+        """
+        context = history_cache.get_context(conversation_id, budget)
+        if context is not None:
+            return context
+
+        result = await db.execute(
+            select(Conversation.summary, Conversation.summary_message_id).filter(
+                Conversation.id == conversation_id
+            )
+        )
+        row = result.first()
+        if row is None:
+            return None
+
+        token = history_cache.begin_load(conversation_id)
+        try:
+            window = await AsyncMessageCRUD.get_context_messages(
+                db, conversation_id, budget, row.summary_message_id
+            )
+            history_cache.put(conversation_id, window, budget, row.summary, token)
+        finally:
+            history_cache.end_load(conversation_id)
+        return TurnContext(
+            row.summary, [to_chat_message(msg["role"], msg["content"]) for msg in window]
+        )
+
+    @staticmethod
+    async def get_cached_contexts(
+            db: AsyncSession, conversations: List[Conversation], budget: Optional[int] = None
+    ) -> Dict[int, List["BaseMessage"]]:
+        """Context windows of many conversations, loading the uncached ones in one query"""
+        contexts = {}
+        windows: Dict[int, List[dict]] = {}
+        for conversation in conversations:
+            messages = history_cache.get(conversation.id, budget)
+            if messages is not None:
+                contexts[conversation.id] = messages
+            else:
+                windows[conversation.id] = []
+        if not windows:
+            return contexts
+
+        tokens = {
+            conversation_id: history_cache.begin_load(conversation_id)
+            for conversation_id in windows
+        }
+        try:
+            result = await db.execute(context_windows_query(list(windows), budget))
+            for conversation_id, role, content, token_count in result.all():
+                windows[conversation_id].append(
+                    {"role": role, "content": content, "token_count": token_count}
+                )
+
+            summaries = {conversation.id: conversation.summary for conversation in conversations}
+            for conversation_id, window in windows.items():
+                history_cache.put(
+                    conversation_id, window, budget, summaries[conversation_id],
+                    tokens[conversation_id]
+                )
+                contexts[conversation_id] = [
+                    to_chat_message(msg["role"], msg["content"]) for msg in window
+                ]
+        finally:
+            for conversation_id in tokens:
+                history_cache.end_load(conversation_id)
+        return contexts
+
+    @staticmethod
+    async def warm_user_history(db: AsyncSession, user_id: int, limit: int = 3):
+        """Load the user's most recent conversations into the history cache"""
+        result = await db.execute(user_conversations_query(user_id).limit(limit))
+        for conversation in result.scalars().all():
+            if conversation.id not in history_cache:
+                await AsyncMessageCRUD.get_cached_context(db, conversation)
+
+    @staticmethod
+    async def get_unsummarized_messages(db: AsyncSession, conversation: Conversation) -> List[dict]:
+        """Messages written after the last one folded into the conversation summary"""
+        conditions = [Message.conversation_id == conversation.id]
+        if conversation.summary_message_id is not None:
+            conditions.append(Message.id > conversation.summary_message_id)
+
+        result = await db.execute(
+            select(Message.id, Message.role, Message.content, Message.token_count).filter(
+                *conditions
+            ).order_by(Message.created_at, Message.id)
+        )
+        return [
+            {"id": id_, "role": role, "content": content, "token_count": token_count}
+            for id_, role, content, token_count in result.all()
+        ]
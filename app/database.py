@@ -1,16 +1,124 @@
-from sqlalchemy import create_engine
+import asyncio
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import NullPool, QueuePool
 import os
+from typing import Any, Dict, Optional
+
 from dotenv import load_dotenv
 
+from metrics import instrument_engine
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# Connection pool of each engine; the async engine gets its own pool of the same size
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Test connections before use and replace ones older than DB_POOL_RECYCLE seconds (-1: never),
+# so connections dropped by the server or a proxy aren't handed out
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Connections each engine opens during startup warmup, so first requests don't wait on them
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", "2"))
+
+# Alembic setup lives next to this module
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+# Revision matching the schema created by create_all before migrations existed
+BASELINE_REVISION = "0001"
+# PostgreSQL advisory lock key serializing migrations across workers
+MIGRATION_LOCK_ID = 7_245_931
+
+# Async drivers used for each sync dialect in DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def get_async_database_url(url: str) -> str:
+    """Map a sync database url onto the matching async driver"""
+    url = make_url(url)
+    if url.drivername == "postgres":
+        url = url.set(drivername="postgresql")
+    async_driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if async_driver is None or url.get_dialect().is_async:
+        return url.render_as_string(hide_password=False)
+    return url.set(drivername=async_driver).render_as_string(hide_password=False)
+
+
+def pool_options(url: str) -> Dict[str, Any]:
+    """Pool arguments for create_engine; sizes only apply to queue pools"""
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    url = make_url(url)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update(
+            pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT
+        )
+    return options
+
+
+def pool_stats(engine) -> Dict[str, Any]:
+    """Connections an engine's pool holds, lends out and may still open"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        # Pools without a size open a connection per checkout
+        return {"pool": type(pool).__name__}
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+    }
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(DATABASE_URL)
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine used by the chat handlers so queries don't block the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+# Commit counts and pool checkout waits for /metrics
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
+
+def warm_pool(count: int = DB_POOL_WARM):
+    """Open pooled connections on the sync engine"""
+    connections = [engine.connect() for _ in range(min(count, DB_POOL_SIZE))]
+    for connection in connections:
+        connection.close()
+
+
+async def warm_async_pool(count: int = DB_POOL_WARM):
+    """Open pooled connections on the async engine"""
+    connections = await asyncio.gather(*(
+        async_engine.connect() for _ in range(min(count, DB_POOL_SIZE))
+    ))
+    for connection in connections:
+        await connection.close()
+
+
+def db_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Pool usage of the sync and async engines"""
+    return {"sync": pool_stats(engine), "async": pool_stats(async_engine.sync_engine)}
+
+
 Base = declarative_base()
 
 def get_db():
@@ -18,4 +126,53 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_async_session_factory():
+    """Session factory for work that outlives one request, like WebSocket generations"""
+    return AsyncSessionLocal
+
+
+def run_migrations(database_url: Optional[str] = None):
+    """Upgrade the database schema to the latest alembic revision.
+
+    On PostgreSQL the upgrade holds an advisory lock, so workers starting together
+    take turns and the later ones find the schema already at head. Other databases
+    have no such lock; run the migrations once before starting several workers.
+    """
+    from alembic import command
+    from alembic.config import Config
+
+    database_url = database_url or DATABASE_URL
+    config = Config(ALEMBIC_INI)
+    config.set_main_option(
+        "script_location", os.path.join(os.path.dirname(ALEMBIC_INI), "migrations")
+    )
+    config.set_main_option("sqlalchemy.url", database_url.replace("%", "%%"))
+
+    migration_engine = create_engine(database_url, poolclass=NullPool)
+    try:
+        with migration_engine.connect() as lock:
+            locked = lock.dialect.name == "postgresql"
+            if locked:
+                lock.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+                lock.commit()
+            try:
+                # Databases created with create_all start from the baseline revision
+                tables = inspect(migration_engine).get_table_names()
+                if "users" in tables and "alembic_version" not in tables:
+                    command.stamp(config, BASELINE_REVISION)
+
+                command.upgrade(config, "head")
+            finally:
+                if locked:
+                    lock.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                    lock.commit()
+    finally:
+        migration_engine.dispose()
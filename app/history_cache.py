@@ -0,0 +1,225 @@
+""" in-process cache of conversation history as LangChain messages"""
+import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+from context import CONTEXT_TOKEN_BUDGET, MESSAGE_TOKEN_OVERHEAD, build_context_window
+
+# Imported where used; importing the app must not load the LLM stack
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+load_dotenv()
+
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_CACHE_MAX_CONVERSATIONS", "1000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rough per-message cost of the LangChain object on top of its content
+MESSAGE_OBJECT_BYTES = 256
+
+
+class CachedMessage(NamedTuple):
+    """history entry already converted for the LLM"""
+    message: "BaseMessage"
+    token_count: int
+
+
+def to_chat_message(role: str, content: str) -> "BaseMessage":
+    """Convert a stored message to LangChain message format"""
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    if role == "user":
+        return HumanMessage(content=content)
+    return AIMessage(content=content)
+
+
+def cached_message_tokens(item: CachedMessage) -> int:
+    """Prompt tokens of a cached message"""
+    return item.token_count + MESSAGE_TOKEN_OVERHEAD
+
+
+def cached_message_bytes(item: CachedMessage) -> int:
+    """Approximate memory held by a cached message"""
+    return len(item.message.content) + MESSAGE_OBJECT_BYTES
+
+
+class TurnContext(NamedTuple):
+    """What a chat turn sends the LLM: the running summary and the newest messages"""
+    summary: Optional[str]
+    messages: List["BaseMessage"]
+
+
+class _CachedHistory:
+    """Newest messages of one conversation, covering at least `budget` tokens"""
+    def __init__(self, messages: List[CachedMessage], budget: int, summary: Optional[str]):
+        self.messages = messages
+        self.budget = budget
+        self.summary = summary
+        self.size = sum(cached_message_bytes(item) for item in messages) + len(summary or "")
+
+
+class ConversationHistoryCache:
+    """Bounded LRU cache of per-conversation context windows.
+
+    Entries hold the newest messages that fit in the context budget, so they are
+    kept up to date by appending on write and trimming from the front, along with
+    the running summary they follow. Writing a new summary must invalidate the entry.
+    """
+    def __init__(
+            self,
+            max_conversations: int = HISTORY_CACHE_MAX_CONVERSATIONS,
+            max_bytes: int = HISTORY_CACHE_MAX_BYTES
+    ):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, _CachedHistory]" = OrderedDict()
+        # Loads in flight: {conversation_id: [generation, loads]}. The generation moves
+        # on every write or invalidation, so a load that began before it is stale
+        self._loading: Dict[int, List[int]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, conversation_id: int) -> bool:
+        return conversation_id in self._entries
+
+    def get(
+            self, conversation_id: int, budget: Optional[int] = None
+    ) -> Optional[List["BaseMessage"]]:
+        """Return the cached context window, or None on a miss"""
+        context = self.get_context(conversation_id, budget)
+        return None if context is None else context.messages
+
+    def get_context(
+            self, conversation_id: int, budget: Optional[int] = None
+    ) -> Optional[TurnContext]:
+        """Return the cached summary and context window, or None on a miss"""
+        budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+        entry = self._entries.get(conversation_id)
+        if entry is None or entry.budget < budget:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        window = build_context_window(entry.messages, budget, tokens=cached_message_tokens)
+        return TurnContext(entry.summary, [item.message for item in window])
+
+    def begin_load(self, conversation_id: int) -> int:
+        """Mark that the window for a conversation is being read from the database.
+
+        Returns the token to pass to put(); call end_load() once the load is over.
+        """
+        loading = self._loading.setdefault(conversation_id, [0, 0])
+        loading[1] += 1
+        return loading[0]
+
+    def end_load(self, conversation_id: int):
+        """Forget a load started with begin_load, whether or not it succeeded"""
+        loading = self._loading.get(conversation_id)
+        if loading is None:
+            return
+        loading[1] -= 1
+        if loading[1] <= 0:
+            del self._loading[conversation_id]
+
+    def put(
+            self,
+            conversation_id: int,
+            messages: List[Dict],
+            budget: Optional[int] = None,
+            summary: Optional[str] = None,
+            token: Optional[int] = None
+    ):
+        """Store a context window loaded from the database with the summary it follows.
+
+        With the token from begin_load, the window is discarded if a message was
+        written or the conversation invalidated while it was loading.
+        """
+        budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+
+        if token is not None:
+            loading = self._loading.get(conversation_id)
+            if loading is None or loading[0] != token:
+                return
+
+        items = [
+            CachedMessage(to_chat_message(msg["role"], msg["content"]), msg["token_count"])
+            for msg in messages
+        ]
+        self._remove(conversation_id)
+        entry = _CachedHistory(items, budget, summary)
+        self._entries[conversation_id] = entry
+        self.size += entry.size
+        self._evict()
+
+    def append(self, conversation_id: int, role: str, content: str, token_count: int):
+        """Add a newly written message to a cached conversation"""
+        self._advance(conversation_id)
+
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+
+        item = CachedMessage(to_chat_message(role, content), token_count)
+        entry.messages.append(item)
+        entry.size += cached_message_bytes(item)
+        self.size += cached_message_bytes(item)
+
+        # Drop messages that fell out of the context window
+        window = build_context_window(entry.messages, entry.budget, tokens=cached_message_tokens)
+        for dropped in entry.messages[:len(entry.messages) - len(window)]:
+            entry.size -= cached_message_bytes(dropped)
+            self.size -= cached_message_bytes(dropped)
+        entry.messages = window
+
+        self._entries.move_to_end(conversation_id)
+        self._evict()
+
+    def invalidate(self, conversation_id: int):
+        """Remove a conversation from the cache, discarding loads in flight"""
+        self._advance(conversation_id)
+        self._remove(conversation_id)
+
+    def _advance(self, conversation_id: int):
+        loading = self._loading.get(conversation_id)
+        if loading is not None:
+            loading[0] += 1
+
+    def _remove(self, conversation_id: int):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def clear(self):
+        """Remove every cached conversation, discarding loads in flight"""
+        self._entries.clear()
+        for loading in self._loading.values():
+            loading[0] += 1
+        self.size = 0
+
+    def _evict(self):
+        """Evict least recently used conversations until within bounds"""
+        while self._entries and (
+                len(self._entries) > self.max_conversations or self.size > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters"""
+        return {
+            "conversations": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Global history cache instance
+history_cache = ConversationHistoryCache()
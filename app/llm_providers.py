@@ -0,0 +1,150 @@
+""" chat model providers selected by LLM_PROVIDER"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+load_dotenv()
+
+# groq: the hosted model; fake: an offline model for tests and load tests
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "groq")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama3-8b-8192")
+
+# Send a one token completion at startup to open the provider connection (billed by Groq)
+LLM_WARMUP_PING = os.getenv("LLM_WARMUP_PING", "false").lower() in ("1", "true", "yes")
+# Seconds the ping may take before the worker is marked ready without it
+LLM_WARMUP_TIMEOUT = float(os.getenv("LLM_WARMUP_TIMEOUT", "5"))
+
+FAKE_LLM_TTFT_MS = float(os.getenv("FAKE_LLM_TTFT_MS", "200"))
+FAKE_LLM_TOKEN_DELAY_MS = float(os.getenv("FAKE_LLM_TOKEN_DELAY_MS", "20"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_TOKENS = int(os.getenv("FAKE_LLM_TOKENS", "50"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+FAKE_VOCABULARY = (
+    "the", "a", "chat", "model", "reply", "stream", "token", "user", "message", "server",
+    "fast", "slow", "answer", "question", "context", "summary", "history", "latency",
+    "request", "response", "is", "with", "for", "and", "of", "to", "in", "that", "this", "it",
+)
+
+
+class FakeLLMError(RuntimeError):
+    """Failure injected by FakeStreamingChatModel"""
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Offline chat model streaming deterministic tokens with configurable latency.
+
+    The reply depends only on the seed and the prompt, so runs are repeatable.
+    Failures are drawn from a seeded sequence at `error_rate`, partway through
+    the stream like a dropped provider connection.
+    """
+    model_name: str = "fake"
+    temperature: Optional[float] = None
+    ttft_ms: float = FAKE_LLM_TTFT_MS
+    token_delay_ms: float = FAKE_LLM_TOKEN_DELAY_MS
+    error_rate: float = FAKE_LLM_ERROR_RATE
+    tokens: int = FAKE_LLM_TOKENS
+    seed: int = FAKE_LLM_SEED
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def reply_tokens(self, messages: List[BaseMessage]) -> List[str]:
+        """Tokens of the reply to a prompt"""
+        prompt = "\n".join(f"{msg.type}:{msg.content}" for msg in messages)
+        digest = hashlib.sha256(f"{self.seed}\n{prompt}".encode()).digest()
+        rng = random.Random(digest)
+        words = [rng.choice(FAKE_VOCABULARY) for _ in range(self.tokens)]
+        return [word if i == 0 else f" {word}" for i, word in enumerate(words)]
+
+    def _failure_point(self) -> Optional[int]:
+        """Token index at which this call fails, or None"""
+        rng = random.Random(f"{self.seed}:{self.calls}")
+        self.calls += 1
+        if self.error_rate and rng.random() < self.error_rate:
+            return rng.randrange(max(self.tokens, 1))
+        return None
+
+    def _stream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Any = None,
+            **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        fail_at = self._failure_point()
+        time.sleep(self.ttft_ms / 1000)
+        for i, token in enumerate(self.reply_tokens(messages)):
+            if i:
+                time.sleep(self.token_delay_ms / 1000)
+            if i == fail_at:
+                raise FakeLLMError("Injected provider failure")
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Any = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        fail_at = self._failure_point()
+        await asyncio.sleep(self.ttft_ms / 1000)
+        for i, token in enumerate(self.reply_tokens(messages)):
+            if i:
+                await asyncio.sleep(self.token_delay_ms / 1000)
+            if i == fail_at:
+                raise FakeLLMError("Injected provider failure")
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    def _generate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Any = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        content = "".join(chunk.message.content for chunk in self._stream(messages))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    async def _agenerate(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Any = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        content = "".join([chunk.message.content async for chunk in self._astream(messages)])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+def create_llm(temperature: float, provider: Optional[str] = None) -> BaseChatModel:
+    """Chat model for the configured provider"""
+    provider = provider or LLM_PROVIDER
+    if provider == "groq":
+        from langchain_groq import ChatGroq
+
+        return ChatGroq(model=GROQ_MODEL, temperature=temperature)
+    if provider == "fake":
+        return FakeStreamingChatModel(temperature=temperature)
+    raise ValueError(f"LLM_PROVIDER must be 'groq' or 'fake', got {provider!r}")
+
+
+async def warm_up_llm(llm: BaseChatModel):
+    """Send a one token completion so the provider connection is open before the first user.
+
+    The offline model has no connection to open and is skipped.
+    """
+    if isinstance(llm, FakeStreamingChatModel):
+        return
+    await llm.ainvoke([HumanMessage(content="ping")], max_tokens=1)
@@ -1,27 +1,52 @@
 """main fastapi file """
 import asyncio
 import json
-from contextlib import asynccontextmanager
-from typing import List
-
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+import threading
+import time
+from contextlib import aclosing, asynccontextmanager
+from typing import List, Optional
+
+from fastapi import (
+    BackgroundTasks, FastAPI, Depends, HTTPException, Query, Response, status,
+    WebSocket, WebSocketDisconnect
+)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.background import BackgroundTask
 
-from chatbot import StreamingChatbot
-from crud import UserCRUD, ConversationCRUD, MessageCRUD
-from database import get_db, engine
-from models import Base
+from auth_cache import auth_cache
+from context import summary_cutoff
+from crud import (
+    UserCRUD, ConversationCRUD, MessageCRUD,
+    AsyncUserCRUD, AsyncConversationCRUD, AsyncMessageCRUD
+)
+from database import (
+    db_pool_stats, get_db, get_async_db, get_async_session_factory, run_migrations,
+    warm_async_pool, warm_pool
+)
+from history_cache import history_cache
+from message_writer import message_writer
+from metrics import CONTENT_TYPE, registry, sse_streams_in_flight
+from models import Conversation
+from pagination import Cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, Page, decode_cursor, encode_cursor
+from response_cache import response_cache
+from scheduler import CLIENT_PRIORITIES, QueueStatus, llm_scheduler
 from schemas import (
     UserCreate, UserResponse, ConversationCreate, ConversationResponse,
-    MessageResponse, ChatRequest, ChatResponse
+    ConversationPreviewResponse, MessageResponse, ChatRequest, ChatResponse,
+    ChatBatchRequest, ChatBatchResult, ChatBatchResponse
+)
+from streaming import (
+    MAX_COALESCE_BYTES, MAX_COALESCE_MS, SSE_COALESCE, WS_COALESCE,
+    WS_MAX_GENERATIONS, WS_PROTOCOL_DELTA, WS_PROTOCOL_FULL, CoalesceSettings, GenerationTasks,
+    InFlightGeneration, chunk_texts, coalesce_chunks, generation_registry
 )
+from startup import warmup
+from tracing import ServerTimingMiddleware, current_trace, record_span, span, traced
 from websocket_manager import manager
 
-# Create tables
-Base.metadata.create_all(bind=engine)
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -29,9 +54,17 @@ async def lifespan(app: FastAPI):
     type(app)
     # Startup
     print("Starting up the chatbot application...")
+    await message_writer.start()
+    await manager.start()
+    # Migrations, pools and the LLM stack load in the background; see /ready
+    warmup.start()
     yield
     # Shutdown
     print("Shutting down the chatbot application...")
+    await warmup.close()
+    await manager.stop()
+    # Commit messages still waiting in the write-behind queue
+    await message_writer.close()
 
 
 app = FastAPI(
@@ -48,10 +81,173 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "X-Has-More", "Server-Timing"],
 )
 
-# Initialize chatbot
-chatbot = StreamingChatbot()
+# Stage timings of every HTTP request
+app.add_middleware(ServerTimingMiddleware)
+
+# Built by the startup warmup, or on first use, so importing the app stays fast
+chatbot = None
+_chatbot_lock = threading.Lock()
+
+# Read at scrape time, so they cost nothing on the hot path
+registry.gauge("websocket_connections", "WebSocket connections open on this worker",
+               function=lambda: len(manager))
+registry.gauge("llm_calls_active", "Upstream LLM calls running",
+               function=lambda: llm_scheduler.active)
+registry.gauge("llm_calls_waiting", "Upstream LLM calls waiting for a slot",
+               function=lambda: llm_scheduler.waiting)
+registry.gauge("db_pool_checked_out", "Pooled database connections lent out",
+               function=lambda: sum(
+                   stats.get("checked_out", 0) for stats in db_pool_stats().values()
+               ))
+
+
+def cache_stats(key: str):
+    """One counter of every in-process cache, labelled by cache"""
+    caches = {"history": history_cache, "response": response_cache, "auth": auth_cache}
+    return lambda: {(name,): cache.stats()[key] for name, cache in caches.items()}
+
+
+registry.gauge("cache_entries", "Entries held by each in-process cache",
+               function=lambda: {
+                   ("history",): history_cache.stats()["conversations"],
+                   ("response",): response_cache.stats()["entries"],
+                   ("auth",): auth_cache.stats()["entries"],
+               }, labelnames=("cache",))
+registry.counter("cache_hits", "Cache lookups answered from memory", ("cache",),
+                 function=cache_stats("hits"))
+registry.counter("cache_misses", "Cache lookups that went to the database or LLM", ("cache",),
+                 function=cache_stats("misses"))
+registry.counter("cache_evictions", "Entries dropped to stay within cache bounds", ("cache",),
+                 function=cache_stats("evictions"))
+registry.gauge("message_writer_queued", "Messages waiting for the next group commit",
+               function=lambda: message_writer.stats()["queued"])
+registry.counter("message_writer_batches", "Group commits of the message writer",
+                 function=lambda: message_writer.batches)
+registry.counter("message_writer_messages", "Messages committed by the message writer",
+                 function=lambda: message_writer.messages)
+registry.counter("message_writer_failures", "Messages the writer failed to commit",
+                 function=lambda: message_writer.failures)
+registry.counter("llm_scheduler_admitted", "LLM calls admitted by the scheduler",
+                 function=lambda: llm_scheduler.admitted)
+registry.counter("llm_scheduler_queued", "LLM calls that had to wait for a slot",
+                 function=lambda: llm_scheduler.queued)
+registry.counter("llm_scheduler_rate_limited", "Rate-limit responses that paused admissions",
+                 function=lambda: llm_scheduler.rate_limited)
+
+
+def get_chatbot():
+    """The shared chatbot, importing the LLM stack the first time it's needed"""
+    global chatbot
+    if chatbot is None:
+        with _chatbot_lock:
+            if chatbot is None:
+                from chatbot import StreamingChatbot
+                chatbot = StreamingChatbot()
+    return chatbot
+
+
+async def prepare_database():
+    """Upgrade the schema, then open pooled connections on both engines"""
+    await asyncio.to_thread(run_migrations)
+    await asyncio.gather(asyncio.to_thread(warm_pool), warm_async_pool())
+
+
+async def prepare_chatbot():
+    """Import the LLM stack and create the model client, pinging the provider if enabled"""
+    bot = await asyncio.to_thread(get_chatbot)
+    from llm_providers import LLM_WARMUP_PING, LLM_WARMUP_TIMEOUT
+    if not LLM_WARMUP_PING:
+        return
+    try:
+        await asyncio.wait_for(bot.warm_up(), LLM_WARMUP_TIMEOUT)
+    except Exception as e:
+        # Ready anyway; the first chat opens the connection instead
+        print(f"LLM warmup ping failed, continuing without it: {e!r}")
+
+
+warmup.add("database", prepare_database)
+warmup.add("chatbot", prepare_chatbot)
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Cursor]:
+    """Decode a pagination cursor query parameter"""
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def set_page_headers(response: Response, page: Page, sort_attribute: str):
+    """Expose the cursors around a page: pass them back as `before` / `after`"""
+    response.headers["X-Has-More"] = "true" if page.has_more else "false"
+    if page.items:
+        keys = [(getattr(item, sort_attribute), item.id) for item in page.items]
+        response.headers["X-Before-Cursor"] = encode_cursor(*min(keys))
+        response.headers["X-After-Cursor"] = encode_cursor(*max(keys))
+
+
+def coalesce_settings(
+        defaults: CoalesceSettings,
+        coalesce_ms: Optional[float] = None,
+        coalesce_bytes: Optional[int] = None
+) -> CoalesceSettings:
+    """Endpoint coalescing defaults with any per-request overrides applied"""
+    return CoalesceSettings(
+        window_ms=defaults.window_ms if coalesce_ms is None else coalesce_ms,
+        max_bytes=defaults.max_bytes if coalesce_bytes is None else coalesce_bytes
+    )
+
+
+async def track_sse(stream):
+    """Count an SSE response as in flight until it ends or the client goes away"""
+    sse_streams_in_flight.inc()
+    try:
+        async with aclosing(stream):
+            async for event in stream:
+                yield event
+    finally:
+        sse_streams_in_flight.dec()
+
+
+def queued_event(status: QueueStatus) -> dict:
+    """Event telling a client its request is waiting for an LLM slot"""
+    return {
+        "type": "queued",
+        "position": status.position,
+        "waited_ms": round(status.waited_ms)
+    }
+
+
+async def compact_conversation(db: AsyncSession, conversation: Conversation):
+    """Fold older turns into the conversation's running summary once it gets long"""
+    try:
+        messages = await AsyncMessageCRUD.get_unsummarized_messages(db, conversation)
+        if not summary_cutoff(messages):
+            return
+
+        with span("summarize"):
+            result = await get_chatbot().compact(conversation.summary, messages)
+        if result.get("summary_message_id") is not None:
+            await AsyncConversationCRUD.update_summary(
+                db, conversation, result["summary"], result["summary_message_id"]
+            )
+    except Exception as e:
+        print(f"Error summarizing conversation {conversation.id}: {e}")
+
+
+async def compact_stored_conversation(db: AsyncSession, conversation_id: int):
+    """Load a conversation, then summarize its older turns"""
+    conversation = await AsyncConversationCRUD.get_conversation(db, conversation_id)
+    if conversation is not None:
+        await compact_conversation(db, conversation)
 
 
 @app.get("/")
@@ -60,6 +256,15 @@ async def root():
     return {"message": "Streaming Chatbot API is running!"}
 
 
+@app.get("/ready")
+async def ready():
+    """Readiness: 200 once the startup warmup has finished, 503 until then"""
+    return JSONResponse(
+        warmup.stats(),
+        status_code=status.HTTP_200_OK if warmup.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+
+
 @app.post("/users/", response_model=UserResponse)
 async def create_user(user: UserCreate, db: Session = Depends(get_db)):
     """Create a new user"""
@@ -92,8 +297,7 @@ async def create_conversation(
         db: Session = Depends(get_db)
 ):
     """Create a new conversation for a user"""
-    user = UserCRUD.get_user_by_id(db, user_id)
-    if not user:
+    if not UserCRUD.user_exists(db, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
@@ -103,23 +307,58 @@ async def create_conversation(
 
 
 @app.get("/users/{user_id}/conversations/", response_model=List[ConversationResponse])
-async def get_user_conversations(user_id: int, db: Session = Depends(get_db)):
-    """Get all conversations for a user"""
-    user = UserCRUD.get_user_by_id(db, user_id)
-    if not user:
+async def get_user_conversations(
+        user_id: int,
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        db: Session = Depends(get_db)
+):
+    """Get a page of conversations for a user, most recently updated first"""
+    if not UserCRUD.user_exists(db, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
 
-    return ConversationCRUD.get_user_conversations(db, user_id)
+    page = ConversationCRUD.get_user_conversations_page(
+        db, user_id, limit, parse_cursor(before), parse_cursor(after)
+    )
+    set_page_headers(response, page, "updated_at")
+    return page.items
+
+
+@app.get(
+    "/users/{user_id}/conversations/previews/",
+    response_model=List[ConversationPreviewResponse]
+)
+async def get_user_conversation_previews(
+        user_id: int,
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        db: Session = Depends(get_db)
+):
+    """Get a page of lightweight conversation previews for a user's sidebar"""
+    if not UserCRUD.user_exists(db, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    page = ConversationCRUD.get_user_conversation_previews_page(
+        db, user_id, limit, parse_cursor(before), parse_cursor(after)
+    )
+    set_page_headers(response, page, "updated_at")
+    return page.items
 
 
 @app.get("/users/", response_model=List[UserResponse])
 async def get_user_list(user_id: int, db: Session = Depends(get_db)):
     """Get all conversations for a user"""
-    user = UserCRUD.get_user_by_id(db, user_id)
-    if not user:
+    if not UserCRUD.user_exists(db, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
@@ -129,77 +368,106 @@ async def get_user_list(user_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/conversations/{conversation_id}/messages/", response_model=List[MessageResponse])
-async def get_conversation_messages(conversation_id: int, db: Session = Depends(get_db)):
-    """Get all messages in a conversation"""
-    conversation = ConversationCRUD.get_conversation(db, conversation_id)
-    if not conversation:
+async def get_conversation_messages(
+        conversation_id: int,
+        response: Response,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        db: Session = Depends(get_db)
+):
+    """Get a page of messages in a conversation, oldest first (newest page by default)"""
+    if ConversationCRUD.get_owner(db, conversation_id) is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Conversation not found"
         )
 
-    return MessageCRUD.get_conversation_messages(db, conversation_id)
+    page = MessageCRUD.get_conversation_messages_page(
+        db, conversation_id, limit, parse_cursor(before), parse_cursor(after)
+    )
+    set_page_headers(response, page, "created_at")
+    return page.items
 
 
 @app.post("/chat/stream/{user_id}")
 async def stream_chat(
         user_id: int,
         chat_request: ChatRequest,
-        db: Session = Depends(get_db)
+        coalesce_ms: Optional[float] = Query(None, ge=0, le=MAX_COALESCE_MS),
+        coalesce_bytes: Optional[int] = Query(None, ge=1, le=MAX_COALESCE_BYTES),
+        db: AsyncSession = Depends(get_async_db)
 ):
-    """Stream chat response word by word"""
+    """Stream chat response, sending chunks coalesced into small frames"""
+    settings = coalesce_settings(SSE_COALESCE, coalesce_ms, coalesce_bytes)
 
     # Verify user exists
-    user = UserCRUD.get_user_by_id(db, user_id)
-    if not user:
+    if not await AsyncUserCRUD.user_exists(db, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
 
-    # Get or create conversation
+    # Get or create conversation; the ownership check is served from the auth cache
     if chat_request.conversation_id:
-        conversation = ConversationCRUD.get_conversation(db, chat_request.conversation_id)
-        if not conversation or conversation.user_id != user_id:
+        conversation_id = chat_request.conversation_id
+        if await AsyncConversationCRUD.get_owner(db, conversation_id) != user_id:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found"
             )
     else:
         # Create new conversation
-        conversation = ConversationCRUD.create_conversation(db, user_id, "New Chat")
+        conversation = await AsyncConversationCRUD.create_conversation(db, user_id, "New Chat")
+        conversation_id = conversation.id
 
     # Save user message
-    user_message = MessageCRUD.create_message(
-        db, conversation.id, "user", chat_request.message
-    )
+    with span("save_message"):
+        user_message = await message_writer.write(
+            conversation_id, "user", chat_request.message
+        )
 
-    # Get conversation history
-    messages = MessageCRUD.get_messages_as_dict(db, conversation.id)
+    # Get the running summary and the recent history that fits the context window
+    context = await AsyncMessageCRUD.get_turn_context(db, conversation_id)
+    if context is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
 
     async def generate_response():
-        full_response = ""
+        parts = []
 
         # Send conversation ID first
         yield f"data: " \
-              f"{json.dumps({'type': 'conversation_id', 'conversation_id': conversation.id})}" \
+              f"{json.dumps({'type': 'conversation_id', 'conversation_id': conversation_id})}" \
               f"\n\n"
 
         try:
-            async for chunk_data in chatbot.stream_response(messages):
-                chunk = chunk_data["chunk"]
-                full_response = chunk_data["full_response"]
+            stream_started = time.perf_counter()
+            chunks = chunk_texts(get_chatbot().stream_response(
+                context.messages, context.summary, user_id, chat_request.priority
+            ))
+            async for chunk in coalesce_chunks(chunks, settings):
+                if isinstance(chunk, QueueStatus):
+                    # Waiting for an LLM slot
+                    yield f"data: {json.dumps(queued_event(chunk))}\n\n"
+                    continue
+                if not parts:
+                    record_span(
+                        "llm_first_token", stream_started, time.perf_counter() - stream_started
+                    )
+                parts.append(chunk)
 
                 # Send chunk
                 yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
 
-                # Add small delay to simulate realistic streaming
-                await asyncio.sleep(0.01)
+            record_span("llm_stream", stream_started, time.perf_counter() - stream_started)
+            full_response = "".join(parts)
 
             # Save assistant response
-            MessageCRUD.create_message(
-                db, conversation.id, "assistant", full_response
-            )
+            with span("save_reply"):
+                await message_writer.write(conversation_id, "assistant", full_response)
 
             # Send completion signal
             yield f"data: {json.dumps({'type': 'complete', 'full_response': full_response})}\n\n"
@@ -208,17 +476,24 @@ async def stream_chat(
             # Send error
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
 
+        # Stage timings; the Server-Timing header only covers the time before streaming
+        trace = current_trace()
+        if trace is not None:
+            yield f"data: {json.dumps(trace.timing_event())}\n\n"
+
         # Send end signal
         yield "data: [DONE]\n\n"
 
     return StreamingResponse(
-        generate_response(),
+        track_sse(generate_response()),
         media_type="text/plain",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "Content-Type": "text/event-stream",
-        }
+        },
+        # Summarize older turns once the response is closed, outside the stream
+        background=BackgroundTask(compact_stored_conversation, db, conversation_id)
     )
 
 
@@ -226,80 +501,389 @@ async def stream_chat(
 async def chat(
         user_id: int,
         chat_request: ChatRequest,
-        db: Session = Depends(get_db)
+        background_tasks: BackgroundTasks,
+        db: AsyncSession = Depends(get_async_db)
 ):
     """Regular chat endpoint (non-streaming)"""
 
     # Verify user exists
-    user = UserCRUD.get_user_by_id(db, user_id)
-    if not user:
+    if not await AsyncUserCRUD.user_exists(db, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
 
-    # Get or create conversation
+    # Get or create conversation; the ownership check is served from the auth cache
     if chat_request.conversation_id:
-        conversation = ConversationCRUD.get_conversation(db, chat_request.conversation_id)
-        if not conversation or conversation.user_id != user_id:
+        conversation_id = chat_request.conversation_id
+        if await AsyncConversationCRUD.get_owner(db, conversation_id) != user_id:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Conversation not found"
             )
     else:
         # Create new conversation
-        conversation = ConversationCRUD.create_conversation(db, user_id, "New Chat")
+        conversation = await AsyncConversationCRUD.create_conversation(db, user_id, "New Chat")
+        conversation_id = conversation.id
 
     # Save user message
-    user_message = MessageCRUD.create_message(
-        db, conversation.id, "user", chat_request.message
+    user_message = await AsyncMessageCRUD.create_message(
+        db, conversation_id, "user", chat_request.message
     )
 
-    # Get conversation history
-    messages = MessageCRUD.get_messages_as_dict(db, conversation.id)
+    # Get the running summary and the recent history that fits the context window
+    context = await AsyncMessageCRUD.get_turn_context(db, conversation_id)
+    if context is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
 
     # Generate response
-    response = chatbot.get_response(messages)
+    with span("llm"):
+        response = await get_chatbot().aget_response(
+            context.messages, context.summary, user_id, chat_request.priority
+        )
 
     # Save assistant response
-    MessageCRUD.create_message(
-        db, conversation.id, "assistant", response
+    await AsyncMessageCRUD.create_message(
+        db, conversation_id, "assistant", response
     )
 
+    # Summarize older turns once the response has been sent
+    background_tasks.add_task(compact_stored_conversation, db, conversation_id)
+
     return ChatResponse(
-        conversation_id=conversation.id,
+        conversation_id=conversation_id,
         message=response
     )
 
 
-@app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    """WebSocket endpoint for real-time chat"""
+@app.post("/chat/batch/{user_id}", response_model=ChatBatchResponse)
+async def chat_batch(
+        user_id: int,
+        batch: ChatBatchRequest,
+        background_tasks: BackgroundTasks,
+        db: AsyncSession = Depends(get_async_db)
+):
+    """Answer many chats at once for offline and bulk workloads.
 
-    # Get database session
-    db = next(get_db())
+    Histories are loaded in one query and the model calls run at bulk priority,
+    a few at a time. Each chat gets its own result, with an error if it failed.
+    """
+    if not await AsyncUserCRUD.user_exists(db, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+
+    requested = [
+        chat_request.conversation_id for chat_request in batch.requests
+        if chat_request.conversation_id
+    ]
+    if len(requested) != len(set(requested)):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A conversation can only appear once per batch"
+        )
 
+    # Load the requested conversations and create the new ones, one query each
+    owned = {}
+    if requested:
+        for conversation in await AsyncConversationCRUD.get_conversations(db, requested):
+            if conversation.user_id == user_id:
+                owned[conversation.id] = conversation
+    new_conversations = iter([])
+    if len(requested) < len(batch.requests):
+        new_conversations = iter(await AsyncConversationCRUD.create_conversations(
+            db, user_id, len(batch.requests) - len(requested), "New Chat"
+        ))
+
+    results = [ChatBatchResult() for _ in batch.requests]
+    turns = []
+    for result, chat_request in zip(results, batch.requests):
+        if chat_request.conversation_id:
+            conversation = owned.get(chat_request.conversation_id)
+            if conversation is None:
+                result.error = "Conversation not found"
+                continue
+        else:
+            conversation = next(new_conversations)
+        result.conversation_id = conversation.id
+        turns.append((result, chat_request, conversation))
+
+    # The writer commits the user messages together
+    await asyncio.gather(*(
+        message_writer.write(conversation.id, "user", chat_request.message)
+        for _, chat_request, conversation in turns
+    ))
+
+    contexts = await AsyncMessageCRUD.get_cached_contexts(
+        db, [conversation for _, _, conversation in turns]
+    )
+    with span("llm"):
+        replies = await get_chatbot().batch_responses(
+            [(contexts[conversation.id], conversation.summary) for _, _, conversation in turns],
+            user_id
+        )
+
+    answered = []
+    for (result, _, conversation), reply in zip(turns, replies):
+        if isinstance(reply, Exception):
+            result.error = str(reply)
+        else:
+            result.message = reply
+            answered.append((conversation, reply))
+
+    # Save assistant responses
+    await asyncio.gather(*(
+        message_writer.write(conversation.id, "assistant", reply)
+        for conversation, reply in answered
+    ))
+
+    # Summarize older turns once the responses have been sent
+    for conversation, _ in answered:
+        background_tasks.add_task(compact_conversation, db, conversation)
+
+    return ChatBatchResponse(results=results)
+
+
+async def load_ws_turn(session_factory, conversation_id: int, user_id: int, user_message: str):
+    """Save the user's message and load the conversation's summary and context window.
+
+    Returns None when the conversation is gone or belongs to someone else.
+    """
+    async with session_factory() as db:
+        if await AsyncConversationCRUD.get_owner(db, conversation_id) != user_id:
+            return None
+        with span("save_message"):
+            await message_writer.write(conversation_id, "user", user_message)
+        return await AsyncMessageCRUD.get_turn_context(db, conversation_id)
+
+
+async def compact_ws_conversation(session_factory, conversation_id: int):
+    """Summarize older turns in a session of its own"""
+    async with session_factory() as db:
+        await compact_stored_conversation(db, conversation_id)
+
+
+@traced("WS message")
+async def generate_ws_response(
+        generation: InFlightGeneration,
+        generations: GenerationTasks,
+        session_factory,
+        user_message: str,
+        settings: CoalesceSettings,
+        priority: str = "interactive"
+):
+    """Save a user message and stream the assistant's reply to every subscribed tab.
+
+    Frames go through broadcast_to_user, so all of the user's connections
+    subscribed to the conversation share one LLM call. Only the LLM stream is
+    cancellable; database work is shielded so a cancel never leaves a session
+    half closed. Stage timings follow message_complete in a timing frame.
+    """
+    user_id = generation.user_id
+    conversation_id = generation.conversation_id
+    context = await generations.shield(
+        load_ws_turn(session_factory, conversation_id, user_id, user_message)
+    )
+    if context is None:
+        # Deleted or moved since the ownership check that admitted the message
+        await manager.broadcast_to_user({
+            "type": "error",
+            "conversation_id": conversation_id,
+            "message": "Conversation not found or access denied"
+        }, user_id)
+        return
+
+    # Send user message confirmation
+    await manager.broadcast_to_user({
+        "type": "user_message",
+        "conversation_id": conversation_id,
+        "message": user_message
+    }, user_id)
+
+    # Send typing indicator
+    await manager.broadcast_to_user({
+        "type": "typing",
+        "conversation_id": conversation_id
+    }, user_id)
+
+    # Generate and stream response; protocol 1 connections turn deltas into chunks
+    parts = generation.parts
     try:
-        # Verify user exists
-        user = UserCRUD.get_user_by_id(db, user_id)
-        if not user:
-            await websocket.close(code=4004, reason="User not found")
-            return
+        stream_started = time.perf_counter()
+        chunks = chunk_texts(get_chatbot().stream_response(
+            context.messages, context.summary, user_id, priority
+        ))
+        async for chunk in coalesce_chunks(chunks, settings):
+            if isinstance(chunk, QueueStatus):
+                await manager.broadcast_to_user({
+                    **queued_event(chunk), "conversation_id": conversation_id
+                }, user_id)
+                continue
+            if not parts:
+                record_span(
+                    "llm_first_token", stream_started, time.perf_counter() - stream_started
+                )
+            parts.append(chunk)
+            await manager.broadcast_to_user({
+                "type": "delta",
+                "conversation_id": conversation_id,
+                "seq": len(parts) - 1,
+                "content": chunk
+            }, user_id)
+
+        record_span("llm_stream", stream_started, time.perf_counter() - stream_started)
+        full_response = "".join(parts)
+
+        # Save assistant response
+        with span("save_reply"):
+            await generations.shield(
+                message_writer.write(conversation_id, "assistant", full_response)
+            )
+
+        # The reply is done; a follow-up may start while older turns are summarized
+        generation_registry.end(generation)
+
+        # Send completion message
+        await manager.broadcast_to_user({
+            "type": "message_complete",
+            "conversation_id": conversation_id,
+            "full_response": full_response,
+            "chunks": len(parts)
+        }, user_id)
+        await manager.broadcast_to_user({
+            **current_trace().timing_event(), "conversation_id": conversation_id
+        }, user_id)
+
+    except asyncio.CancelledError:
+        # The upstream stream is already closed; keep the partial reply in the history
+        full_response = "".join(parts)
+        if full_response:
+            # Shielded so a second cancel, e.g. at shutdown, can't drop the partial reply
+            await generations.shield(
+                message_writer.write(conversation_id, "assistant", full_response)
+            )
+        await manager.broadcast_to_user({
+            "type": "generation_cancelled",
+            "conversation_id": conversation_id,
+            "full_response": full_response
+        }, user_id)
+        raise
+
+    except Exception as e:
+        await manager.broadcast_to_user({
+            "type": "error",
+            "conversation_id": conversation_id,
+            "message": f"Error generating response: {str(e)}"
+        }, user_id)
+        return
+
+    # Summarize older turns once the reply has been sent
+    await generations.shield(compact_ws_conversation(session_factory, conversation_id))
+
+
+async def join_generation(websocket: WebSocket, user_id: int, conversation_id: int):
+    """Subscribe a websocket to a conversation, catching up on a reply in progress"""
+    manager.subscribe(websocket, conversation_id)
+    generation = generation_registry.get(user_id, conversation_id)
+    if generation is not None:
+        await manager.send_message({
+            "type": "generation_in_progress",
+            "conversation_id": conversation_id,
+            "seq": len(generation.parts),
+            "content": generation.text
+        }, websocket)
+    return generation
+
+
+@app.websocket("/ws/{user_id}")
+async def websocket_endpoint(
+        websocket: WebSocket,
+        user_id: int,
+        protocol: int = Query(WS_PROTOCOL_FULL, ge=WS_PROTOCOL_FULL, le=WS_PROTOCOL_DELTA),
+        coalesce_ms: Optional[float] = Query(None, ge=0, le=MAX_COALESCE_MS),
+        coalesce_bytes: Optional[int] = Query(None, ge=1, le=MAX_COALESCE_BYTES),
+        session_factory=Depends(get_async_session_factory)
+):
+    """WebSocket endpoint for real-time chat (`protocol=2` streams deltas only).
+
+    Each reply is generated in its own task, so a connection can stream several
+    conversations at once and cancel any of them with
+    {"type": "cancel", "conversation_id": id}. Replies are sent to every tab of
+    the user subscribed to the conversation with
+    {"type": "subscribe", "conversation_id": id}. Database sessions last for one
+    unit of work, so idle sockets don't hold pooled connections.
+    """
+    settings = coalesce_settings(WS_COALESCE, coalesce_ms, coalesce_bytes)
+    generations = GenerationTasks(WS_MAX_GENERATIONS)
+
+    try:
+        async with session_factory() as db:
+            # Verify user exists
+            if not await AsyncUserCRUD.user_exists(db, user_id):
+                await websocket.close(code=4004, reason="User not found")
+                return
+
+            # Preload recent conversations so the first turn hits the history cache
+            await AsyncMessageCRUD.warm_user_history(db, user_id)
 
         # Connect to WebSocket
-        await manager.connect(websocket, user_id)
+        await manager.connect(websocket, user_id, protocol)
 
         # Send welcome message
         await manager.send_message({
             "type": "connection",
             "message": "Connected to chat server",
-            "user_id": user_id
+            "user_id": user_id,
+            "protocol": protocol
         }, websocket)
 
         while True:
             # Receive message from client
             data = await websocket.receive_text()
             message_data = json.loads(data)
+            message_type = message_data.get("type")
+
+            # Stop one generation, or all of this connection's when no conversation is given
+            if message_type == "cancel":
+                conversation_id = message_data.get("conversation_id")
+                if conversation_id is None:
+                    generations.cancel_all()
+                    continue
+                generation = generation_registry.get(user_id, conversation_id)
+                if generation is None or not generation.cancel():
+                    await manager.send_message({
+                        "type": "error",
+                        "conversation_id": conversation_id,
+                        "message": "No response is being generated for this conversation"
+                    }, websocket)
+                continue
+
+            # Follow a conversation's replies, including ones started from other tabs
+            if message_type in ("subscribe", "unsubscribe"):
+                conversation_id = message_data.get("conversation_id")
+                if message_type == "unsubscribe":
+                    manager.unsubscribe(websocket, conversation_id)
+                    continue
+
+                async with session_factory() as db:
+                    owner = await AsyncConversationCRUD.get_owner(db, conversation_id)
+                if owner != user_id:
+                    await manager.send_message({
+                        "type": "error",
+                        "message": "Conversation not found or access denied"
+                    }, websocket)
+                    continue
+
+                await manager.send_message({
+                    "type": "subscribed",
+                    "conversation_id": conversation_id
+                }, websocket)
+                await join_generation(websocket, user_id, conversation_id)
+                continue
 
             # Validate message format
             if "message" not in message_data:
@@ -312,11 +896,38 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
 
             user_message = message_data["message"]
             conversation_id = message_data.get("conversation_id")
-            # print("Conversation_id:",conversation_id)
+            priority = message_data.get("priority", "interactive")
+            if priority not in CLIENT_PRIORITIES:
+                await manager.send_message({
+                    "type": "error",
+                    "conversation_id": conversation_id,
+                    "message": f"priority must be one of {list(CLIENT_PRIORITIES)}"
+                }, websocket)
+                continue
+
+            # Another tab is already generating this reply: stream it here instead
+            if conversation_id and generation_registry.get(user_id, conversation_id):
+                await manager.send_message({
+                    "type": "error",
+                    "conversation_id": conversation_id,
+                    "message": "A response is already being generated for this conversation"
+                }, websocket)
+                await join_generation(websocket, user_id, conversation_id)
+                continue
+
+            if generations.full():
+                await manager.send_message({
+                    "type": "error",
+                    "conversation_id": conversation_id,
+                    "message": f"Too many responses in progress (limit {generations.limit})"
+                }, websocket)
+                continue
+
             # Get or create conversation
             if conversation_id:
-                conversation = ConversationCRUD.get_conversation(db, conversation_id)
-                if not conversation or conversation.user_id != user_id:
+                async with session_factory() as db:
+                    owner = await AsyncConversationCRUD.get_owner(db, conversation_id)
+                if owner != user_id:
                     await manager.send_message({
                         "type": "error",
                         "message": "Conversation not found or access denied"
@@ -324,64 +935,30 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
                     continue
             else:
                 # Create new conversation
-                conversation = ConversationCRUD.create_conversation(db, user_id, user_message[:15])
+                async with session_factory() as db:
+                    conversation = await AsyncConversationCRUD.create_conversation(
+                        db, user_id, user_message[:15]
+                    )
+                conversation_id = conversation.id
                 await manager.send_message({
                     "type": "conversation_created",
-                    "conversation_id": conversation.id
+                    "conversation_id": conversation_id
                 }, websocket)
 
-            # Save user message
-            MessageCRUD.create_message(db, conversation.id, "user", user_message)
-
-            # Send user message confirmation
-            await manager.send_message({
-                "type": "user_message",
-                "conversation_id": conversation.id,
-                "message": user_message
-            }, websocket)
-
-            # Get conversation history
-            messages = MessageCRUD.get_messages_as_dict(db, conversation.id)
-
-            # Send typing indicator
-            await manager.send_message({
-                "type": "typing",
-                "conversation_id": conversation.id
-            }, websocket)
-
-            # Generate and stream response
-            full_response = ""
-            try:
-                async for chunk_data in chatbot.stream_response(messages):
-                    chunk = chunk_data["chunk"]
-                    full_response = chunk_data["full_response"]
-
-                    # Send chunk to client
-                    await manager.send_message({
-                        "type": "chunk",
-                        "conversation_id": conversation.id,
-                        "content": chunk,
-                        "full_response": full_response
-                    }, websocket)
-
-                    # Small delay for realistic streaming
-                    await asyncio.sleep(0.01)
-
-                # Save assistant response
-                MessageCRUD.create_message(db, conversation.id, "assistant", full_response)
-
-                # Send completion message
-                await manager.send_message({
-                    "type": "message_complete",
-                    "conversation_id": conversation.id,
-                    "full_response": full_response
-                }, websocket)
+            # A tab may have started this reply while the conversation was loading
+            if generation_registry.get(user_id, conversation_id):
+                await join_generation(websocket, user_id, conversation_id)
+                continue
 
-            except Exception as e:
-                await manager.send_message({
-                    "type": "error",
-                    "message": f"Error generating response: {str(e)}"
-                }, websocket)
+            # Stream the reply in the background so the socket stays responsive
+            manager.subscribe(websocket, conversation_id)
+            generation = generation_registry.begin(user_id, conversation_id, generations)
+            generation.task = generations.start(conversation_id, generate_ws_response(
+                generation, generations, session_factory, user_message, settings, priority
+            ))
+            generation.task.add_done_callback(
+                lambda _, finished=generation: generation_registry.end(finished)
+            )
 
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
@@ -391,15 +968,40 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
             "type": "error",
             "message": f"Server error: {str(e)}"
         }, websocket)
+        await manager.flush(websocket)
+        manager.disconnect(websocket, user_id)
     finally:
-        db.close()
+        # Replies other tabs are watching keep going; the rest free provider capacity
+        for generation in generation_registry.owned_by(generations):
+            if manager.subscriber_count(user_id, generation.conversation_id):
+                generations.release(generation.conversation_id)
+                generation.owner = None
+        await generations.close()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics for LLM streams, database calls and open connections"""
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/db/stats")
+async def get_database_stats():
+    """Get connection pool usage of the sync and async engines"""
+    return db_pool_stats()
+
+
+@app.get("/ws/stats")
+async def get_websocket_stats():
+    """Get outbound queue depth, send latency and slow consumer counters"""
+    return manager.stats()
 
 
 @app.get("/ws/users/{user_id}/status")
 async def get_websocket_status(user_id: int):
     """Get WebSocket connection status for a user"""
     print("Hello")
-    connections = len(manager.active_connections.get(user_id, []))
+    connections = manager.connection_count(user_id)
     return {
         "user_id": user_id,
         "active_connections": connections,
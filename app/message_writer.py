@@ -0,0 +1,163 @@
+""" group-commit writer for chat messages"""
+import asyncio
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from crud import message_counters, new_message
+from database import AsyncSessionLocal
+from history_cache import history_cache
+from models import Message
+
+load_dotenv()
+
+MESSAGE_WRITER_FLUSH_MS = float(os.getenv("MESSAGE_WRITER_FLUSH_MS", "10"))
+MESSAGE_WRITER_MAX_BATCH = int(os.getenv("MESSAGE_WRITER_MAX_BATCH", "256"))
+
+# Pending write: the message to insert and the future acknowledging its commit
+_PendingWrite = Tuple[Message, asyncio.Future]
+
+
+class MessageWriter:
+    """Write-behind stage that batches message inserts into one transaction per flush.
+
+    `write` resolves only after the transaction holding the message has committed,
+    so callers get the same durability as MessageCRUD.create_message while many
+    concurrent streams share each commit.
+    """
+    def __init__(
+            self,
+            session_factory=AsyncSessionLocal,
+            flush_interval: float = MESSAGE_WRITER_FLUSH_MS / 1000,
+            max_batch: int = MESSAGE_WRITER_MAX_BATCH
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closed = False
+        self.batches = 0
+        self.messages = 0
+        self.failures = 0
+
+    def _ensure_running(self):
+        """Start the flush task on the current event loop"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def start(self):
+        """Accept writes and start the flush task on the running event loop"""
+        self._closed = False
+        self._ensure_running()
+
+    async def write(self, conversation_id: int, role: str, content: str) -> Message:
+        """Queue a message and wait until it has been committed"""
+        if self._closed:
+            raise RuntimeError("Message writer is closed")
+
+        self._ensure_running()
+        future = self._loop.create_future()
+        self._queue.put_nowait((new_message(conversation_id, role, content), future))
+        return await future
+
+    async def _run(self):
+        """Collect writes for one flush interval, then commit them together"""
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                return
+            batch = [item]
+
+            deadline = self._loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[_PendingWrite]):
+        """Commit a batch, falling back to one transaction per message on failure"""
+        try:
+            await self._commit([message for message, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                self.failures += 1
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # Retry individually so one bad message doesn't fail the others
+            for message, future in batch:
+                retry = Message(
+                    conversation_id=message.conversation_id,
+                    role=message.role,
+                    content=message.content,
+                    token_count=message.token_count,
+                    created_at=message.created_at
+                )
+                await self._flush([(retry, future)])
+            return
+
+        self.batches += 1
+        self.messages += len(batch)
+        for message, future in batch:
+            history_cache.append(
+                message.conversation_id, message.role, message.content, message.token_count
+            )
+            if not future.done():
+                future.set_result(message)
+
+    async def _commit(self, messages: List[Message]):
+        """Insert messages and update their conversations' counters in one transaction"""
+        by_conversation: Dict[int, List[Message]] = defaultdict(list)
+        for message in messages:
+            by_conversation[message.conversation_id].append(message)
+
+        async with self.session_factory() as db:
+            db.add_all(messages)
+            for conversation_id, conversation_messages in by_conversation.items():
+                await db.execute(message_counters(conversation_id, conversation_messages))
+            await db.commit()
+
+    async def close(self):
+        """Flush every queued message and stop the writer"""
+        self._closed = True
+        if self._task is None or self._task.done():
+            return
+
+        # The writer drains everything queued ahead of the stop marker
+        if self._loop is asyncio.get_running_loop():
+            self._queue.put_nowait(None)
+            await self._task
+        self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        """Writer counters"""
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "messages": self.messages,
+            "failures": self.failures,
+        }
+
+
+# Global message writer instance
+message_writer = MessageWriter()
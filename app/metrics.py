@@ -0,0 +1,322 @@
+""" Prometheus metrics for the chat hot paths"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from tracing import record_span
+
+# Latency buckets in seconds, from a cached DB read to a long LLM reply
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+# A value read at scrape time: a number, or {label values: number} for labelled metrics
+Callback = Callable[[], Union[float, Dict[Tuple[str, ...], float]]]
+
+
+def _callback_samples(name: str, labelnames: Sequence[str], function: Callback) -> List[str]:
+    values = function()
+    if not labelnames:
+        return [f"{name} {_format_value(values)}"]
+    return [
+        f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}"
+        for labels, value in sorted(values.items())
+    ]
+
+
+class Metric(ABC):
+    """A named metric with optional labels, rendered in Prometheus text format"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Observations come from the event loop and from threadpool workers
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self._samples(),
+        ]
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """Sample lines below the HELP and TYPE header"""
+
+
+class Counter(Metric):
+    """Monotonically increasing count, or one kept elsewhere and read at scrape time"""
+    kind = "counter"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            function: Optional[Callback] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> List[str]:
+        if self.function is not None:
+            return _callback_samples(f"{self.name}_total", self.labelnames, self.function)
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            function: Optional[Callback] = None,
+            labelnames: Sequence[str] = ()
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def value(self) -> float:
+        return self.function() if self.function is not None else self._value
+
+    def _samples(self) -> List[str]:
+        if self.function is not None:
+            return _callback_samples(self.name, self.labelnames, self.function)
+        return [f"{self.name} {_format_value(self._value)}"]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in fixed buckets"""
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # {labels: [per-bucket counts..., overflow count, sum]}
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self._values.get(labels)
+        return int(sum(counts[:-1])) if counts else 0
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for labels, counts in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                samples.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            samples.append(f"{self.name}_sum{label_text} {_format_value(counts[-1])}")
+            samples.append(f"{self.name}_count{label_text} {cumulative}")
+        return samples
+
+
+class MetricsRegistry:
+    """Metrics exposed on /metrics"""
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            function: Optional[Callback] = None
+    ) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(
+            self,
+            name: str,
+            documentation: str,
+            function: Optional[Callback] = None,
+            labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, function, labelnames))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Global metrics registry instance
+registry = MetricsRegistry()
+
+llm_time_to_first_token = registry.histogram(
+    "llm_time_to_first_token_seconds", "Time from opening an LLM stream to its first token"
+)
+llm_tokens_per_second = registry.histogram(
+    "llm_tokens_per_second", "Streamed chunks per second after the first token",
+    buckets=RATE_BUCKETS
+)
+llm_generation_time = registry.histogram(
+    "llm_generation_seconds", "Total time of an upstream LLM stream"
+)
+db_query_time = registry.histogram(
+    "db_crud_seconds", "Latency of CRUD methods", labelnames=("method",)
+)
+db_commits = registry.counter("db_commits", "Database transactions committed", ("engine",))
+db_pool_wait = registry.histogram(
+    "db_pool_checkout_wait_seconds", "Time spent checking out a pooled connection",
+    labelnames=("engine",)
+)
+sse_streams_in_flight = registry.gauge("sse_streams_in_flight", "SSE responses being streamed")
+
+
+def observe_stream(started: float, first_token: Optional[float], tokens: int):
+    """Record TTFT, token rate and duration of a finished LLM stream"""
+    finished = time.perf_counter()
+    llm_generation_time.observe(finished - started)
+    if first_token is None:
+        return
+    llm_time_to_first_token.observe(first_token - started)
+    if tokens > 1 and finished > first_token:
+        llm_tokens_per_second.observe((tokens - 1) / (finished - first_token))
+
+
+def timed_crud(cls):
+    """Class decorator recording the latency of every CRUD method in db_crud_seconds.
+
+    Each call is also a span of the current trace, named after the method.
+    """
+    for attr, member in list(vars(cls).items()):
+        function = member.__func__ if isinstance(member, staticmethod) else member
+        if attr.startswith("_") or not callable(function):
+            continue
+        setattr(cls, attr, staticmethod(_timed(function, f"{cls.__name__}.{attr}")))
+    return cls
+
+
+def _timed(function, label: str):
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def timed_async(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                db_query_time.observe(elapsed, label)
+                record_span(label, started, elapsed)
+        return timed_async
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_query_time.observe(elapsed, label)
+            record_span(label, started, elapsed)
+    return timed
+
+
+def instrument_engine(engine, label: str):
+    """Count commits and time connection checkouts of a (sync) SQLAlchemy engine.
+
+    Checkouts are timed around Engine.connect, which sessions and the async engine
+    both go through, so the timing survives dispose() replacing the pool. It covers
+    pre-ping and opening new connections as well as waiting for a free one.
+    """
+    from sqlalchemy import event
+
+    event.listen(engine, "commit", lambda conn: db_commits.inc(label))
+
+    connect = engine.connect
+
+    @functools.wraps(connect)
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, label)
+
+    engine.connect = timed_connect
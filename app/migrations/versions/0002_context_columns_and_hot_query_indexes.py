@@ -0,0 +1,52 @@
+"""context columns and hot query indexes
+
+Adds the stored per-message token counts and the running conversation summary,
+plus composite indexes for listing a conversation's messages and a user's
+conversations.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16 09:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "messages",
+        sa.Column("token_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("conversations", sa.Column("summary", sa.Text(), nullable=True))
+    op.add_column("conversations", sa.Column("summary_message_id", sa.Integer(), nullable=True))
+
+    op.create_index(
+        "ix_messages_conversation_id_created_at",
+        "messages",
+        ["conversation_id", "created_at"],
+    )
+    op.create_index(
+        "ix_conversations_user_id_updated_at",
+        "conversations",
+        ["user_id", sa.text("updated_at DESC")],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_conversations_user_id_updated_at", table_name="conversations")
+    op.drop_index("ix_messages_conversation_id_created_at", table_name="messages")
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.drop_column("summary_message_id")
+        batch_op.drop_column("summary")
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.drop_column("token_count")
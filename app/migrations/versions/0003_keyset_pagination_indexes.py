@@ -0,0 +1,53 @@
+"""keyset pagination indexes
+
+Extends the hot query indexes with the id tie-breaker so keyset pagination on
+(created_at, id) and (updated_at, id) is served straight from the index.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-16 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_messages_conversation_id_created_at_id",
+        "messages",
+        ["conversation_id", "created_at", "id"],
+    )
+    op.drop_index("ix_messages_conversation_id_created_at", table_name="messages")
+
+    op.create_index(
+        "ix_conversations_user_id_updated_at_id",
+        "conversations",
+        ["user_id", sa.text("updated_at DESC"), sa.text("id DESC")],
+    )
+    op.drop_index("ix_conversations_user_id_updated_at", table_name="conversations")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_conversations_user_id_updated_at",
+        "conversations",
+        ["user_id", sa.text("updated_at DESC")],
+    )
+    op.drop_index("ix_conversations_user_id_updated_at_id", table_name="conversations")
+
+    op.create_index(
+        "ix_messages_conversation_id_created_at",
+        "messages",
+        ["conversation_id", "created_at"],
+    )
+    op.drop_index("ix_messages_conversation_id_created_at_id", table_name="messages")
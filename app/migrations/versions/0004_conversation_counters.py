@@ -0,0 +1,82 @@
+"""conversation counters
+
+Denormalized message count, token total and last message preview on
+conversations, maintained on the message write path. Existing conversations
+are backfilled from their messages.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# context.CHARS_PER_TOKEN when this revision was written
+CHARS_PER_TOKEN = 4
+
+
+def upgrade() -> None:
+    op.add_column(
+        "conversations",
+        sa.Column("message_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("total_tokens", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column("conversations", sa.Column("last_message_at", sa.DateTime(), nullable=True))
+    op.add_column(
+        "conversations", sa.Column("last_message_preview", sa.String(length=200), nullable=True)
+    )
+
+    # Rows written before token counts were stored have token_count 0; estimate
+    # them from their length the way count_tokens does for new messages
+    op.execute(sa.text(
+        """
+        UPDATE conversations SET
+            message_count = (
+                SELECT count(*) FROM messages WHERE messages.conversation_id = conversations.id
+            ),
+            total_tokens = (
+                SELECT coalesce(sum(
+                    CASE WHEN token_count > 0 THEN token_count
+                    ELSE (length(content) + :chars_per_token - 1) / :chars_per_token END
+                ), 0) FROM messages
+                WHERE messages.conversation_id = conversations.id
+            ),
+            last_message_at = (
+                SELECT max(created_at) FROM messages
+                WHERE messages.conversation_id = conversations.id
+            ),
+            last_message_preview = (
+                SELECT substr(content, 1, 120) FROM messages
+                WHERE messages.conversation_id = conversations.id
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            )
+        """
+    ).bindparams(chars_per_token=CHARS_PER_TOKEN))
+    op.execute(
+        """
+        UPDATE conversations SET updated_at = last_message_at
+        WHERE last_message_at IS NOT NULL
+          AND (updated_at IS NULL OR updated_at < last_message_at)
+        """
+    )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.drop_column("last_message_preview")
+        batch_op.drop_column("last_message_at")
+        batch_op.drop_column("total_tokens")
+        batch_op.drop_column("message_count")
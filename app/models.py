@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -24,6 +24,14 @@ class Conversation(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     title = Column(String(200), nullable=True)
+    # Running summary of older turns and the last message folded into it
+    summary = Column(Text, nullable=True)
+    summary_message_id = Column(Integer, nullable=True)
+    # Maintained by MessageCRUD on every message write for cheap listings
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    total_tokens = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime, nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -39,7 +47,25 @@ class Message(Base):
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationship
-    conversation = relationship("Conversation", back_populates="messages")
\ No newline at end of file
+    conversation = relationship("Conversation", back_populates="messages")
+
+
+# Messages of a conversation in order: MessageCRUD.get_conversation_messages(_page)
+Index(
+    "ix_messages_conversation_id_created_at_id",
+    Message.conversation_id,
+    Message.created_at,
+    Message.id
+)
+
+# A user's conversations, most recent first: ConversationCRUD.get_user_conversations(_page)
+Index(
+    "ix_conversations_user_id_updated_at_id",
+    Conversation.user_id,
+    Conversation.updated_at.desc(),
+    Conversation.id.desc()
+)
@@ -0,0 +1,68 @@
+""" keyset (cursor) pagination helpers"""
+import base64
+import json
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import asc, desc, tuple_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Position of a row in a listing: (sort timestamp, id)
+Cursor = Tuple[datetime, int]
+
+
+class Page(NamedTuple):
+    """one page of a listing"""
+    items: List
+    has_more: bool
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    """Opaque cursor for the position of a row"""
+    raw = json.dumps([sort_value.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Parse a cursor from encode_cursor, raising ValueError when it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_query(
+        stmt,
+        sort_column,
+        id_column,
+        limit: int,
+        before: Optional[Cursor] = None,
+        after: Optional[Cursor] = None
+):
+    """Restrict a select to one page around the cursors without OFFSET.
+
+    `before` selects rows older than the cursor and `after` newer ones. Returns the
+    statement and whether rows come back newest first.
+    """
+    key = tuple_(sort_column, id_column)
+    if before is not None:
+        stmt = stmt.filter(key < tuple_(*before))
+    if after is not None:
+        stmt = stmt.filter(key > tuple_(*after))
+
+    # Walk away from the cursor the client is paging from
+    newest_first = after is None or before is not None
+    order = desc if newest_first else asc
+    return stmt.order_by(order(sort_column), order(id_column)).limit(limit + 1), newest_first
+
+
+def keyset_page(rows: List, limit: int, newest_first: bool, descending: bool) -> Page:
+    """Trim the extra lookahead row and put the page in listing order"""
+    items = list(rows[:limit])
+    if newest_first != descending:
+        items.reverse()
+    return Page(items=items, has_more=len(rows) > limit)
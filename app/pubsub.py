@@ -0,0 +1,267 @@
+""" cross-worker message routing and presence for WebSocket connections"""
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# memory: a single worker; unix: several workers on one host
+WS_BACKEND = os.getenv("WS_BACKEND", "memory")
+WS_BACKEND_DIR = os.getenv("WS_BACKEND_DIR", os.path.join(tempfile.gettempdir(), "chatbot-ws"))
+WS_PRESENCE_INTERVAL = float(os.getenv("WS_PRESENCE_INTERVAL", "5"))
+
+# Peers that miss this many heartbeats no longer count towards presence
+PRESENCE_MISSED_HEARTBEATS = 3
+MAX_DATAGRAM_BYTES = 256 * 1024
+# Users per presence datagram; a heartbeat is split into as many as it needs
+PRESENCE_USERS_PER_DATAGRAM = 2000
+
+# Called with (user_id, message) for messages published by other workers
+Deliver = Callable[[int, dict], None]
+
+
+class WebSocketBackend(ABC):
+    """Routes user messages and tracks connection counts across worker processes.
+
+    The ConnectionManager always delivers to its own sockets; the backend only
+    carries messages and presence to and from other workers.
+    """
+    async def start(self, deliver: Deliver):
+        """Start receiving messages published by other workers"""
+
+    async def stop(self):
+        """Stop receiving and tell other workers this one is gone"""
+
+    @abstractmethod
+    def publish(self, user_id: int, message: dict):
+        """Send a message to the user's connections on other workers"""
+
+    @abstractmethod
+    def set_presence(self, user_id: int, count: int):
+        """Record how many connections the user has on this worker"""
+
+    @abstractmethod
+    def connection_count(self, user_id: int) -> int:
+        """Connections the user has across all workers"""
+
+
+def decode_payload(data: bytes) -> Optional[dict]:
+    """Parse a datagram from another worker, or None if it isn't a valid one"""
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict) or not isinstance(payload.get("origin"), str):
+        return None
+
+    kind = payload.get("kind")
+    if kind == "message":
+        valid = isinstance(payload.get("user_id"), int) and isinstance(payload.get("message"), dict)
+    elif kind == "presence":
+        users = payload.get("users")
+        valid = isinstance(users, dict) and all(
+            user_id.isdigit() and isinstance(count, int) for user_id, count in users.items()
+        )
+    else:
+        valid = kind == "leave"
+    return payload if valid else None
+
+
+class InMemoryBackend(WebSocketBackend):
+    """Backend for a single worker process"""
+    def __init__(self):
+        self._presence: Dict[int, int] = {}
+
+    def publish(self, user_id: int, message: dict):
+        # No other workers to reach
+        pass
+
+    def set_presence(self, user_id: int, count: int):
+        if count:
+            self._presence[user_id] = count
+        else:
+            self._presence.pop(user_id, None)
+
+    def connection_count(self, user_id: int) -> int:
+        return self._presence.get(user_id, 0)
+
+
+class UnixSocketBackend(WebSocketBackend):
+    """Backend for several workers on one host, over Unix datagram sockets.
+
+    Each worker binds `<node_id>.sock` in a shared directory and sends messages
+    and presence updates to every other socket there. A full presence snapshot
+    is sent every `presence_interval` seconds as a heartbeat, so workers that
+    die without saying goodbye drop out after a few missed beats.
+    """
+    def __init__(
+            self,
+            directory: str = WS_BACKEND_DIR,
+            presence_interval: float = WS_PRESENCE_INTERVAL,
+            node_id: Optional[str] = None
+    ):
+        self.directory = directory
+        self.presence_interval = presence_interval
+        self.node_id = node_id or str(os.getpid())
+        self.path = os.path.join(directory, f"{self.node_id}.sock")
+        self._sock: Optional[socket.socket] = None
+        self._deliver: Optional[Deliver] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._local: Dict[int, int] = {}
+        # {node_id: (last heartbeat, {user_id: connections})}
+        self._peers: Dict[str, Tuple[float, Dict[int, int]]] = {}
+        self.published = 0
+        self.received = 0
+        self.send_errors = 0
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(self.path)
+        self._sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._receive)
+        self._heartbeat = asyncio.create_task(self._send_heartbeats())
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        self._broadcast({"kind": "leave", "origin": self.node_id})
+
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def publish(self, user_id: int, message: dict):
+        self.published += 1
+        self._broadcast({
+            "kind": "message", "origin": self.node_id, "user_id": user_id, "message": message
+        })
+
+    def set_presence(self, user_id: int, count: int):
+        if count:
+            self._local[user_id] = count
+        else:
+            self._local.pop(user_id, None)
+        self._broadcast({
+            "kind": "presence", "origin": self.node_id, "users": {str(user_id): count}
+        })
+
+    def connection_count(self, user_id: int) -> int:
+        expired = time.monotonic() - self.presence_interval * PRESENCE_MISSED_HEARTBEATS
+        total = self._local.get(user_id, 0)
+        for node_id, (seen, users) in list(self._peers.items()):
+            if seen < expired:
+                del self._peers[node_id]
+                continue
+            total += users.get(user_id, 0)
+        return total
+
+    def _peer_paths(self) -> List[str]:
+        """Sockets of the other workers sharing the directory"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name) for name in names
+            if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+        ]
+
+    def _broadcast(self, payload: dict):
+        """Send a payload to every other worker without blocking"""
+        if self._sock is None:
+            return
+
+        data = json.dumps(payload).encode()
+        for path in self._peer_paths():
+            try:
+                self._sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The worker exited without removing its socket
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except OSError as e:
+                # Full receive buffer or an oversized message
+                self.send_errors += 1
+                print(f"Error publishing to {path}: {e}")
+
+    def _receive(self):
+        """Handle every datagram waiting on the socket"""
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(MAX_DATAGRAM_BYTES)
+            except BlockingIOError:
+                return
+
+            # A stray or malformed datagram must not stop the listener
+            payload = decode_payload(data)
+            if payload is None:
+                print(f"Ignoring malformed datagram of {len(data)} bytes")
+                continue
+
+            origin = payload["origin"]
+            if payload["kind"] == "message":
+                self.received += 1
+                self._deliver(payload["user_id"], payload["message"])
+            elif payload["kind"] == "presence":
+                users = {} if payload.get("full") else self._peers.get(origin, (0, {}))[1]
+                for user_id, count in payload["users"].items():
+                    if count:
+                        users[int(user_id)] = count
+                    else:
+                        users.pop(int(user_id), None)
+                self._peers[origin] = (time.monotonic(), users)
+            elif payload["kind"] == "leave":
+                self._peers.pop(origin, None)
+
+    def _send_presence_snapshot(self):
+        """Send this worker's full presence, split so each datagram stays small"""
+        users = list(self._local.items())
+        for start in range(0, max(len(users), 1), PRESENCE_USERS_PER_DATAGRAM):
+            chunk = users[start:start + PRESENCE_USERS_PER_DATAGRAM]
+            self._broadcast({
+                "kind": "presence",
+                "origin": self.node_id,
+                "users": {str(user_id): count for user_id, count in chunk},
+                # The first datagram replaces what peers know; the rest add to it
+                "full": start == 0,
+            })
+
+    async def _send_heartbeats(self):
+        """Periodically send this worker's full presence"""
+        while True:
+            self._send_presence_snapshot()
+            await asyncio.sleep(self.presence_interval)
+
+
+BACKENDS = {
+    "memory": InMemoryBackend,
+    "unix": UnixSocketBackend,
+}
+
+
+def create_backend(name: str = WS_BACKEND) -> WebSocketBackend:
+    """Backend selected by WS_BACKEND"""
+    if name not in BACKENDS:
+        raise ValueError(f"WS_BACKEND must be one of {tuple(BACKENDS)}, got {name!r}")
+    return BACKENDS[name]()
@@ -0,0 +1,127 @@
+""" exact-match cache of LLM replies for repeated prompts"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+# Only for annotations; importing the app must not load the LLM stack
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+load_dotenv()
+
+# Seconds a cached reply is served for; 0 disables the cache
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def normalize_content(content: str) -> str:
+    """Collapse whitespace so trivially different prompts share an entry"""
+    return " ".join(content.split())
+
+
+def llm_cache_identity(llm) -> List:
+    """Model name and temperature of a chat model, as used in cache keys"""
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+    return [model, getattr(llm, "temperature", None)]
+
+
+def response_cache_key(llm, messages: List["BaseMessage"]) -> str:
+    """Hash of the model, its temperature and the normalized prompt messages"""
+    payload = json.dumps([
+        llm_cache_identity(llm),
+        [[msg.type, normalize_content(msg.content)] for msg in messages],
+    ])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class _CachedResponse(NamedTuple):
+    """reply chunks as streamed, so replays keep the same framing"""
+    chunks: List[str]
+    expires_at: float
+    size: int
+
+
+class ResponseCache:
+    """TTL and size bounded LRU cache of replies keyed by response_cache_key"""
+    def __init__(
+            self,
+            ttl: float = RESPONSE_CACHE_TTL,
+            max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes: int = RESPONSE_CACHE_MAX_BYTES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CachedResponse]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """Return the cached reply chunks, or None on a miss"""
+        if not self.enabled:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.chunks
+
+    def put(self, key: str, chunks: List[str]):
+        """Store a complete reply"""
+        if not self.enabled or not chunks:
+            return
+
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = _CachedResponse(list(chunks), time.monotonic() + self.ttl, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def clear(self):
+        """Remove every cached reply"""
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters"""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Global response cache instance
+response_cache = ResponseCache()
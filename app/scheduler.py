@@ -0,0 +1,304 @@
+""" admission control and fair scheduling for upstream LLM calls"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional,
+    Union
+)
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# LLM calls running at once on this worker; 0 for no limit
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# Admissions pause after a rate-limit response, doubling up to the maximum
+LLM_BACKOFF_SECONDS = float(os.getenv("LLM_BACKOFF_SECONDS", "1"))
+LLM_MAX_BACKOFF_SECONDS = float(os.getenv("LLM_MAX_BACKOFF_SECONDS", "30"))
+# Times a call rejected by a rate limit is queued again before failing
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "3"))
+
+# Priority classes, most urgent first
+PRIORITIES = ("interactive", "background", "bulk")
+# Classes clients may ask for; background is for the server's own summaries
+CLIENT_PRIORITIES = ("interactive", "bulk")
+
+# Seconds between queue updates sent to a waiting request
+QUEUE_STATUS_INTERVAL = 1.0
+
+
+class QueueStatus(NamedTuple):
+    """where a waiting request is in the queue; position 1 is admitted next"""
+    position: int
+    waited_ms: float
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Whether a provider error is a 429 rate-limit response"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the provider asked us to wait, from its Retry-After header"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Ticket:
+    """A request waiting for, or holding, an LLM slot"""
+    def __init__(self, user_id: Optional[Hashable], priority: int):
+        self.user_id = user_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.released = False
+        self._admission = asyncio.Event()
+
+    @property
+    def waited_ms(self) -> float:
+        return (time.monotonic() - self.enqueued_at) * 1000
+
+
+class LLMScheduler:
+    """Admits LLM calls under a global concurrency limit.
+
+    Waiting requests are served by priority class. Within a class the slot goes
+    to the user with the fewest calls running, then in turn, so one user's burst
+    can't starve everyone else. A rate-limit response pauses all admissions with
+    exponential backoff.
+    """
+    def __init__(
+            self,
+            max_concurrency: int = LLM_MAX_CONCURRENCY,
+            backoff: float = LLM_BACKOFF_SECONDS,
+            max_backoff: float = LLM_MAX_BACKOFF_SECONDS,
+            retries: int = LLM_RATE_LIMIT_RETRIES
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = retries
+        self.active = 0
+        # Per priority class, each user's waiting tickets in turn order
+        self._queues = [OrderedDict() for _ in PRIORITIES]
+        self._waiting = [0] * len(PRIORITIES)
+        self._running: Dict[Optional[Hashable], int] = {}
+        self._backoff = backoff
+        self._paused_until = 0.0
+        self._resume: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.queued = 0
+        self.rate_limited = 0
+
+    @property
+    def waiting(self) -> int:
+        return sum(self._waiting)
+
+    def enqueue(self, user_id: Optional[Hashable], priority: str = "interactive") -> Ticket:
+        """Queue a request; it may be admitted straight away"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {PRIORITIES}, got {priority!r}")
+
+        ticket = Ticket(user_id, PRIORITIES.index(priority))
+        self._queues[ticket.priority].setdefault(user_id, deque()).append(ticket)
+        self._waiting[ticket.priority] += 1
+        self._dispatch()
+        if not ticket.admitted:
+            self.queued += 1
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """Give back a slot, or leave the queue if the ticket was never admitted"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self.active -= 1
+            self._running[ticket.user_id] -= 1
+            if not self._running[ticket.user_id]:
+                del self._running[ticket.user_id]
+        else:
+            self._remove(ticket)
+        self._dispatch()
+
+    async def wait(self, ticket: Ticket) -> AsyncIterator[QueueStatus]:
+        """Yield the ticket's queue status every few seconds until it is admitted"""
+        while not ticket.admitted:
+            yield self.status(ticket)
+            try:
+                await asyncio.wait_for(ticket._admission.wait(), QUEUE_STATUS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def status(self, ticket: Ticket) -> QueueStatus:
+        """Queue position of a ticket, assuming users keep taking turns"""
+        if ticket.admitted:
+            return QueueStatus(0, ticket.waited_ms)
+
+        ahead = sum(self._waiting[:ticket.priority])
+        queues = self._queues[ticket.priority]
+        index = queues[ticket.user_id].index(ticket)
+        before_user = True
+        for user_id in self._turn_order(queues):
+            tickets = queues[user_id]
+            if user_id == ticket.user_id:
+                before_user = False
+                ahead += index
+            else:
+                ahead += min(len(tickets), index + 1 if before_user else index)
+        return QueueStatus(ahead + 1, ticket.waited_ms)
+
+    def backoff(self, error: BaseException) -> bool:
+        """Pause admissions if the error is a rate limit, returning whether it was"""
+        if not is_rate_limit_error(error):
+            return False
+
+        delay = max(retry_after(error) or 0, self._backoff)
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self.rate_limited += 1
+        logger.warning("LLM rate limited, pausing admissions for %.1fs", delay)
+        return True
+
+    def succeeded(self):
+        """Reset the backoff once the provider accepts a call again"""
+        self._backoff = self.min_backoff
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[Hashable] = None, priority: str = "interactive"):
+        """Hold an LLM slot for the body of the block"""
+        ticket = self.enqueue(user_id, priority)
+        try:
+            async for _ in self.wait(ticket):
+                pass
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def run(
+            self,
+            call: Callable[[], Awaitable[Any]],
+            user_id: Optional[Hashable] = None,
+            priority: str = "interactive"
+    ) -> Any:
+        """Await an LLM call once admitted, queueing it again after a rate limit"""
+        for attempt in range(self.retries + 1):
+            async with self.slot(user_id, priority):
+                try:
+                    result = await call()
+                except Exception as e:
+                    if attempt < self.retries and self.backoff(e):
+                        continue
+                    raise
+            self.succeeded()
+            return result
+
+    async def stream(
+            self,
+            open_stream: Callable[[], AsyncIterator[str]],
+            user_id: Optional[Hashable] = None,
+            priority: str = "interactive"
+    ) -> AsyncIterator[Union[str, QueueStatus]]:
+        """Yield queue updates while waiting, then the chunks of the admitted stream.
+
+        A stream rejected by a rate limit before its first chunk is queued again;
+        once text has been sent, errors are passed on.
+        """
+        for attempt in range(self.retries + 1):
+            ticket = self.enqueue(user_id, priority)
+            try:
+                async for status in self.wait(ticket):
+                    yield status
+
+                started = False
+                try:
+                    async for chunk in open_stream():
+                        if not started:
+                            started = True
+                            self.succeeded()
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or attempt == self.retries or not self.backoff(e):
+                        raise
+            finally:
+                self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        """Scheduler counters"""
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "waiting": dict(zip(PRIORITIES, self._waiting)),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rate_limited": self.rate_limited,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+        }
+
+    def _has_capacity(self) -> bool:
+        return not self.max_concurrency or self.active < self.max_concurrency
+
+    def _dispatch(self):
+        """Admit waiting tickets while there is capacity and no backoff"""
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            if self.waiting:
+                if self._resume is not None:
+                    self._resume.cancel()
+                self._resume = asyncio.get_running_loop().call_later(pause, self._dispatch)
+            return
+
+        while self._has_capacity():
+            ticket = self._next()
+            if ticket is None:
+                return
+            ticket.admitted = True
+            ticket._admission.set()
+            self._running[ticket.user_id] = self._running.get(ticket.user_id, 0) + 1
+            self.active += 1
+            self.admitted += 1
+
+    def _next(self) -> Optional[Ticket]:
+        """Most urgent waiting ticket, rotating between users in a class"""
+        for priority, queues in enumerate(self._queues):
+            if not queues:
+                continue
+            user_id = self._turn_order(queues)[0]
+            tickets = queues[user_id]
+            ticket = tickets.popleft()
+            if tickets:
+                queues.move_to_end(user_id)
+            else:
+                del queues[user_id]
+            self._waiting[priority] -= 1
+            return ticket
+        return None
+
+    def _turn_order(self, queues: Dict) -> List[Optional[Hashable]]:
+        """Users of a class in the order they get slots: fewest running calls first"""
+        return sorted(queues, key=lambda user_id: self._running.get(user_id, 0))
+
+    def _remove(self, ticket: Ticket):
+        queues = self._queues[ticket.priority]
+        tickets: Deque[Ticket] = queues[ticket.user_id]
+        tickets.remove(ticket)
+        if not tickets:
+            del queues[ticket.user_id]
+        self._waiting[ticket.priority] -= 1
+
+
+# Global LLM scheduler instance
+llm_scheduler = LLMScheduler()
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 from datetime import datetime
 
 
@@ -26,6 +26,7 @@ class MessageResponse(BaseModel):
     id: int
     role: str
     content: str
+    token_count: int = 0
     created_at: datetime
 
     class Config:
@@ -47,11 +48,46 @@ class ConversationResponse(BaseModel):
         from_attributes = True
 
 
+class ConversationPreviewResponse(BaseModel):
+    id: int
+    title: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    message_count: int = 0
+    total_tokens: int = 0
+    last_message_at: Optional[datetime] = None
+    last_message_preview: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
 class ChatRequest(BaseModel):
     message: str
     conversation_id: Optional[int] = None
+    # Scheduling class for the LLM call; bulk work yields to interactive chats
+    priority: Literal["interactive", "bulk"] = "interactive"
 
 
 class ChatResponse(BaseModel):
     conversation_id: int
-    message: str
\ No newline at end of file
+    message: str
+
+
+# Most chats accepted by one /chat/batch request
+MAX_BATCH_SIZE = 100
+
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class ChatBatchResult(BaseModel):
+    conversation_id: Optional[int] = None
+    message: Optional[str] = None
+    # Set instead of message when this chat failed; the others are unaffected
+    error: Optional[str] = None
+
+
+class ChatBatchResponse(BaseModel):
+    results: List[ChatBatchResult]
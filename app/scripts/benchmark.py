@@ -0,0 +1,371 @@
+"""Load test the chat endpoints against SQLite and the fake LLM.
+
+Starts the app in-process with uvicorn (on a background thread) against a scratch
+SQLite database and the offline fake model, then runs many concurrent sessions
+against /chat, /chat/stream (SSE) and /ws. Reports time to first byte and to
+first chunk, inter-chunk latency percentiles, messages per second and database
+queries per turn, and writes everything to a JSON file so runs can be compared.
+
+Run from the app directory:
+
+    python scripts/benchmark.py --sessions 1000 --turns 3 --output results.json
+    python scripts/benchmark.py --modes ws --sessions 2000 --ttft-ms 300 --token-delay-ms 15
+
+Clients share the interpreter with the server, so absolute numbers include some
+client overhead; compare runs made with the same settings. Raise the open file
+limit (ulimit -n) for thousands of sessions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ("chat", "sse", "ws")
+
+
+class Recorder:
+    """Latency samples and counters for one endpoint"""
+    def __init__(self):
+        self.first_byte: List[float] = []
+        self.first_chunk: List[float] = []
+        self.inter_chunk: List[float] = []
+        self.turn_time: List[float] = []
+        self.chunks = 0
+        self.turns = 0
+        self.errors = 0
+        self.error_samples: List[str] = []
+
+    def error(self, e):
+        self.errors += 1
+        if len(self.error_samples) < 5:
+            self.error_samples.append(repr(e))
+
+    def report(self, elapsed: float, queries: int) -> Dict:
+        return {
+            "turns": self.turns,
+            "errors": self.errors,
+            "error_samples": self.error_samples,
+            "chunks": self.chunks,
+            "messages_per_sec": self.turns / elapsed if elapsed else 0.0,
+            "db_queries": queries,
+            "db_queries_per_turn": queries / self.turns if self.turns else None,
+            "elapsed_s": elapsed,
+            "time_to_first_byte_ms": percentiles(self.first_byte),
+            "time_to_first_chunk_ms": percentiles(self.first_chunk),
+            "inter_chunk_ms": percentiles(self.inter_chunk),
+            "turn_ms": percentiles(self.turn_time),
+        }
+
+
+def percentiles(samples: List[float]) -> Optional[Dict[str, float]]:
+    """Summary of latency samples given in seconds, in milliseconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered) * 1000,
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": ordered[-1] * 1000,
+    }
+
+
+class QueryCounter:
+    """Counts statements executed on the app's engines"""
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._executed)
+
+    def _executed(self, *args):
+        self.count += 1
+
+
+def start_server(app, port: int, timeout: float = 60):
+    """Run uvicorn on a background thread and wait until its startup warmup is done"""
+    import urllib.error
+    import urllib.request
+    import uvicorn
+
+    config = uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning",
+        backlog=4096, timeout_keep_alive=30
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        if not thread.is_alive():
+            raise RuntimeError("Server failed to start")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Server not ready after {timeout:.0f}s")
+        if server.started:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready") as response:
+                    if response.status == 200:
+                        return server, thread
+            except urllib.error.URLError:
+                pass
+        time.sleep(0.05)
+
+
+async def create_users(client, count: int) -> List[int]:
+    """Create one user per session, one at a time since this is setup, not load"""
+    run_id = os.urandom(4).hex()
+    user_ids = []
+    for i in range(count):
+        response = await client.post("/users/", json={
+            "username": f"bench_{run_id}_{i}", "email": f"bench_{run_id}_{i}@example.com"
+        })
+        response.raise_for_status()
+        user_ids.append(response.json()["id"])
+    return user_ids
+
+
+async def chat_session(client, user_id: int, turns: int, recorder: Recorder):
+    """Non-streaming turns on /chat"""
+    conversation_id = None
+    for turn in range(turns):
+        started = time.perf_counter()
+        try:
+            response = await client.post(f"/chat/{user_id}", json={
+                "message": f"Benchmark question {turn} from user {user_id}",
+                "conversation_id": conversation_id,
+            })
+            response.raise_for_status()
+            conversation_id = response.json()["conversation_id"]
+        except Exception as e:
+            recorder.error(e)
+            return
+        elapsed = time.perf_counter() - started
+        recorder.first_byte.append(elapsed)
+        recorder.turn_time.append(elapsed)
+        recorder.turns += 1
+
+
+async def sse_session(client, user_id: int, turns: int, recorder: Recorder):
+    """Streaming turns on /chat/stream"""
+    conversation_id = None
+    for turn in range(turns):
+        started = time.perf_counter()
+        first_byte = last_chunk = None
+        try:
+            async with client.stream("POST", f"/chat/stream/{user_id}", json={
+                "message": f"Benchmark question {turn} from user {user_id}",
+                "conversation_id": conversation_id,
+            }) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    now = time.perf_counter()
+                    if first_byte is None:
+                        first_byte = now
+                        recorder.first_byte.append(now - started)
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+
+                    event = json.loads(line[6:])
+                    if event["type"] == "conversation_id":
+                        conversation_id = event["conversation_id"]
+                    elif event["type"] == "chunk":
+                        recorder.chunks += 1
+                        if last_chunk is None:
+                            recorder.first_chunk.append(now - started)
+                        else:
+                            recorder.inter_chunk.append(now - last_chunk)
+                        last_chunk = now
+                    elif event["type"] == "error":
+                        raise RuntimeError(event["message"])
+        except Exception as e:
+            recorder.error(e)
+            return
+        recorder.turn_time.append(time.perf_counter() - started)
+        recorder.turns += 1
+
+
+async def ws_session(
+        base_url: str, user_id: int, turns: int, recorder: Recorder, timeout: float
+):
+    """Streaming turns over one WebSocket using the delta protocol"""
+    import websockets
+
+    url = base_url.replace("http", "ws", 1) + f"/ws/{user_id}?protocol=2"
+    try:
+        async with websockets.connect(url, open_timeout=timeout, max_size=None) as websocket:
+            json.loads(await websocket.recv())
+            conversation_id = None
+            for turn in range(turns):
+                started = time.perf_counter()
+                first_byte = last_chunk = None
+                await websocket.send(json.dumps({
+                    "message": f"Benchmark question {turn} from user {user_id}",
+                    "conversation_id": conversation_id,
+                }))
+                while True:
+                    frame = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+                    now = time.perf_counter()
+                    if frame["type"] == "timing":
+                        # Stage timings of the previous turn
+                        continue
+                    if first_byte is None:
+                        first_byte = now
+                        recorder.first_byte.append(now - started)
+
+                    if frame["type"] == "conversation_created":
+                        conversation_id = frame["conversation_id"]
+                    elif frame["type"] == "delta":
+                        recorder.chunks += 1
+                        if last_chunk is None:
+                            recorder.first_chunk.append(now - started)
+                        else:
+                            recorder.inter_chunk.append(now - last_chunk)
+                        last_chunk = now
+                    elif frame["type"] == "message_complete":
+                        break
+                    elif frame["type"] == "error":
+                        raise RuntimeError(frame["message"])
+                recorder.turn_time.append(time.perf_counter() - started)
+                recorder.turns += 1
+    except Exception as e:
+        recorder.error(e)
+
+
+async def run_mode(mode: str, base_url: str, args, counter: QueryCounter) -> Dict:
+    """Run every session of one mode concurrently"""
+    import httpx
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.request_timeout)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        user_ids = await create_users(client, args.sessions)
+
+        recorder = Recorder()
+        gate = asyncio.Semaphore(args.concurrency or args.sessions)
+
+        async def session(user_id: int):
+            async with gate:
+                if mode == "chat":
+                    await chat_session(client, user_id, args.turns, recorder)
+                elif mode == "sse":
+                    await sse_session(client, user_id, args.turns, recorder)
+                else:
+                    await ws_session(
+                        base_url, user_id, args.turns, recorder, args.request_timeout
+                    )
+
+        queries_before = counter.count
+        started = time.perf_counter()
+        await asyncio.gather(*[session(user_id) for user_id in user_ids])
+        elapsed = time.perf_counter() - started
+
+        # Let write-behind work (message writer, summaries) land before counting queries
+        await asyncio.sleep(0.5)
+        return recorder.report(elapsed, counter.count - queries_before)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_summary(results: Dict):
+    for mode, result in results["modes"].items():
+        ttfc = result["time_to_first_chunk_ms"] or result["time_to_first_byte_ms"] or {}
+        gaps = result["inter_chunk_ms"] or {}
+        queries = result["db_queries_per_turn"]
+        print(
+            f"{mode:>4}: {result['turns']} turns, {result['errors']} errors, "
+            f"{result['messages_per_sec']:.1f} msg/s, "
+            f"first chunk p50 {ttfc.get('p50', 0):.1f}ms p99 {ttfc.get('p99', 0):.1f}ms, "
+            f"inter-chunk p50 {gaps.get('p50', 0):.1f}ms p99 {gaps.get('p99', 0):.1f}ms, "
+            f"{queries if queries is None else round(queries, 1)} queries/turn"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--sessions", type=int, default=200, help="concurrent sessions per mode")
+    parser.add_argument("--concurrency", type=int, default=0, help="cap on open sessions")
+    parser.add_argument("--turns", type=int, default=3, help="messages per session")
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--token-delay-ms", type=float, default=20)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--request-timeout", type=float, default=120, help="seconds")
+    parser.add_argument("--response-cache", action="store_true", help="keep the reply cache on")
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    database_url = args.database_url or (
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    # Configure the app before it is imported
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "LLM_PROVIDER": "fake",
+        "FAKE_LLM_TTFT_MS": str(args.ttft_ms),
+        "FAKE_LLM_TOKEN_DELAY_MS": str(args.token_delay_ms),
+        "FAKE_LLM_TOKENS": str(args.tokens),
+        "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "WS_BACKEND": "memory",
+    })
+    if not args.response_cache:
+        os.environ["RESPONSE_CACHE_TTL"] = "0"
+
+    from database import async_engine, engine
+    from main import app
+
+    counter = QueryCounter([engine, async_engine.sync_engine])
+    server, thread = start_server(app, args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "database_url": database_url,
+        "modes": {},
+    }
+    try:
+        for mode in args.modes:
+            print(f"Running {args.sessions} {mode} sessions x {args.turns} turns...")
+            results["modes"][mode] = asyncio.run(run_mode(mode, base_url, args, counter))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_summary(results)
+    print(f"Results written to {args.output}")
+    return 1 if any(result["errors"] for result in results["modes"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
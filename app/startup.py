@@ -0,0 +1,106 @@
+""" startup warmup run in the background so the server accepts connections at once"""
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# A failed warmup step is retried after this many seconds, doubling up to the maximum
+STARTUP_RETRY_SECONDS = float(os.getenv("STARTUP_RETRY_SECONDS", "1"))
+STARTUP_MAX_RETRY_SECONDS = float(os.getenv("STARTUP_MAX_RETRY_SECONDS", "30"))
+
+
+class _Step:
+    """One warmup step and how it went"""
+    def __init__(self, run: Callable[[], Awaitable[Any]]):
+        self.run = run
+        self.done = False
+        self.attempts = 0
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class Warmup:
+    """Runs named startup steps concurrently, retrying each until it succeeds.
+
+    The server keeps serving while they run; `ready` turns true once every step
+    has finished, which is what /ready reports to load balancers.
+    """
+    def __init__(
+            self,
+            retry: float = STARTUP_RETRY_SECONDS,
+            max_retry: float = STARTUP_MAX_RETRY_SECONDS
+    ):
+        self.retry = retry
+        self.max_retry = max_retry
+        self._steps: Dict[str, _Step] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, name: str, run: Callable[[], Awaitable[Any]]):
+        self._steps[name] = _Step(run)
+
+    @property
+    def ready(self) -> bool:
+        return all(step.done for step in self._steps.values())
+
+    def start(self) -> asyncio.Task:
+        """Start every step on the running event loop"""
+        self._task = asyncio.create_task(self.wait())
+        return self._task
+
+    async def wait(self):
+        """Run the steps that haven't finished yet and wait for all of them"""
+        await asyncio.gather(*(
+            self._run(name, step) for name, step in self._steps.items() if not step.done
+        ))
+
+    async def _run(self, name: str, step: _Step):
+        started = time.perf_counter()
+        delay = self.retry
+        while True:
+            step.attempts += 1
+            try:
+                await step.run()
+            except Exception as e:
+                step.error = str(e)
+                print(f"Startup step {name} failed, retrying in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry)
+                continue
+            step.done = True
+            step.error = None
+            step.seconds = round(time.perf_counter() - started, 3)
+            print(f"Startup step {name} finished in {step.seconds:.2f}s")
+            return
+
+    async def close(self):
+        """Stop steps that are still running"""
+        if self._task is None or self._task.done():
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Readiness and the state of each step"""
+        return {
+            "ready": self.ready,
+            "steps": {
+                name: {
+                    "done": step.done,
+                    "attempts": step.attempts,
+                    "seconds": step.seconds,
+                    "error": step.error,
+                }
+                for name, step in self._steps.items()
+            },
+        }
+
+
+# Global startup warmup instance
+warmup = Warmup()
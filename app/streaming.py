@@ -0,0 +1,276 @@
+""" helpers for streaming LLM output to clients"""
+import asyncio
+from contextlib import aclosing
+import os
+from typing import (
+    AsyncIterator, Awaitable, Coroutine, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+)
+
+from dotenv import load_dotenv
+
+from scheduler import QueueStatus
+
+load_dotenv()
+
+
+class CoalesceSettings(NamedTuple):
+    """how long and how much text to buffer before sending a frame"""
+    window_ms: float
+    max_bytes: int
+
+
+# Defaults per endpoint; a window of 0 sends every chunk as its own frame
+SSE_COALESCE = CoalesceSettings(
+    window_ms=float(os.getenv("SSE_COALESCE_MS", "20")),
+    max_bytes=int(os.getenv("SSE_COALESCE_BYTES", "256")),
+)
+WS_COALESCE = CoalesceSettings(
+    window_ms=float(os.getenv("WS_COALESCE_MS", "20")),
+    max_bytes=int(os.getenv("WS_COALESCE_BYTES", "256")),
+)
+
+# Upper bounds for per-request overrides
+MAX_COALESCE_MS = 1000
+MAX_COALESCE_BYTES = 64 * 1024
+
+# WebSocket protocol versions, chosen with the `protocol` query parameter.
+# v1 repeats the reply so far in every chunk frame; v2 sends numbered deltas and
+# the full reply only in message_complete.
+WS_PROTOCOL_FULL = 1
+WS_PROTOCOL_DELTA = 2
+
+# Responses one WebSocket connection may generate at the same time
+WS_MAX_GENERATIONS = int(os.getenv("WS_MAX_GENERATIONS", "4"))
+
+_END = object()
+
+
+async def chunk_texts(stream) -> AsyncIterator[Union[str, QueueStatus]]:
+    """Text of each chunk produced by StreamingChatbot.stream_response.
+
+    Queue updates sent while waiting for an LLM slot are passed through as
+    QueueStatus tuples.
+    """
+    async with aclosing(stream):
+        async for chunk_data in stream:
+            if "queued" in chunk_data:
+                yield chunk_data["queued"]
+            else:
+                yield chunk_data["chunk"]
+
+
+async def coalesce_chunks(
+        chunks: AsyncIterator[Union[str, QueueStatus]], settings: CoalesceSettings
+) -> AsyncIterator[Union[str, QueueStatus]]:
+    """Merge small chunks into fewer frames.
+
+    The first chunk is sent as soon as it arrives to keep time to first token
+    low. After that, text is buffered until `window_ms` has passed since the
+    oldest buffered chunk or the buffer reaches `max_bytes`. Queue updates are
+    never merged or delayed.
+    """
+    if settings.window_ms <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(_END)
+
+    loop = asyncio.get_running_loop()
+    window = settings.window_ms / 1000
+    pump_task = asyncio.create_task(pump())
+    try:
+        sent_text = False
+        buffer = []
+        size = 0
+        deadline = None
+        while True:
+            if buffer:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or size >= settings.max_bytes:
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                    continue
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+            else:
+                item = await queue.get()
+
+            if item is _END or isinstance(item, Exception):
+                if buffer:
+                    yield "".join(buffer)
+                if item is _END:
+                    return
+                raise item
+
+            if isinstance(item, QueueStatus):
+                yield item
+                continue
+            if not sent_text:
+                sent_text = True
+                yield item
+                continue
+
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(item)
+            size += len(item.encode())
+    finally:
+        # Stops the upstream LLM stream when the client goes away
+        pump_task.cancel()
+
+
+class GenerationTasks:
+    """Responses being generated on one WebSocket connection, keyed by conversation"""
+    def __init__(self, limit: int = WS_MAX_GENERATIONS):
+        self.limit = limit
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Cancelled tasks still saving their partial reply
+        self._cancelled: Dict[int, asyncio.Task] = {}
+        # Database work that must finish even when its generation is cancelled
+        self._shielded: Set[asyncio.Task] = set()
+
+    def __contains__(self, conversation_id: int) -> bool:
+        return conversation_id in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __iter__(self):
+        return iter(list(self._tasks))
+
+    def full(self) -> bool:
+        """Whether the connection is at its concurrent generation limit"""
+        return len(self._tasks) >= self.limit
+
+    def start(self, conversation_id: int, generation: Coroutine) -> asyncio.Task:
+        """Run a generation in the background until it finishes or is cancelled"""
+        previous = self._tasks.get(conversation_id) or self._cancelled.get(conversation_id)
+        task = asyncio.create_task(self._run(previous, generation))
+        self._tasks[conversation_id] = task
+
+        def forget(done: asyncio.Task):
+            for tasks in (self._tasks, self._cancelled):
+                if tasks.get(conversation_id) is done:
+                    del tasks[conversation_id]
+            if not done.cancelled() and done.exception() is not None:
+                print(f"Error generating response for conversation {conversation_id}: "
+                      f"{done.exception()}")
+
+        task.add_done_callback(forget)
+        return task
+
+    @staticmethod
+    async def _run(previous: Optional[asyncio.Task], generation: Coroutine):
+        """Let the previous generation finish saving before the next one starts"""
+        if previous is not None:
+            try:
+                await asyncio.wait([previous])
+            except asyncio.CancelledError:
+                generation.close()
+                raise
+        await generation
+
+    def shield(self, work: Coroutine) -> Awaitable:
+        """Run work that cancelling a generation must not interrupt; close() waits for it"""
+        task = asyncio.create_task(work)
+        self._shielded.add(task)
+        task.add_done_callback(self._shielded.discard)
+        return asyncio.shield(task)
+
+    def cancel(self, conversation_id: int) -> bool:
+        """Cancel the generation for a conversation, returning False if none is running"""
+        task = self._tasks.pop(conversation_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        self._cancelled[conversation_id] = task
+        return True
+
+    def release(self, conversation_id: int) -> Optional[asyncio.Task]:
+        """Stop tracking a generation without cancelling it"""
+        return self._tasks.pop(conversation_id, None)
+
+    def cancel_all(self) -> int:
+        """Cancel every generation, returning how many were running"""
+        running = len(self._tasks)
+        for conversation_id in list(self._tasks):
+            self.cancel(conversation_id)
+        return running
+
+    async def close(self):
+        """Cancel every generation and wait for them to finish cleaning up"""
+        self.cancel_all()
+        await asyncio.gather(*self._cancelled.values(), return_exceptions=True)
+        await asyncio.gather(*self._shielded, return_exceptions=True)
+
+
+class InFlightGeneration:
+    """A reply being streamed, with the text sent so far for tabs that subscribe late"""
+    def __init__(self, user_id: int, conversation_id: int, owner: GenerationTasks):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        # Connection that started the generation; None once handed over
+        self.owner: Optional[GenerationTasks] = owner
+        self.task: Optional[asyncio.Task] = None
+        self.parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def cancel(self) -> bool:
+        """Cancel the generation, whichever connection started it"""
+        if self.owner is not None:
+            return self.owner.cancel(self.conversation_id)
+        if self.task is None or self.task.done():
+            return False
+        self.task.cancel()
+        return True
+
+
+class GenerationRegistry:
+    """Replies being generated on this worker, keyed by user and conversation"""
+    def __init__(self):
+        self._generations: Dict[Tuple[int, int], InFlightGeneration] = {}
+
+    def __len__(self) -> int:
+        return len(self._generations)
+
+    def get(self, user_id: int, conversation_id: int) -> Optional[InFlightGeneration]:
+        return self._generations.get((user_id, conversation_id))
+
+    def begin(
+            self, user_id: int, conversation_id: int, owner: GenerationTasks
+    ) -> InFlightGeneration:
+        """Register a generation that is about to start"""
+        generation = InFlightGeneration(user_id, conversation_id, owner)
+        self._generations[(user_id, conversation_id)] = generation
+        return generation
+
+    def end(self, generation: InFlightGeneration):
+        """Remove a generation once it finished or was cancelled"""
+        key = (generation.user_id, generation.conversation_id)
+        if self._generations.get(key) is generation:
+            del self._generations[key]
+
+    def owned_by(self, owner: GenerationTasks) -> List[InFlightGeneration]:
+        """Generations started by one connection"""
+        return [
+            generation for generation in self._generations.values() if generation.owner is owner
+        ]
+
+
+# Global in-flight generation registry
+generation_registry = GenerationRegistry()
@@ -1,26 +1,73 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 import uuid
+from contextlib import aclosing, asynccontextmanager
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, QueuePool
 
+# Run against the offline model; no network or Groq key needed
+os.environ["LLM_PROVIDER"] = "fake"
+os.environ.setdefault("FAKE_LLM_TTFT_MS", "0")
+os.environ.setdefault("FAKE_LLM_TOKEN_DELAY_MS", "0")
+
+import main
 from main import app
-from database import get_db
-from models import Base
+from chatbot import StreamingChatbot, create_chatbot_graph
+from context import (
+    MESSAGE_TOKEN_OVERHEAD, build_context_window, count_tokens, message_tokens, summary_cutoff
+)
+from auth_cache import AuthorizationCache, auth_cache
+from crud import AsyncConversationCRUD, AsyncMessageCRUD, MessageCRUD
+from history_cache import ConversationHistoryCache, history_cache
+from llm_providers import FakeLLMError, FakeStreamingChatModel, create_llm
+from response_cache import ResponseCache, response_cache, response_cache_key
+from message_writer import MessageWriter, message_writer
+from database import (
+    get_db, get_async_db, get_async_database_url, get_async_session_factory, pool_options,
+    pool_stats, run_migrations
+)
+from metrics import Histogram, Metric, db_commits, db_pool_wait, instrument_engine
+from models import Base, Conversation, User
+from scheduler import LLMScheduler, QueueStatus
+from tracing import Trace, TraceLog
+import tracing
 from schemas import UserCreate
+from startup import Warmup
+from streaming import CoalesceSettings, coalesce_chunks
+from pubsub import UnixSocketBackend
+from websocket_manager import ConnectionManager
 
 # --- Setup test DB ---
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+# File backed so the sync and async engines share the same tables
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool
+    connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    get_async_database_url(SQLALCHEMY_DATABASE_URL),
+    poolclass=NullPool
+)
+TestingAsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 # Create tables
 Base.metadata.create_all(bind=engine)
 
@@ -34,11 +81,25 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_async_session_factory] = lambda: TestingAsyncSessionLocal
+message_writer.session_factory = TestingAsyncSessionLocal
 client = TestClient(app)
 
 
 # --- Fixtures ---
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    # Fake models share a cache key, so replies must not leak between tests
+    response_cache.clear()
+
+
 @pytest.fixture
 def new_user():
     unique_email = f"rocky_{uuid.uuid4().hex[:6]}@example.com"
@@ -102,3 +163,1463 @@ def test_regular_chat(new_user):
     data = response.json()
     assert "message" in data
     assert "conversation_id" in data
+
+
+def test_async_database_url():
+    assert get_async_database_url("postgresql://u:p@db:5432/chat") == \
+        "postgresql+asyncpg://u:p@db:5432/chat"
+    assert get_async_database_url("sqlite:///./chat.db") == "sqlite+aiosqlite:///./chat.db"
+
+
+def test_stream_chat_unknown_user():
+    response = client.post("/chat/stream/999999", json={"message": "Hello"})
+    assert response.status_code == 404
+
+
+def test_stream_chat_foreign_conversation(new_user):
+    owner_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{owner_id}/conversations/", json={"title": "Private"}
+    ).json()["id"]
+
+    other = {"username": "Other", "email": f"other_{uuid.uuid4().hex[:6]}@example.com"}
+    other_id = client.post("/users/", json=other).json()["id"]
+
+    response = client.post(
+        f"/chat/stream/{other_id}",
+        json={"message": "Hello", "conversation_id": conversation_id}
+    )
+    assert response.status_code == 404
+
+
+def test_build_context_window_keeps_recent_messages():
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " * 10}
+        for i in range(20)
+    ]
+    budget = sum(message_tokens(msg) for msg in messages[-5:])
+
+    window = build_context_window(messages, budget)
+    assert window == messages[-5:]
+
+    # The newest message is kept even when it exceeds the budget on its own
+    assert build_context_window(messages, 1) == messages[-1:]
+
+
+def test_context_messages_use_stored_token_counts(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Long"}
+    ).json()["id"]
+
+    db = TestingSessionLocal()
+    try:
+        for i in range(10):
+            MessageCRUD.create_message(db, conversation_id, "user", f"turn {i} " * 50)
+
+        stored = MessageCRUD.get_messages_as_dict(db, conversation_id)
+        assert len(stored) == 10
+
+        budget = 2 * (count_tokens("turn 9 " * 50) + MESSAGE_TOKEN_OVERHEAD)
+        window = MessageCRUD.get_context_messages(db, conversation_id, budget=budget)
+        assert [msg["content"] for msg in window] == [msg["content"] for msg in stored[-2:]]
+        assert window[-1]["token_count"] == count_tokens("turn 9 " * 50)
+    finally:
+        db.close()
+
+
+def _stored(role, content):
+    return {"role": role, "content": content, "token_count": count_tokens(content)}
+
+
+def test_history_cache_append_and_lru():
+    cache = ConversationHistoryCache(max_conversations=2)
+    assert cache.get(1) is None
+
+    cache.put(1, [_stored("user", "Hello"), _stored("assistant", "Hi there")], summary="Greetings")
+    cache.append(1, "user", "How are you?", count_tokens("How are you?"))
+    assert [msg.content for msg in cache.get(1)] == ["Hello", "Hi there", "How are you?"]
+    assert type(cache.get(1)[1]).__name__ == "AIMessage"
+    # The running summary is cached with the window it precedes
+    assert cache.get_context(1).summary == "Greetings"
+
+    # Messages for conversations that are not cached are ignored
+    cache.append(3, "user", "ignored", 2)
+    assert 3 not in cache
+
+    cache.put(2, [_stored("user", "Second")])
+    cache.get(1)
+    cache.put(4, [_stored("user", "Third")])
+    assert 1 in cache and 2 not in cache and 4 in cache
+    assert cache.stats()["evictions"] == 1
+    assert cache.hits == 4 and cache.misses == 1
+
+
+def test_history_cache_byte_budget_and_stale_loads():
+    cache = ConversationHistoryCache(max_bytes=1000)
+    cache.put(1, [_stored("user", "a" * 400)])
+    cache.put(2, [_stored("user", "b" * 400)])
+    assert 1 not in cache and 2 in cache
+    assert cache.size <= 1000
+
+    # A write that lands while the window is loading discards the loaded window
+    token = cache.begin_load(5)
+    cache.append(5, "user", "new", 1)
+    cache.put(5, [_stored("user", "old")], token=token)
+    cache.end_load(5)
+    assert 5 not in cache
+
+    # So does an invalidation, even if another load of the conversation starts after it
+    first = cache.begin_load(6)
+    cache.invalidate(6)
+    second = cache.begin_load(6)
+    cache.put(6, [_stored("user", "stale")], token=first)
+    assert 6 not in cache
+    cache.put(6, [_stored("user", "fresh")], token=second)
+    assert [msg.content for msg in cache.get(6)] == ["fresh"]
+    cache.end_load(6)
+    cache.end_load(6)
+
+    # A load that failed leaves nothing behind once ended
+    cache.begin_load(7)
+    cache.end_load(7)
+    assert cache._loading == {}
+
+
+def test_create_message_appends_to_cached_history(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Cached"}
+    ).json()["id"]
+
+    db = TestingSessionLocal()
+    try:
+        MessageCRUD.create_message(db, conversation_id, "user", "First")
+        history_cache.put(conversation_id, MessageCRUD.get_context_messages(db, conversation_id))
+        MessageCRUD.create_message(db, conversation_id, "assistant", "Second")
+        assert [msg.content for msg in history_cache.get(conversation_id)] == ["First", "Second"]
+    finally:
+        db.close()
+        history_cache.invalidate(conversation_id)
+
+
+def _long_history(turns, words=400):
+    return [
+        {"id": i + 1, **_stored("user" if i % 2 == 0 else "assistant", f"turn{i} " * words)}
+        for i in range(turns)
+    ]
+
+
+def test_summary_cutoff_keeps_recent_turns():
+    assert summary_cutoff(_long_history(2), trigger=3072, keep=1024) == 0
+
+    messages = _long_history(10)
+    cut = summary_cutoff(messages, trigger=3072, keep=1024)
+    assert 0 < cut < len(messages)
+    assert sum(message_tokens(msg) for msg in messages[cut:]) <= 1024
+
+
+def test_chatbot_graph_compacts_long_history():
+    llm = FakeListChatModel(responses=["rolled up summary", "final answer"])
+    graph = create_chatbot_graph(llm)
+
+    result = graph.invoke({"messages": _long_history(10), "summary": None})
+    assert result["summary"] == "rolled up summary"
+    assert result["current_response"] == "final answer"
+    assert result["summary_message_id"] == 10 - len(result["messages"]) + 1
+
+
+def test_compact_conversation_persists_running_summary(new_user, monkeypatch):
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=["first", "second"]))
+    )
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    async def run():
+        async with TestingAsyncSessionLocal() as db:
+            conversation = await AsyncConversationCRUD.create_conversation(db, user_id, "Long")
+            for msg in _long_history(10):
+                await AsyncMessageCRUD.create_message(
+                    db, conversation.id, msg["role"], msg["content"]
+                )
+
+            await main.compact_conversation(db, conversation)
+            assert conversation.summary == "first"
+            first_cut = conversation.summary_message_id
+
+            # Only the turns after the summary are sent verbatim
+            unsummarized = await AsyncMessageCRUD.get_unsummarized_messages(db, conversation)
+            window = await AsyncMessageCRUD.get_cached_context(db, conversation)
+            assert 0 < len(window) < 10
+            assert [msg.content for msg in window] == [msg["content"] for msg in unsummarized]
+
+            # Under the trigger nothing is summarized again
+            await main.compact_conversation(db, conversation)
+            assert conversation.summary == "first"
+
+            for msg in _long_history(8):
+                await AsyncMessageCRUD.create_message(
+                    db, conversation.id, msg["role"], msg["content"]
+                )
+            await main.compact_conversation(db, conversation)
+            assert conversation.summary == "second"
+            assert conversation.summary_message_id > first_cut
+
+            stored = await AsyncConversationCRUD.get_conversation(db, conversation.id)
+            await db.refresh(stored)
+            assert stored.summary == "second"
+
+    asyncio.run(run())
+
+
+def test_migrations_create_hot_query_indexes():
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'migrated.db')}"
+    run_migrations(database_url)
+
+    migrated = inspect(create_engine(database_url))
+    message_indexes = {index["name"]: index for index in migrated.get_indexes("messages")}
+    assert message_indexes["ix_messages_conversation_id_created_at_id"]["column_names"] == [
+        "conversation_id", "created_at", "id"
+    ]
+    assert "ix_conversations_user_id_updated_at_id" in {
+        index["name"] for index in migrated.get_indexes("conversations")
+    }
+    assert {"summary", "summary_message_id"} <= {
+        column["name"] for column in migrated.get_columns("conversations")
+    }
+
+
+def test_counter_migration_estimates_tokens_of_uncounted_messages():
+    from alembic import command
+    from alembic.config import Config
+    import database
+
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'backfill.db')}"
+    config = Config(database.ALEMBIC_INI)
+    config.set_main_option(
+        "script_location", os.path.join(os.path.dirname(database.ALEMBIC_INI), "migrations")
+    )
+    config.set_main_option("sqlalchemy.url", database_url)
+    command.upgrade(config, "0003")
+
+    migrated = create_engine(database_url)
+    with migrated.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO users (id, username, email, created_at) "
+            "VALUES (1, 'old', 'old@example.com', '2024-01-01')"
+        ))
+        connection.execute(text(
+            "INSERT INTO conversations (id, user_id, title, created_at, updated_at) "
+            "VALUES (1, 1, 'Old', '2024-01-01', '2024-01-01')"
+        ))
+        connection.execute(text(
+            "INSERT INTO messages (conversation_id, role, content, token_count, created_at) "
+            "VALUES (1, 'user', :old, 0, '2024-01-01'), "
+            "(1, 'assistant', 'counted', 7, '2024-01-02')"
+        ), {"old": "x" * 10})
+
+    run_migrations(database_url)
+    with migrated.connect() as connection:
+        counters = connection.execute(
+            text("SELECT message_count, total_tokens FROM conversations WHERE id = 1")
+        ).one()
+    assert tuple(counters) == (2, count_tokens("x" * 10) + 7)
+
+
+def test_conversation_messages_keyset_pagination(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Paged"}
+    ).json()["id"]
+
+    db = TestingSessionLocal()
+    try:
+        for i in range(7):
+            MessageCRUD.create_message(db, conversation_id, "user", f"message {i}")
+    finally:
+        db.close()
+
+    url = f"/conversations/{conversation_id}/messages/"
+    newest = client.get(url, params={"limit": 3})
+    assert [msg["content"] for msg in newest.json()] == ["message 4", "message 5", "message 6"]
+    assert newest.headers["X-Has-More"] == "true"
+
+    older = client.get(url, params={"limit": 3, "before": newest.headers["X-Before-Cursor"]})
+    assert [msg["content"] for msg in older.json()] == ["message 1", "message 2", "message 3"]
+
+    oldest = client.get(url, params={"limit": 3, "before": older.headers["X-Before-Cursor"]})
+    assert [msg["content"] for msg in oldest.json()] == ["message 0"]
+    assert oldest.headers["X-Has-More"] == "false"
+
+    newer = client.get(url, params={"limit": 2, "after": oldest.headers["X-After-Cursor"]})
+    assert [msg["content"] for msg in newer.json()] == ["message 1", "message 2"]
+
+    assert client.get(url, params={"before": "not-a-cursor"}).status_code == 400
+
+
+def test_user_conversations_keyset_pagination(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    for title in ["First", "Second", "Third"]:
+        client.post(f"/users/{user_id}/conversations/", json={"title": title})
+
+    url = f"/users/{user_id}/conversations/"
+    first_page = client.get(url, params={"limit": 2})
+    assert [conv["title"] for conv in first_page.json()] == ["Third", "Second"]
+    assert first_page.headers["X-Has-More"] == "true"
+
+    second_page = client.get(
+        url, params={"limit": 2, "before": first_page.headers["X-Before-Cursor"]}
+    )
+    assert [conv["title"] for conv in second_page.json()] == ["First"]
+    assert second_page.headers["X-Has-More"] == "false"
+
+
+def _count_queries(sync_engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    return statements, lambda: event.remove(
+        sync_engine, "before_cursor_execute", before_cursor_execute
+    )
+
+
+def test_conversation_previews_use_write_path_counters(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_ids = [
+        client.post(f"/users/{user_id}/conversations/", json={"title": f"Chat {i}"}).json()["id"]
+        for i in range(4)
+    ]
+
+    db = TestingSessionLocal()
+    try:
+        for conversation_id in conversation_ids:
+            MessageCRUD.create_message(db, conversation_id, "user", "Hello")
+            MessageCRUD.create_message(db, conversation_id, "assistant", "Hi! " + "x" * 300)
+        # Writing to the oldest conversation moves it to the top of the list
+        MessageCRUD.create_message(db, conversation_ids[0], "user", "Still there?")
+    finally:
+        db.close()
+
+    statements, stop = _count_queries(engine)
+    try:
+        previews = client.get(f"/users/{user_id}/conversations/previews/").json()
+    finally:
+        stop()
+
+    # The user check is served from the authorization cache: one query for the page
+    assert len(statements) == 1
+    assert [preview["id"] for preview in previews] == [
+        conversation_ids[0], *reversed(conversation_ids[1:])
+    ]
+    assert previews[0]["message_count"] == 3
+    assert previews[0]["last_message_preview"] == "Still there?"
+    assert previews[0]["total_tokens"] == sum(
+        count_tokens(text) for text in ["Hello", "Hi! " + "x" * 300, "Still there?"]
+    )
+    assert len(previews[1]["last_message_preview"]) == 120
+
+
+def test_conversation_list_does_not_query_per_conversation(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    db = TestingSessionLocal()
+    try:
+        for i in range(5):
+            conversation_id = client.post(
+                f"/users/{user_id}/conversations/", json={"title": f"Chat {i}"}
+            ).json()["id"]
+            MessageCRUD.create_message(db, conversation_id, "user", f"Hello {i}")
+    finally:
+        db.close()
+
+    statements, stop = _count_queries(engine)
+    try:
+        conversations = client.get(f"/users/{user_id}/conversations/").json()
+    finally:
+        stop()
+
+    assert len(conversations) == 5
+    assert all(len(conv["messages"]) == 1 for conv in conversations)
+    # The page and its messages; the user check is served from the authorization cache
+    assert len(statements) == 2
+
+
+def test_message_writer_group_commits_concurrent_writes(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_ids = [
+        client.post(f"/users/{user_id}/conversations/", json={"title": f"Chat {i}"}).json()["id"]
+        for i in range(2)
+    ]
+    writer = MessageWriter(TestingAsyncSessionLocal, flush_interval=0.05)
+
+    async def run():
+        written = await asyncio.gather(*[
+            writer.write(conversation_ids[i % 2], "user", f"message {i}") for i in range(20)
+        ])
+        await writer.close()
+        return written
+
+    written = asyncio.run(run())
+    assert all(message.id for message in written)
+    assert writer.stats()["batches"] == 1 and writer.stats()["messages"] == 20
+
+    previews = client.get(f"/users/{user_id}/conversations/previews/").json()
+    assert sorted(preview["message_count"] for preview in previews) == [10, 10]
+
+
+def test_message_writer_flushes_queued_writes_on_close(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Shutdown"}
+    ).json()["id"]
+    writer = MessageWriter(TestingAsyncSessionLocal, flush_interval=10)
+
+    async def run():
+        await writer.start()
+        pending = asyncio.ensure_future(writer.write(conversation_id, "user", "queued"))
+        await asyncio.sleep(0)
+        await writer.close()
+        return await pending
+
+    assert asyncio.run(run()).id
+    messages = client.get(f"/conversations/{conversation_id}/messages/").json()
+    assert [msg["content"] for msg in messages] == ["queued"]
+
+
+def test_stream_chat_persists_messages_through_writer(new_user, monkeypatch):
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=["Hi there"]))
+    )
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    response = client.post(f"/chat/stream/{user_id}", json={"message": "Hello"})
+    assert response.status_code == 200
+    assert "data: [DONE]" in response.text
+
+    conversation_id = client.get(f"/users/{user_id}/conversations/").json()[0]["id"]
+    messages = client.get(f"/conversations/{conversation_id}/messages/").json()
+    assert [(msg["role"], msg["content"]) for msg in messages] == [
+        ("user", "Hello"), ("assistant", "Hi there")
+    ]
+
+
+def test_stream_chat_compacts_after_the_stream_closes(new_user, monkeypatch):
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=["Hi there"]))
+    )
+    compacted = []
+
+    async def record_compaction(db, conversation):
+        compacted.append((conversation.id, main.sse_streams_in_flight.value()))
+
+    monkeypatch.setattr(main, "compact_conversation", record_compaction)
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    response = client.post(f"/chat/stream/{user_id}", json={"message": "Hello"})
+    assert response.text.endswith("data: [DONE]\n\n")
+
+    # Summarizing runs as a background task, not inside the counted stream
+    conversation_id = client.get(f"/users/{user_id}/conversations/").json()[0]["id"]
+    assert compacted == [(conversation_id, 0)]
+
+
+async def _slow_chunks(chunks, delay):
+    for chunk in chunks:
+        yield chunk
+        await asyncio.sleep(delay)
+
+
+def test_coalesce_chunks_flushes_first_chunk_then_by_window_and_size():
+    async def collect(chunks, settings, delay=0.001):
+        return [frame async for frame in coalesce_chunks(_slow_chunks(chunks, delay), settings)]
+
+    tokens = [f"t{i} " for i in range(40)]
+
+    # First chunk goes out alone, the rest is merged into a few frames
+    frames = asyncio.run(collect(tokens, CoalesceSettings(window_ms=200, max_bytes=10_000)))
+    assert frames[0] == "t0 " and len(frames) < 5
+    assert "".join(frames) == "".join(tokens)
+
+    # The byte limit caps frame size
+    frames = asyncio.run(collect(tokens, CoalesceSettings(window_ms=200, max_bytes=16)))
+    assert all(len(frame.encode()) < 16 + 4 for frame in frames)
+    assert "".join(frames) == "".join(tokens)
+
+    # A zero window passes chunks through unchanged
+    frames = asyncio.run(collect(tokens, CoalesceSettings(window_ms=0, max_bytes=16)))
+    assert frames == tokens
+
+
+def test_websocket_streams_coalesced_chunks(new_user, monkeypatch):
+    reply = " ".join(f"word{i}" for i in range(30))
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=[reply]))
+    )
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?coalesce_ms=1000") as websocket:
+        assert websocket.receive_json()["type"] == "connection"
+        websocket.send_json({"message": "Hello"})
+
+        chunks = []
+        while True:
+            frame = websocket.receive_json()
+            if frame["type"] == "chunk":
+                chunks.append(frame["content"])
+            elif frame["type"] == "message_complete":
+                break
+
+    assert frame["full_response"] == reply == "".join(chunks)
+    assert len(chunks) < len(reply) / 2
+
+
+def test_websocket_delta_protocol_sends_text_once(new_user, monkeypatch):
+    reply = " ".join(f"word{i}" for i in range(30))
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=[reply]))
+    )
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2&coalesce_ms=0") as websocket:
+        assert websocket.receive_json()["protocol"] == 2
+        websocket.send_json({"message": "Hello"})
+
+        deltas = []
+        while True:
+            frame = websocket.receive_json()
+            assert frame["type"] != "chunk"
+            if frame["type"] == "delta":
+                assert "full_response" not in frame
+                deltas.append(frame)
+            elif frame["type"] == "message_complete":
+                break
+
+    assert [delta["seq"] for delta in deltas] == list(range(len(reply)))
+    assert "".join(delta["content"] for delta in deltas) == reply
+    assert frame["full_response"] == reply and frame["chunks"] == len(deltas)
+
+
+def _receive_until(websocket, frame_type):
+    frames = []
+    while True:
+        frames.append(websocket.receive_json())
+        if frames[-1]["type"] == frame_type:
+            return frames
+
+
+def test_websocket_cancel_stops_generation(new_user, monkeypatch):
+    reply = "x" * 200
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=[reply, "Short answer"], sleep=0.02)
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2&coalesce_ms=0") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"message": "Tell me a long story"})
+        conversation_id = _receive_until(websocket, "delta")[-1]["conversation_id"]
+
+        websocket.send_json({"type": "cancel", "conversation_id": conversation_id})
+        cancelled = _receive_until(websocket, "generation_cancelled")[-1]
+        assert 0 < len(cancelled["full_response"]) < len(reply)
+
+        # The socket keeps serving the conversation after a cancel
+        websocket.send_json({"message": "Shorter", "conversation_id": conversation_id})
+        assert _receive_until(websocket, "message_complete")[-1]["full_response"] == "Short answer"
+
+    messages = client.get(f"/conversations/{conversation_id}/messages/").json()
+    assert [msg["content"] for msg in messages] == [
+        "Tell me a long story", cancelled["full_response"], "Shorter", "Short answer"
+    ]
+
+
+def test_websocket_turn_refuses_missing_or_foreign_conversation(new_user):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Mine"}
+    ).json()["id"]
+
+    async def run():
+        return (
+            await main.load_ws_turn(TestingAsyncSessionLocal, conversation_id, user_id + 1, "hi"),
+            await main.load_ws_turn(TestingAsyncSessionLocal, 10 ** 9, user_id, "hi"),
+        )
+
+    # The handler turns None into an error frame instead of crashing
+    assert asyncio.run(run()) == (None, None)
+    assert client.get(f"/conversations/{conversation_id}/messages/").json() == []
+
+
+def test_websocket_follow_up_waits_for_summary_instead_of_failing(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["First answer", "Second answer"])
+    ))
+    compacted = []
+
+    async def slow_compaction(session_factory, conversation_id):
+        await asyncio.sleep(0.2)
+        compacted.append(conversation_id)
+
+    monkeypatch.setattr(main, "compact_ws_conversation", slow_compaction)
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"message": "Hello"})
+        frames = _receive_until(websocket, "message_complete")
+        conversation_id = frames[-1]["conversation_id"]
+
+        # Sent while the first turn is still being summarized
+        websocket.send_json({"message": "And then?", "conversation_id": conversation_id})
+        frames = _receive_until(websocket, "message_complete")
+        assert "error" not in [frame["type"] for frame in frames]
+        assert frames[-1]["full_response"] == "Second answer"
+        assert compacted[0] == conversation_id
+
+    messages = client.get(f"/conversations/{conversation_id}/messages/").json()
+    assert [msg["content"] for msg in messages] == [
+        "Hello", "First answer", "And then?", "Second answer"
+    ]
+
+
+def test_websocket_runs_generations_concurrently_up_to_limit(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["a" * 20, "b" * 20], sleep=0.02)
+    ))
+    monkeypatch.setattr(main, "WS_MAX_GENERATIONS", 2)
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_ids = [
+        client.post(f"/users/{user_id}/conversations/", json={"title": f"Chat {i}"}).json()["id"]
+        for i in range(3)
+    ]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2&coalesce_ms=0") as websocket:
+        websocket.receive_json()
+        for conversation_id in conversation_ids:
+            websocket.send_json({"message": "Hi", "conversation_id": conversation_id})
+
+        frames = _receive_until(websocket, "error")
+        assert "limit 2" in frames[-1]["message"]
+
+        # Deltas of both replies interleave on the one socket
+        completed = set()
+        while len(completed) < 2:
+            frame = websocket.receive_json()
+            frames.append(frame)
+            if frame["type"] == "message_complete":
+                completed.add(frame["conversation_id"])
+
+    assert completed == set(conversation_ids[:2])
+    delta_order = [frame["conversation_id"] for frame in frames if frame["type"] == "delta"]
+    first_done = max(i for i, cid in enumerate(delta_order) if cid == delta_order[0])
+    assert any(cid != delta_order[0] for cid in delta_order[:first_done])
+
+
+class _FakeWebSocket:
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.frames = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        if self.gate is not None:
+            await self.gate.wait()
+        self.frames.append(json.loads(text))
+
+    async def close(self, code=1000, reason=""):
+        self.close_code = code
+
+
+def test_slow_tab_does_not_hold_up_other_tabs():
+    async def run():
+        manager = ConnectionManager()
+        slow, fast = _FakeWebSocket(gate=asyncio.Event()), _FakeWebSocket()
+        await manager.connect(slow, 1)
+        await manager.connect(fast, 1)
+
+        for i in range(10):
+            await manager.send_to_user({"type": "delta", "seq": i, "content": "x"}, 1)
+        await manager.flush(fast)
+
+        stats = manager.stats()
+        manager.disconnect(slow, 1)
+        manager.disconnect(fast, 1)
+        return slow, fast, stats
+
+    slow, fast, stats = asyncio.run(run())
+    assert len(fast.frames) == 10 and slow.frames == []
+    assert stats["connections"] == 2 and stats["queued"] == 9 and stats["sent"] == 10
+
+
+def _flood_slow_client(policy):
+    async def run():
+        manager = ConnectionManager()
+        websocket = _FakeWebSocket(gate=asyncio.Event())
+        await manager.connect(websocket, 1, protocol=2)
+        client = manager._clients[id(websocket)]
+        client.policy, client.max_queue = policy, 3
+
+        for i in range(10):
+            await manager.send_message(
+                {"type": "delta", "conversation_id": 1, "seq": i, "content": str(i)}, websocket
+            )
+            await asyncio.sleep(0)
+        await manager.send_message({"type": "message_complete", "conversation_id": 1}, websocket)
+        websocket.gate.set()
+        await manager.flush(websocket)
+        await asyncio.sleep(0)
+        return websocket, manager
+
+    return asyncio.run(run())
+
+
+def test_slow_consumer_policies():
+    # Streamed text is merged or dropped, but the end of the turn always arrives
+    websocket, manager = _flood_slow_client("coalesce")
+    *deltas, complete = websocket.frames
+    assert "".join(frame["content"] for frame in deltas) == "0123456789"
+    assert deltas[-1]["seq"] == 3 and deltas[-1]["last_seq"] == 9
+    assert complete["type"] == "message_complete"
+    assert manager.stats()["coalesced"] == 6
+
+    websocket, manager = _flood_slow_client("drop")
+    *deltas, complete = websocket.frames
+    assert [frame["seq"] for frame in deltas] == [0, 1, 2, 3]
+    assert complete["type"] == "message_complete"
+    assert manager.stats()["dropped"] == 6
+
+    websocket, manager = _flood_slow_client("disconnect")
+    assert websocket.close_code == 1013
+    assert manager.active_connections == {} and manager.stats()["slow_disconnects"] == 1
+
+
+def test_unix_socket_backend_routes_messages_and_presence_across_workers():
+    directory = tempfile.mkdtemp()
+
+    # A worker that died without cleaning up its socket
+    dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    dead.bind(os.path.join(directory, "dead.sock"))
+    dead.close()
+
+    async def run():
+        worker_a = ConnectionManager(UnixSocketBackend(directory, node_id="a"))
+        worker_b = ConnectionManager(UnixSocketBackend(directory, node_id="b"))
+        await worker_a.start()
+        await worker_b.start()
+
+        websocket = _FakeWebSocket()
+        await worker_b.connect(websocket, 7)
+        await asyncio.sleep(0.05)
+        online = worker_a.connection_count(7)
+
+        await worker_a.send_to_user({"type": "chunk", "content": "hi"}, 7)
+        await asyncio.sleep(0.05)
+        await worker_b.flush(websocket)
+
+        await worker_b.stop()
+        await asyncio.sleep(0.05)
+        offline = worker_a.connection_count(7)
+        await worker_a.stop()
+        return online, offline, websocket.frames
+
+    online, offline, frames = asyncio.run(run())
+    assert (online, offline) == (1, 0)
+    assert frames == [{"type": "chunk", "content": "hi"}]
+    assert os.listdir(directory) == []
+
+
+def test_unix_socket_backend_skips_bad_datagrams_and_splits_presence(monkeypatch):
+    import pubsub
+
+    monkeypatch.setattr(pubsub, "PRESENCE_USERS_PER_DATAGRAM", 2)
+    directory = tempfile.mkdtemp()
+
+    async def run():
+        delivered = []
+        worker_a = UnixSocketBackend(directory, presence_interval=60, node_id="a")
+        worker_b = UnixSocketBackend(directory, presence_interval=60, node_id="b")
+        await worker_a.start(lambda user_id, message: delivered.append((user_id, message)))
+        await worker_b.start(lambda user_id, message: None)
+
+        # Foreign or malformed datagrams are skipped, and later ones still arrive
+        stray = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for data in (b"not json", b"[1]", b'{"kind": "message"}',
+                     b'{"kind": "presence", "origin": "x", "users": {"u": 1}}'):
+            stray.sendto(data, worker_a.path)
+        stray.close()
+        worker_b.publish(7, {"type": "chunk", "content": "hi"})
+
+        # A full snapshot of five users goes out in three datagrams
+        for user_id in range(1, 6):
+            worker_b._local[user_id] = 1
+        worker_b._send_presence_snapshot()
+        await asyncio.sleep(0.05)
+        counts = [worker_a.connection_count(user_id) for user_id in range(1, 6)]
+
+        await worker_b.stop()
+        await worker_a.stop()
+        return delivered, counts
+
+    delivered, counts = asyncio.run(run())
+    assert delivered == [(7, {"type": "chunk", "content": "hi"})]
+    assert counts == [1] * 5
+
+    # Backends must implement the whole interface
+    class Partial(pubsub.WebSocketBackend):
+        def publish(self, user_id, message):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_websocket_fans_out_one_generation_to_every_tab(new_user, monkeypatch):
+    reply = "y" * 40
+    llm = FakeListChatModel(responses=[reply], sleep=0.01)
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(llm=llm))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/users/{user_id}/conversations/", json={"title": "Shared"}
+    ).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2&coalesce_ms=0") as sender, \
+            client.websocket_connect(f"/ws/{user_id}?coalesce_ms=0") as viewer, \
+            client.websocket_connect(f"/ws/{user_id}?coalesce_ms=0") as other:
+        for websocket in (sender, viewer, other):
+            websocket.receive_json()
+        viewer.send_json({"type": "subscribe", "conversation_id": conversation_id})
+        assert viewer.receive_json()["type"] == "subscribed"
+
+        sender.send_json({"message": "Hello", "conversation_id": conversation_id})
+        sent = _receive_until(sender, "delta")
+
+        # Asking again from another tab joins the running reply instead of a new LLM call
+        other.send_json({"message": "Hello", "conversation_id": conversation_id})
+        joined = _receive_until(other, "generation_in_progress")
+        assert "already being generated" in joined[0]["message"]
+
+        sent += _receive_until(sender, "message_complete")
+        viewed = _receive_until(viewer, "message_complete")
+        caught_up = _receive_until(other, "message_complete")
+
+    assert sent[-1]["full_response"] == viewed[-1]["full_response"] == reply
+    # Protocol 1 tabs get chunk frames with the reply so far, even after joining late
+    assert viewed[-2] == {
+        "type": "chunk", "conversation_id": conversation_id,
+        "content": "y", "full_response": reply
+    }
+    assert caught_up[-2]["full_response"] == reply
+    assert len(client.get(f"/conversations/{conversation_id}/messages/").json()) == 2
+
+
+def test_response_cache_key_ttl_and_lru(monkeypatch):
+    llm = FakeListChatModel(responses=["unused"])
+    key = response_cache_key(llm, [HumanMessage(content="Hello  there ")])
+    assert key == response_cache_key(llm, [HumanMessage(content="Hello there")])
+    assert key != response_cache_key(llm, [AIMessage(content="Hello there")])
+
+    cache = ResponseCache(ttl=60, max_entries=2)
+    for name in ("a", "b", "c"):
+        cache.put(name, [name])
+    assert cache.get("a") is None and cache.get("c") == ["c"]
+    assert cache.stats()["evictions"] == 1
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("c") is None and cache.stats()["entries"] == 1
+
+
+def test_chatbot_replays_cached_replies_chunk_by_chunk():
+    bot = StreamingChatbot(llm=FakeListChatModel(responses=["abc", "different"]))
+    history = [{"role": "user", "content": "Hello!"}]
+
+    async def stream():
+        return [chunk["chunk"] async for chunk in bot.stream_response(history)]
+
+    assert asyncio.run(stream()) == ["a", "b", "c"]
+    assert asyncio.run(stream()) == ["a", "b", "c"]
+    assert bot.get_response(history) == "abc"
+    assert response_cache.stats()["hits"] == 2
+
+    # A different history is a different prompt
+    history.append({"role": "assistant", "content": "abc"})
+    assert bot.get_response(history) == "different"
+
+
+def test_chatbot_single_flight_shares_one_upstream_stream():
+    llm = FakeListChatModel(responses=["shared", "second call"], sleep=0.01)
+    bot = StreamingChatbot(llm=llm, cache=None)
+    history = [{"role": "user", "content": "Hello!"}]
+
+    async def read(stop_after=None):
+        chunks = []
+        async with aclosing(bot.stream_response(history)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk["chunk"])
+                if len(chunks) == stop_after:
+                    break
+        return "".join(chunks)
+
+    async def run():
+        first = asyncio.ensure_future(read())
+        await asyncio.sleep(0.035)
+        # Late subscribers still get the reply from the start
+        results = await asyncio.gather(first, read(), read(stop_after=2))
+        return results, bot.flights.started, bot.flights.joined, len(bot.flights)
+
+    results, started, joined, in_flight = asyncio.run(run())
+    assert results == ["shared", "shared", "sh"]
+    assert (started, joined, in_flight) == (1, 2, 0)
+
+    async def abandon():
+        await read(stop_after=1)
+        await asyncio.sleep(0)
+        return len(bot.flights)
+
+    # The upstream stream is cancelled once its only reader goes away
+    assert asyncio.run(abandon()) == 0
+    assert asyncio.run(read()) == "shared"
+
+
+def test_fake_llm_is_deterministic_with_injected_failures():
+    llm = FakeStreamingChatModel(ttft_ms=0, token_delay_ms=0, tokens=8)
+    prompt = [HumanMessage(content="Hello")]
+    reply = llm.invoke(prompt).content
+    assert len(reply.split()) == 8 and llm.invoke(prompt).content == reply
+    assert FakeStreamingChatModel(tokens=8, seed=1).reply_tokens(prompt) != llm.reply_tokens(prompt)
+
+    async def stream():
+        return [chunk.content async for chunk in llm.astream(prompt)]
+
+    assert "".join(asyncio.run(stream())) == reply
+
+    llm.error_rate = 1
+    with pytest.raises(FakeLLMError):
+        asyncio.run(stream())
+    with pytest.raises(ValueError):
+        create_llm(temperature=0.7, provider="unknown")
+
+
+class _RateLimited(Exception):
+    status_code = 429
+
+
+def test_scheduler_orders_by_priority_and_shares_slots_between_users():
+    scheduler = LLMScheduler(max_concurrency=2)
+    running = [scheduler.enqueue("a"), scheduler.enqueue("a")]
+    assert all(ticket.admitted for ticket in running)
+
+    a3, a4 = scheduler.enqueue("a"), scheduler.enqueue("a")
+    b1 = scheduler.enqueue("b")
+    bulk = scheduler.enqueue("c", "bulk")
+    summary = scheduler.enqueue(None, "background")
+    waiting = [b1, a3, a4, summary, bulk]
+    # b holds no slot yet, so it goes before a's backlog; lower classes wait for both
+    assert [scheduler.status(ticket).position for ticket in waiting] == [1, 2, 3, 4, 5]
+
+    admitted = []
+    for ticket in running + waiting:
+        scheduler.release(ticket)
+        admitted.extend(t for t in waiting if t.admitted and t not in admitted)
+    assert admitted == waiting
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+    with pytest.raises(ValueError):
+        scheduler.enqueue("a", "urgent")
+
+
+def test_scheduler_backs_off_and_retries_after_rate_limit(caplog):
+    scheduler = LLMScheduler(max_concurrency=1, backoff=0.05)
+    attempts = []
+
+    async def open_stream():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise _RateLimited("429 Too Many Requests")
+        yield "hello"
+
+    async def run():
+        return [item async for item in scheduler.stream(open_stream, "a")]
+
+    items = asyncio.run(run())
+    assert items[-1] == "hello"
+    assert all(isinstance(item, QueueStatus) for item in items[:-1])
+    assert attempts[1] - attempts[0] >= 0.05
+    assert scheduler.rate_limited == 1 and scheduler.active == 0
+    assert [record.levelname for record in caplog.records if record.name == "scheduler"] == [
+        "WARNING"
+    ]
+
+    # Other errors, and rate limits after the first chunk, are not retried
+    async def failing():
+        yield "partial"
+        raise _RateLimited("429")
+
+    async def run_failing():
+        return [item async for item in scheduler.stream(failing, "a")]
+
+    with pytest.raises(_RateLimited):
+        asyncio.run(run_failing())
+    assert scheduler.active == 0
+
+
+def test_stream_chat_reports_queue_position_while_waiting(new_user, monkeypatch):
+    scheduler = LLMScheduler(max_concurrency=1, backoff=0.2)
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["Queued answer"]), cache=None, scheduler=scheduler
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    # A provider rate limit holds every admission for a moment
+    scheduler.backoff(_RateLimited("429"))
+    response = client.post(f"/chat/stream/{user_id}", json={"message": "Hi"})
+    events = [
+        json.loads(line[6:]) for line in response.text.splitlines()
+        if line.startswith("data: {")
+    ]
+    types = [event["type"] for event in events]
+    assert types[:2] == ["conversation_id", "queued"]
+    assert events[1]["position"] == 1
+    assert types[-2:] == ["complete", "timing"]
+    assert events[-2]["full_response"] == "Queued answer"
+    assert "queued" not in types[2:]
+
+
+def _metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_histogram_renders_cumulative_prometheus_buckets():
+    histogram = Histogram("test_seconds", "Test latency", ("method",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 2):
+        histogram.observe(value, 'get "x"')
+
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP test_seconds Test latency", "# TYPE test_seconds histogram"]
+    assert lines[2:] == [
+        'test_seconds_bucket{method="get \\"x\\"",le="0.1"} 1',
+        'test_seconds_bucket{method="get \\"x\\"",le="1"} 3',
+        'test_seconds_bucket{method="get \\"x\\"",le="+Inf"} 4',
+        'test_seconds_sum{method="get \\"x\\""} 3.05',
+        'test_seconds_count{method="get \\"x\\""} 4',
+    ]
+
+
+def test_metrics_endpoint_reports_stream_and_database_metrics(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["Measured reply"]), cache=None
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    assert client.post(f"/chat/stream/{user_id}", json={"message": "Hi"}).status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    assert _metric_value(text, "llm_time_to_first_token_seconds_count") >= 1
+    assert _metric_value(text, "llm_tokens_per_second_count") >= 1
+    assert _metric_value(
+        text, 'db_crud_seconds_count{method="AsyncUserCRUD.user_exists"}'
+    ) >= 1
+    assert _metric_value(text, "sse_streams_in_flight") == 0
+    assert _metric_value(text, "websocket_connections") == 0
+
+    with client.websocket_connect(f"/ws/{user_id}") as websocket:
+        websocket.receive_json()
+        assert _metric_value(client.get("/metrics").text, "websocket_connections") == 1
+
+
+def test_metrics_endpoint_reports_cache_writer_and_scheduler_counters(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["Counted reply"])
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    samples = [
+        'cache_hits_total{cache="auth"}', 'cache_misses_total{cache="history"}',
+        'cache_misses_total{cache="response"}', "message_writer_batches_total",
+        "message_writer_messages_total", "llm_scheduler_admitted_total",
+    ]
+    before = client.get("/metrics").text
+    assert 'cache_entries{cache="history"}' in before
+    assert "cache_evictions_total" in before and "llm_scheduler_rate_limited_total" in before
+
+    assert client.post(f"/chat/stream/{user_id}", json={"message": "Hi"}).status_code == 200
+    after = client.get("/metrics").text
+    increase = {
+        sample: _metric_value(after, sample) - _metric_value(before, sample) for sample in samples
+    }
+    assert increase.pop("message_writer_messages_total") == 2
+    assert all(value >= 1 for value in increase.values()), increase
+
+
+def test_instrument_engine_counts_commits_and_pool_waits():
+    scratch = create_engine("sqlite://")
+    instrument_engine(scratch, "scratch")
+    with scratch.connect() as connection:
+        connection.exec_driver_sql("CREATE TABLE t (x INTEGER)")
+        connection.commit()
+    assert db_commits.value("scratch") == 1
+    assert db_pool_wait.count("scratch") == 1
+
+    # Replacing the pool keeps the checkout timing
+    scratch.dispose()
+    with scratch.begin() as connection:
+        connection.exec_driver_sql("SELECT 1")
+    assert db_pool_wait.count("scratch") == 2
+
+    # A metric type that renders no samples can't be created
+    class Unrendered(Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Unrendered("unrendered", "No samples")
+
+
+def test_http_responses_carry_server_timing_for_each_stage(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["Timed reply"]), cache=None
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    response = client.post(f"/chat/{user_id}", json={"message": "Hi"})
+    stages = [metric.split(";")[0] for metric in response.headers["Server-Timing"].split(", ")]
+    assert {
+        "AsyncUserCRUD.user_exists", "AsyncConversationCRUD.create_conversation",
+        "AsyncMessageCRUD.create_message", "AsyncMessageCRUD.get_turn_context", "llm",
+    } <= set(stages)
+    assert stages[0] == "AsyncUserCRUD.user_exists" and stages[-1] == "total"
+
+    # Streams time the stages after the headers in a final timing frame
+    response = client.post(f"/chat/stream/{user_id}", json={"message": "Again"})
+    assert "AsyncUserCRUD.user_exists;dur=" in response.headers["Server-Timing"]
+    assert "save_message;dur=" in response.headers["Server-Timing"]
+    events = [
+        json.loads(line[6:]) for line in response.text.splitlines()
+        if line.startswith("data: {")
+    ]
+    timing = events[-1]
+    assert timing["type"] == "timing"
+    assert {"llm_first_token", "llm_stream", "save_reply"} <= set(timing["spans"])
+    assert timing["total_ms"] >= timing["spans"]["llm_stream"]
+
+
+def test_websocket_reply_ends_with_timing_frame(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeListChatModel(responses=["Timed reply"]), cache=None
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}?protocol=2") as websocket:
+        websocket.receive_json()
+        websocket.send_json({"message": "Hi"})
+        _receive_until(websocket, "message_complete")
+        timing = websocket.receive_json()
+
+    assert timing["type"] == "timing"
+    assert "AsyncMessageCRUD.get_turn_context" in timing["spans"]
+    assert {"save_message", "llm_first_token", "llm_stream", "save_reply"} <= set(timing["spans"])
+
+
+def test_trace_log_writes_sampled_traces_as_json_lines(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "trace_log", TraceLog(str(path), sample_rate=1))
+    with tracing.tracing("GET /test"):
+        with tracing.span("stage"):
+            pass
+    with tracing.span("outside a trace"):
+        pass
+
+    monkeypatch.setattr(tracing, "trace_log", TraceLog(str(path), sample_rate=0))
+    with tracing.tracing("GET /unsampled"):
+        pass
+
+    lines = path.read_text().splitlines()
+    assert len(lines) == 1
+    trace = json.loads(lines[0])
+    assert trace["name"] == "GET /test"
+    assert [span["name"] for span in trace["spans"]] == ["stage"]
+
+
+class _PickyModel(FakeStreamingChatModel):
+    """Fake model that fails on "boom" and records the calls running at once"""
+    running: int = 0
+    peak: int = 0
+
+    async def _agenerate(self, messages, *args, **kwargs):
+        if messages[-1].content == "boom":
+            raise FakeLLMError("boom")
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            return await super()._agenerate(messages, *args, **kwargs)
+        finally:
+            self.running -= 1
+
+
+def test_chatbot_batch_responses_limit_concurrency_and_isolate_failures():
+    llm = _PickyModel(ttft_ms=20, token_delay_ms=0, tokens=4)
+    scheduler = LLMScheduler(max_concurrency=0)
+    bot = StreamingChatbot(llm=llm, scheduler=scheduler)
+    prompts = ["one", "two", "boom", "three", "one", "four"]
+    conversations = [([{"role": "user", "content": text}], None) for text in prompts]
+
+    replies = asyncio.run(bot.batch_responses(conversations, max_concurrency=2))
+    assert isinstance(replies[2], FakeLLMError)
+    assert replies[0] == replies[4] == llm.invoke([HumanMessage(content="one")]).content
+    assert llm.peak == 2
+    # Identical prompts share one call; failures are not cached
+    assert scheduler.admitted == 5
+    assert asyncio.run(bot.aget_response(*conversations[1])) == replies[1]
+    assert scheduler.admitted == 5
+    with pytest.raises(FakeLLMError):
+        asyncio.run(bot.aget_response(*conversations[2]))
+
+
+def test_chat_batch_loads_histories_in_one_query(new_user, monkeypatch):
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=FakeStreamingChatModel(ttft_ms=0, token_delay_ms=0, tokens=4), cache=None
+    ))
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/chat/{user_id}", json={"message": "First"}
+    ).json()["conversation_id"]
+    history_cache.clear()
+
+    statements, stop = _count_queries(async_engine.sync_engine)
+    try:
+        response = client.post(f"/chat/batch/{user_id}", json={"requests": [
+            {"message": "Again", "conversation_id": conversation_id},
+            {"message": "Something new"},
+            {"message": "Lost", "conversation_id": 999999},
+        ]})
+    finally:
+        stop()
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["conversation_id"] == conversation_id and results[0]["message"]
+    assert results[1]["conversation_id"] not in (None, conversation_id)
+    assert results[2] == {"conversation_id": None, "message": None,
+                          "error": "Conversation not found"}
+    assert len([sql for sql in statements if "running_tokens" in sql]) == 1
+
+    messages = client.get(f"/conversations/{conversation_id}/messages/").json()
+    assert [msg["role"] for msg in messages] == ["user", "assistant", "user", "assistant"]
+    assert messages[-1]["content"] == results[0]["message"]
+
+    duplicate = {"message": "Hi", "conversation_id": conversation_id}
+    response = client.post(f"/chat/batch/{user_id}", json={"requests": [duplicate, duplicate]})
+    assert response.status_code == 400
+
+
+def test_websocket_holds_no_db_session_while_idle(new_user, monkeypatch):
+    monkeypatch.setattr(
+        main, "chatbot", StreamingChatbot(llm=FakeListChatModel(responses=["Hi there"]))
+    )
+    open_sessions = []
+
+    @asynccontextmanager
+    async def tracked_session():
+        async with TestingAsyncSessionLocal() as db:
+            open_sessions.append(db)
+            try:
+                yield db
+            finally:
+                open_sessions.remove(db)
+
+    async def tracked_db():
+        async with tracked_session() as db:
+            yield db
+
+    monkeypatch.setitem(app.dependency_overrides, get_async_db, tracked_db)
+    monkeypatch.setitem(app.dependency_overrides, get_async_session_factory,
+                        lambda: tracked_session)
+    user_id = client.post("/users/", json=new_user).json()["id"]
+
+    with client.websocket_connect(f"/ws/{user_id}") as websocket:
+        assert websocket.receive_json()["type"] == "connection"
+        assert open_sessions == []
+
+        websocket.send_json({"message": "Hello"})
+        frames = _receive_until(websocket, "message_complete")
+        conversation_id = frames[0]["conversation_id"]
+
+        websocket.send_json({"type": "subscribe", "conversation_id": conversation_id})
+        _receive_until(websocket, "subscribed")
+        # Saving the reply and summarizing use short sessions of their own
+        deadline = time.monotonic() + 5
+        while open_sessions and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert open_sessions == []
+
+
+def test_pool_options_and_stats():
+    assert pool_options("sqlite:///./chat.db")["pool_size"] == 5
+    assert "pool_size" not in pool_options("sqlite+aiosqlite:///./chat.db")
+    assert pool_options("postgresql+asyncpg://u:p@db/chat")["max_overflow"] == 10
+
+    scratch = create_engine("sqlite://", poolclass=QueuePool, pool_size=2, max_overflow=1)
+    with scratch.connect():
+        stats = pool_stats(scratch)
+    assert stats == {"pool": "QueuePool", "size": 2, "max_overflow": 1,
+                     "checked_in": 0, "checked_out": 1, "overflow": 0}
+    assert pool_stats(async_engine.sync_engine) == {"pool": "NullPool"}
+
+
+def test_authorization_cache_ttl_and_lru(monkeypatch):
+    cache = AuthorizationCache(ttl=60, max_entries=4)
+    # Adding a conversation also records that its owner exists
+    cache.add_conversation(1, user_id=10)
+    cache.add_conversation(2, user_id=20)
+    assert cache.conversation_owner(1) == 10 and cache.has_user(10)
+    cache.add_user(30)
+    assert cache.conversation_owner(2) is None and cache.has_user(10)
+
+    cache.invalidate_user(20)
+    assert not cache.has_user(20)
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert not cache.has_user(30)
+    assert not AuthorizationCache(ttl=0).has_user(30)
+
+
+def test_authorization_checks_skip_the_database_and_follow_deletes(new_user, monkeypatch):
+    user_id = client.post("/users/", json=new_user).json()["id"]
+    conversation_id = client.post(
+        f"/chat/{user_id}", json={"message": "First"}
+    ).json()["conversation_id"]
+    assert auth_cache.conversation_owner(conversation_id) == user_id
+
+    async def skip_compaction(db, conversation_id):
+        pass
+
+    monkeypatch.setattr(main, "compact_stored_conversation", skip_compaction)
+
+    statements, stop = _count_queries(async_engine.sync_engine)
+    try:
+        response = client.post(
+            f"/chat/{user_id}", json={"message": "Again", "conversation_id": conversation_id}
+        )
+    finally:
+        stop()
+    assert response.status_code == 200
+    # Ownership comes from the auth cache and the summary from the history cache
+    assert not any("FROM users" in sql or "FROM conversations" in sql for sql in statements)
+
+    # Deletes through the ORM drop the cached checks
+    db = TestingSessionLocal()
+    try:
+        db.delete(db.get(Conversation, conversation_id))
+        db.commit()
+        assert auth_cache.conversation_owner(conversation_id) is None
+        assert auth_cache.has_user(user_id)
+        db.delete(db.get(User, user_id))
+        db.commit()
+    finally:
+        db.close()
+    assert not auth_cache.has_user(user_id)
+    assert client.post(f"/chat/{user_id}", json={"message": "Gone"}).status_code == 404
+
+
+# Seconds `import main` may take; the LLM stack loads during the startup warmup instead
+IMPORT_TIME_BUDGET = 3.0
+
+
+def test_importing_the_app_skips_the_llm_stack():
+    script = (
+        "import json, sys, time\n"
+        "started = time.perf_counter()\n"
+        "import main\n"
+        "heavy = sorted({m.split('.')[0] for m in sys.modules} & "
+        "{'chatbot', 'llm_providers', 'langgraph', 'langchain', 'langchain_core'})\n"
+        "print(json.dumps([time.perf_counter() - started, heavy]))\n"
+    )
+    env = {**os.environ, "DATABASE_URL": "sqlite:///" + os.path.join(tempfile.mkdtemp(), "i.db")}
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+    )
+    seconds, heavy = json.loads(result.stdout.splitlines()[-1])
+    assert heavy == []
+    assert seconds < IMPORT_TIME_BUDGET
+
+
+def test_chatbot_warmup_ping_is_opt_in_scheduled_and_bounded(monkeypatch):
+    import llm_providers
+
+    prompts = []
+
+    class RecordingModel(FakeListChatModel):
+        delay: float = 0
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            prompts.append(kwargs)
+            await asyncio.sleep(self.delay)
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+    scheduler = LLMScheduler(max_concurrency=1)
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=RecordingModel(responses=["ok"]), scheduler=scheduler
+    ))
+
+    # Off by default: starting a worker costs no completion
+    asyncio.run(main.prepare_chatbot())
+    assert prompts == []
+
+    monkeypatch.setattr(llm_providers, "LLM_WARMUP_PING", True)
+    asyncio.run(main.prepare_chatbot())
+    assert prompts == [{"max_tokens": 1}]
+    assert scheduler.stats()["admitted"] == 1
+
+    # A ping that hangs doesn't hold the worker back from ready
+    monkeypatch.setattr(llm_providers, "LLM_WARMUP_TIMEOUT", 0.05)
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(
+        llm=RecordingModel(responses=["ok"], delay=5), scheduler=scheduler
+    ))
+    started = time.monotonic()
+    asyncio.run(main.prepare_chatbot())
+    assert time.monotonic() - started < 1
+
+    # The offline model has no connection to warm
+    fake = FakeStreamingChatModel()
+    monkeypatch.setattr(main, "chatbot", StreamingChatbot(llm=fake, scheduler=scheduler))
+    asyncio.run(main.prepare_chatbot())
+    assert fake.calls == 0
+
+
+def test_warmup_retries_steps_and_reports_readiness(monkeypatch):
+    warmup = Warmup(retry=0.01)
+    attempts = []
+
+    async def flaky_database():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise ConnectionError("database is starting up")
+
+    async def model():
+        pass
+
+    warmup.add("database", flaky_database)
+    warmup.add("chatbot", model)
+    monkeypatch.setattr(main, "warmup", warmup)
+
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["steps"]["database"]["done"] is False
+
+    asyncio.run(warmup.wait())
+    response = client.get("/ready")
+    assert response.status_code == 200
+    steps = response.json()["steps"]
+    assert steps["database"]["attempts"] == 3 and steps["database"]["error"] is None
+    assert steps["chatbot"]["attempts"] == 1
+    assert attempts[2] - attempts[1] >= 0.02
@@ -0,0 +1,166 @@
+""" per-request stage timing: spans, Server-Timing headers and sampled trace logs"""
+import functools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from starlette.datastructures import MutableHeaders
+
+load_dotenv()
+
+# Fraction of requests written to TRACE_LOG_PATH as JSON lines; 0 disables the log
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "traces.jsonl")
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Spans recorded while handling one request or WebSocket message"""
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        # (name, start offset, duration) in seconds
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def record(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def totals(self) -> Dict[str, float]:
+        """Milliseconds spent in each stage, summed over repeated spans"""
+        totals: Dict[str, float] = {}
+        for name, _, duration in self.spans:
+            totals[name] = totals.get(name, 0) + duration * 1000
+        return {name: round(ms, 3) for name, ms in totals.items()}
+
+    def server_timing(self) -> str:
+        """Server-Timing header value for the spans so far"""
+        metrics = [f"{name};dur={ms:.1f}" for name, ms in self.totals().items()]
+        metrics.append(f"total;dur={self.elapsed * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def timing_event(self) -> dict:
+        """Frame sent at the end of a stream"""
+        return {
+            "type": "timing",
+            "spans": self.totals(),
+            "total_ms": round(self.elapsed * 1000, 3),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.elapsed * 1000, 3),
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 3),
+                 "duration_ms": round(duration * 1000, 3)}
+                for name, offset, duration in self.spans
+            ],
+        }
+
+
+class TraceLog:
+    """Appends a sample of finished traces to a JSONL file"""
+    def __init__(self, path: str = TRACE_LOG_PATH, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+
+    def maybe_write(self, trace: Trace):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace.to_dict()) + "\n"
+        try:
+            with self._lock, open(self.path, "a") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Error writing trace to {self.path}: {e}")
+
+
+# Global trace log instance
+trace_log = TraceLog()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record_span(name: str, started: float, duration: float):
+    """Add a span measured by the caller to the current trace, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, started, duration)
+
+
+@contextmanager
+def span(name: str):
+    """Time the body of the block as a stage of the current trace"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(name, started, time.perf_counter() - started)
+
+
+@contextmanager
+def tracing(name: str):
+    """Record spans of the block into a new trace, logged when the block ends"""
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace_log.maybe_write(trace)
+
+
+def traced(name: str):
+    """Decorator running a coroutine function in a trace of its own"""
+    def decorate(function):
+        @functools.wraps(function)
+        async def run(*args, **kwargs):
+            with tracing(name):
+                return await function(*args, **kwargs)
+        return run
+    return decorate
+
+
+class ServerTimingMiddleware:
+    """Traces each HTTP request and reports its stages in a Server-Timing header.
+
+    The header is written when the response starts, so streaming responses only
+    include the stages before their first byte; they send the rest in a timing
+    frame at the end of the stream.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with tracing(f"{scope['method']} {scope['path']}") as trace:
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", trace.server_timing())
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
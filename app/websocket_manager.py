@@ -1,15 +1,244 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import Dict, List
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+from collections import deque
 import json
 import asyncio
+import os
+
+from dotenv import load_dotenv
+
+from pubsub import WebSocketBackend, create_backend
+from streaming import WS_PROTOCOL_FULL
+
+load_dotenv()
+
+# Frames waiting to be written to one connection before the slow consumer policy applies
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do with streamed text when a connection's queue is full: coalesce, drop or disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+# A single send taking longer than this disconnects the client
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+SLOW_CONSUMER_POLICIES = ("coalesce", "drop", "disconnect")
+if WS_SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(
+        f"WS_SLOW_CONSUMER_POLICY must be one of {SLOW_CONSUMER_POLICIES}, "
+        f"got {WS_SLOW_CONSUMER_POLICY!r}"
+    )
+
+# Streamed text frames that can be merged into the one queued before them
+STREAM_FRAME_TYPES = ("chunk", "delta")
+
+# Close code sent to clients that can't keep up (1013: try again later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+def merge_frames(queued: Dict[str, Any], message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Combine two streamed text frames of one reply, or None if they can't be merged.
+
+    A merged delta keeps the `seq` of its first piece and adds `last_seq`.
+    """
+    if (
+            queued.get("type") not in STREAM_FRAME_TYPES
+            or queued.get("type") != message.get("type")
+            or queued.get("conversation_id") != message.get("conversation_id")
+    ):
+        return None
+
+    # Newest frame wins for everything else, e.g. a chunk's full_response
+    merged = dict(message)
+    merged["content"] = queued["content"] + message["content"]
+    if message["type"] == "delta":
+        merged["seq"] = queued["seq"]
+        merged["last_seq"] = message.get("last_seq", message["seq"])
+    return merged
+
+
+class ClientConnection:
+    """One WebSocket with its own outbound queue and writer task"""
+    def __init__(
+            self,
+            websocket: WebSocket,
+            user_id: int,
+            on_close: Callable[["ClientConnection"], None],
+            protocol: int = WS_PROTOCOL_FULL,
+            max_queue: int = WS_SEND_QUEUE_SIZE,
+            policy: str = WS_SLOW_CONSUMER_POLICY,
+            send_timeout: float = WS_SEND_TIMEOUT
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.protocol = protocol
+        # Conversations whose reply frames this connection receives
+        self.subscriptions: Set[int] = set()
+        # Reply text so far per conversation, for protocol 1 chunk frames
+        self._replies: Dict[int, str] = {}
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self._on_close = on_close
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.create_task(self._run())
+        self.closed = False
+        self.too_slow = False
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def enqueue(self, message: Dict[str, Any]):
+        """Queue a frame without waiting for the socket"""
+        if self.closed:
+            return
+
+        message = self._render(message)
+        if len(self._queue) >= self.max_queue and not self._overflow(message):
+            return
+
+        self._queue.append(message)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._idle.clear()
+        self._ready.set()
+
+    def _overflow(self, message: Dict[str, Any]) -> bool:
+        """Apply the slow consumer policy to a frame for a full queue; True to queue it anyway.
+
+        Only streamed text is coalesced or dropped. Other frames, such as
+        message_complete or error, tell the client a turn has ended, so they are
+        queued past the limit unless the policy is to disconnect; the send timeout
+        still disconnects a client that stops reading.
+        """
+        streamed = message.get("type") in STREAM_FRAME_TYPES
+        if streamed and self.policy == "coalesce":
+            merged = merge_frames(self._queue[-1], message)
+            if merged is not None:
+                self._queue[-1] = merged
+                self.coalesced += 1
+                return False
+        elif streamed and self.policy == "drop":
+            self.dropped += 1
+            return False
+        elif not streamed and self.policy != "disconnect":
+            return True
+
+        print(f"Disconnecting slow WebSocket client of user {self.user_id}")
+        self.close(SLOW_CONSUMER_CLOSE_CODE, "Client too slow")
+        return False
+
+    def _render(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Adapt a broadcast reply frame to this connection's protocol"""
+        if self.protocol != WS_PROTOCOL_FULL:
+            return message
+
+        conversation_id = message.get("conversation_id")
+        kind = message.get("type")
+        if kind == "generation_in_progress":
+            self._replies[conversation_id] = message["content"]
+        elif kind == "delta":
+            full_response = self._replies.get(conversation_id, "") + message["content"]
+            self._replies[conversation_id] = full_response
+            return {
+                "type": "chunk",
+                "conversation_id": conversation_id,
+                "content": message["content"],
+                "full_response": full_response
+            }
+        elif kind in ("message_complete", "generation_cancelled", "error"):
+            self._replies.pop(conversation_id, None)
+        return message
+
+    async def _run(self):
+        """Write queued frames to the socket one at a time"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._idle.set()
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            message = self._queue.popleft()
+            started = loop.time()
+            try:
+                await asyncio.wait_for(
+                    self.websocket.send_text(json.dumps(message)), self.send_timeout
+                )
+            except asyncio.TimeoutError:
+                print(f"WebSocket send to user {self.user_id} timed out")
+                self.close(SLOW_CONSUMER_CLOSE_CODE, "Client too slow")
+                return
+            except Exception as e:
+                print(f"Error sending message: {e}")
+                self.close()
+                return
+
+            elapsed = loop.time() - started
+            self.sent += 1
+            self.send_time += elapsed
+            self.max_send_time = max(self.max_send_time, elapsed)
+
+    async def flush(self):
+        """Wait until every queued frame has been written"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), self.send_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self, code: Optional[int] = None, reason: str = ""):
+        """Stop the writer, dropping queued frames, and optionally close the socket"""
+        if self.closed:
+            return
+        self.closed = True
+        self.too_slow = code == SLOW_CONSUMER_CLOSE_CODE
+        self._queue.clear()
+        self._idle.set()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code, reason))
+        self._on_close(self)
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), self.send_timeout)
+        except Exception as e:
+            print(f"Error closing WebSocket: {e}")
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, backend: Optional[WebSocketBackend] = None):
+        # Carries messages and presence to the other workers
+        self.backend = backend or create_backend()
         # Store active connections: {user_id: [websocket_connections]}
         self.active_connections: Dict[int, List[WebSocket]] = {}
+        # Writers keyed by id(websocket), since WebSocket objects aren't hashable
+        self._clients: Dict[int, ClientConnection] = {}
+        # Totals of connections that have already closed
+        self._closed_totals = {"sent": 0, "dropped": 0, "coalesced": 0}
+        self.slow_disconnects = 0
+
+    def __len__(self) -> int:
+        """Connections open on this worker"""
+        return len(self._clients)
+
+    async def start(self):
+        """Start exchanging messages and presence with other workers"""
+        await self.backend.start(self._deliver)
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def stop(self):
+        """Stop exchanging messages with other workers"""
+        await self.backend.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: int, protocol: int = WS_PROTOCOL_FULL):
         """Accept websocket connection and add to user's connections"""
         print("websocket connect")
         await websocket.accept()
@@ -18,45 +247,121 @@ class ConnectionManager:
             self.active_connections[user_id] = []
 
         self.active_connections[user_id].append(websocket)
+        self._clients[id(websocket)] = ClientConnection(
+            websocket, user_id, self._client_closed, protocol
+        )
+        self.backend.set_presence(user_id, len(self.active_connections[user_id]))
         print(f"User {user_id} connected. Total connections: {len(self.active_connections[user_id])}")
 
     def disconnect(self, websocket: WebSocket, user_id: int):
         """Remove websocket connection"""
         if user_id in self.active_connections:
-            if websocket in self.active_connections[user_id]:
-                self.active_connections[user_id].remove(websocket)
+            # Compare by identity: WebSockets compare equal when their scopes match
+            self.active_connections[user_id] = [
+                ws for ws in self.active_connections[user_id] if ws is not websocket
+            ]
+
+            self.backend.set_presence(user_id, len(self.active_connections[user_id]))
 
             # Remove user entry if no connections left
             if not self.active_connections[user_id]:
                 del self.active_connections[user_id]
 
+        # Stop the connection's writer; anything still queued is dropped
+        client = self._clients.get(id(websocket))
+        if client is not None:
+            client.close()
+
         print(f"User {user_id} disconnected")
 
+    def _client_closed(self, client: ClientConnection):
+        """Forget a connection whose writer stopped"""
+        if self._clients.pop(id(client.websocket), None) is None:
+            return
+        self._closed_totals["sent"] += client.sent
+        self._closed_totals["dropped"] += client.dropped
+        self._closed_totals["coalesced"] += client.coalesced
+        self.slow_disconnects += client.too_slow
+        if any(ws is client.websocket for ws in self.active_connections.get(client.user_id, [])):
+            # The writer gave up on the socket before the endpoint noticed
+            self.disconnect(client.websocket, client.user_id)
+
     async def send_message(self, message: dict, websocket: WebSocket):
-        """Send message to specific websocket"""
-        try:
-            await websocket.send_text(json.dumps(message))
-        except Exception as e:
-            print(f"Error sending message: {e}")
+        """Queue a message for a specific websocket"""
+        client = self._clients.get(id(websocket))
+        if client is not None:
+            client.enqueue(message)
 
     async def send_to_user(self, message: dict, user_id: int):
-        """Send message to all connections of a user"""
-        if user_id in self.active_connections:
-            disconnected = []
-            for websocket in self.active_connections[user_id]:
-                try:
-                    await websocket.send_text(json.dumps(message))
-                except:
-                    disconnected.append(websocket)
+        """Queue a message for all connections of a user, on every worker"""
+        self._deliver(user_id, message)
+        self.backend.publish(user_id, message)
+
+    def _deliver(self, user_id: int, message: dict):
+        """Queue a message for the user's connections on this worker.
+
+        Frames about a conversation only go to connections subscribed to it.
+        """
+        conversation_id = message.get("conversation_id")
+        for websocket in list(self.active_connections.get(user_id, [])):
+            client = self._clients.get(id(websocket))
+            if client is not None and (
+                    conversation_id is None or conversation_id in client.subscriptions
+            ):
+                client.enqueue(message)
 
-            # Remove disconnected websockets
-            for ws in disconnected:
-                self.active_connections[user_id].remove(ws)
+    def subscribe(self, websocket: WebSocket, conversation_id: int):
+        """Send a conversation's reply frames to a websocket"""
+        client = self._clients.get(id(websocket))
+        if client is not None:
+            client.subscriptions.add(conversation_id)
+
+    def unsubscribe(self, websocket: WebSocket, conversation_id: int):
+        """Stop sending a conversation's reply frames to a websocket"""
+        client = self._clients.get(id(websocket))
+        if client is not None:
+            client.subscriptions.discard(conversation_id)
+
+    def subscriber_count(self, user_id: int, conversation_id: int) -> int:
+        """Connections on this worker subscribed to a user's conversation"""
+        return sum(
+            1 for websocket in self.active_connections.get(user_id, [])
+            if conversation_id in getattr(self._clients.get(id(websocket)), "subscriptions", ())
+        )
+
+    def connection_count(self, user_id: int) -> int:
+        """Connections the user has across all workers"""
+        return self.backend.connection_count(user_id)
 
     async def broadcast_to_user(self, message: dict, user_id: int):
         """Broadcast message to all user's connections"""
         await self.send_to_user(message, user_id)
 
+    async def flush(self, websocket: WebSocket):
+        """Wait for the messages queued for a websocket to be sent"""
+        client = self._clients.get(id(websocket))
+        if client is not None:
+            await client.flush()
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth, send latency and slow consumer counters"""
+        clients = list(self._clients.values())
+        sent = sum(client.sent for client in clients)
+        send_time = sum(client.send_time for client in clients)
+        return {
+            "connections": len(clients),
+            "queued": sum(client.depth for client in clients),
+            "max_queue_depth": max((client.max_depth for client in clients), default=0),
+            "sent": sent + self._closed_totals["sent"],
+            "dropped": sum(client.dropped for client in clients) + self._closed_totals["dropped"],
+            "coalesced": (
+                sum(client.coalesced for client in clients) + self._closed_totals["coalesced"]
+            ),
+            "slow_disconnects": self.slow_disconnects,
+            "avg_send_ms": send_time / sent * 1000 if sent else 0.0,
+            "max_send_ms": max((client.max_send_time for client in clients), default=0.0) * 1000,
+        }
+
 
 # Global connection manager instance
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()